@@ -1,15 +1,198 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session
+from flask import Flask, render_template, stream_template, get_flashed_messages, request, redirect, url_for, flash, session, jsonify, Response, stream_with_context, g, has_app_context, has_request_context
+import bisect
+import click
+import csv
+import hashlib
+import heapq
+import hmac
+import io
+import json
+import math
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime
-from sqlalchemy import or_
-from flask import abort
+from flask_sqlalchemy.session import Session as FlaskSession
+from markupsafe import Markup, escape
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict, namedtuple
+from datetime import datetime, timedelta
+from functools import wraps
+from jinja2 import FileSystemBytecodeCache, nodes
+from jinja2.ext import Extension
+from sqlalchemy import and_, bindparam, case, distinct, event, func, inspect as sa_inspect, literal, or_, text, type_coerce
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, joinedload, selectinload
+from sqlalchemy.schema import CreateTable
+from sqlalchemy.sql import Select
+from flask import abort, current_app, before_render_template, template_rendered
+from flask.cli import AppGroup
+from itsdangerous import BadSignature, URLSafeSerializer
+
+# ---------------- CONFIG ---------------- #
+# Settings are read when create_app() builds an app, so the module can be
+# imported (e.g. by a pre-fork server) without touching the database.
+#
+# DATABASE_URL picks the primary database (SQLite file by default, or a
+# pooled PostgreSQL URI). DATABASE_REPLICA_URL adds a 'replica' bind that
+# routes marked read-only views read from; locally two SQLite files can
+# stand in for primary and replica.
+
+def default_config():
+    return {
+        'SECRET_KEY': 'boosss_secret_key',
+        'LIST_PAGE_SIZE': 50,
+        'LIST_MAX_PAGE_SIZE': 200,
+        'LIST_COUNT_TTL': 60,  # seconds a listing total is reused
+        'LIST_COUNT_CACHE_SIZE': 500,  # listing totals kept, one per search string
+        'DASHBOARD_CACHE_TTL': 30,
+        'DASHBOARD_CACHE_SIZE': 1000,  # doctor and patient dashboards kept
+        'HISTORY_CACHE_TTL': 300,  # bounds staleness from writes made by other processes
+        'HISTORY_CACHE_SIZE': 500,
+        'AGENDA_FEED_PAST_DAYS': 30,
+        'AGENDA_FEED_DAYS': 90,
+        'ARCHIVE_AFTER_DAYS': int(os.environ.get('ARCHIVE_AFTER_DAYS', 365)),
+        'DELETE_CHUNK_SIZE': 500,  # appointments removed per transaction
+        'DELETE_CHUNK_PAUSE': 0.02,  # seconds between chunks, so other writers get the lock
+        'DELETE_INLINE_LIMIT': 1000,  # larger histories are deleted on a background thread
+        'FRAGMENT_CACHE_TTL': 300,  # upper bound; a new data version replaces a fragment sooner
+        'FRAGMENT_CACHE_SIZE': 1000,
+        'JINJA_BYTECODE_CACHE_DIR': os.environ.get('JINJA_BYTECODE_CACHE_DIR'),  # default: instance/jinja-cache
+        'SLOT_MINUTES': 30,
+        'ADMISSION_ENABLED': os.environ.get('ADMISSION_ENABLED', '1') == '1',
+        'ADMISSION_BACKEND': os.environ.get('ADMISSION_BACKEND', 'memory'),  # or sqlite:<path>, shared by workers
+        'ADMISSION_BUDGET_MS': float(os.environ.get('ADMISSION_BUDGET_MS', 500)),  # longest wait for a slot
+        'ADMISSION_RULES': {
+            # rates are (tokens per second, burst)
+            'book_appointment': {'methods': ('POST',), 'concurrency': 4, 'queue': 32,
+                                 'user_rate': (0.2, 5), 'doctor_rate': (3.0, 10)},
+        },
+        'SLOT_MAX_DAYS': 62,
+        'EARLIEST_SLOT_MAX_DAYS': 90,
+        'SQLALCHEMY_DATABASE_URI': os.environ.get('DATABASE_URL', 'sqlite:///hospital.db'),
+        'DATABASE_REPLICA_URL': os.environ.get('DATABASE_REPLICA_URL'),
+        'DB_POOL_SIZE': int(os.environ.get('DB_POOL_SIZE', 10)),
+        'DB_MAX_OVERFLOW': int(os.environ.get('DB_MAX_OVERFLOW', 20)),
+        'DB_POOL_TIMEOUT': int(os.environ.get('DB_POOL_TIMEOUT', 30)),
+        'DB_POOL_RECYCLE': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+        'SQLITE_PRAGMAS': {
+            'journal_mode': os.environ.get('SQLITE_JOURNAL_MODE', 'WAL'),
+            'synchronous': os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL'),
+            'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000)),
+            'mmap_size': int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),
+            'cache_size': int(os.environ.get('SQLITE_CACHE_SIZE', -64000)),  # negative: KiB
+        },
+        'REPLICA_STICKY_SECONDS': 5,  # a writer reads from the primary for this long
+        'METRICS_ENABLED': os.environ.get('METRICS_ENABLED', '1') == '1',
+        'METRICS_TOKEN': os.environ.get('METRICS_TOKEN'),  # lets a scraper read /admin/metrics
+        'METRICS_TOP_STATEMENTS': 5,
+        'SLOW_QUERY_MS': float(os.environ.get('SLOW_QUERY_MS', 200)),
+        'SLOW_REQUEST_MS': float(os.environ.get('SLOW_REQUEST_MS', 1000)),
+    }
+
+
+def engine_options(config, uri):
+    """Pool settings for server databases; SQLite is tuned by pragmas on connect."""
+    if uri.startswith('sqlite'):
+        return {}
+    return {
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_timeout': config['DB_POOL_TIMEOUT'],
+        'pool_recycle': config['DB_POOL_RECYCLE'],
+        'pool_pre_ping': True,
+    }
+
+
+def install_sqlite_pragmas(engine, pragmas, read_only=False):
+    """Run pragmas on every new connection of a SQLite engine."""
+    if engine.dialect.name != 'sqlite':
+        return
+
+    @event.listens_for(engine, 'connect')
+    def _sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        if read_only:
+            cursor.execute('PRAGMA query_only=ON')
+        cursor.close()
+
+
+class RoutingSession(FlaskSession):
+    """Sends reads to the replica inside @read_replica views; flushes always go to the primary."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and has_app_context() and g.get('read_replica') \
+                and 'replica' in self._db.engines:
+            return self._db.engines['replica']
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+# Views, request hooks and CLI commands are collected here and attached
+# to each app by create_app(), keeping their usual endpoint names.
+_routes = []
+_before_request = []
+commands = AppGroup('hospital')
+
+
+def route(rule, **options):
+    def decorator(view):
+        _routes.append((rule, view, options))
+        return view
+    return decorator
+
+
+def before_request(hook):
+    _before_request.append(hook)
+    return hook
+
+
+def read_replica(view):
+    """Serve a read-only view from the replica bind when one is configured.
+
+    Clients that committed a write in the last REPLICA_STICKY_SECONDS stay
+    on the primary so they see their own changes.
+    """
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        g.read_replica = session.get('primary_until', 0) < time.time()
+        try:
+            return view(*args, **kwargs)
+        finally:
+            g.read_replica = False
+    return wrapped
+
+
+@event.listens_for(Session, 'after_flush')
+def _note_write(db_session, flush_context):
+    db_session.info['wrote'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _stick_to_primary(db_session):
+    if db_session.info.pop('wrote', False) and has_request_context():
+        session['primary_until'] = time.time() + current_app.config['REPLICA_STICKY_SECONDS']
 
-app = Flask(__name__)
-app.secret_key = 'boosss_secret_key'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///hospital.db'
-db = SQLAlchemy()
-db.init_app(app)
-app.app_context().push()
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _forget_write(db_session, previous_transaction):
+    db_session.info.pop('wrote', None)
+
+
+@commands.command('db-config')
+def db_config_command():
+    """Show the engines in use and, for SQLite, the pragmas they run with."""
+    for key, engine in db.engines.items():
+        print(f"{key or 'primary'}: {engine.url!r} ({engine.pool.__class__.__name__})")
+        if engine.dialect.name == 'sqlite':
+            with engine.connect() as connection:
+                for name in list(current_app.config['SQLITE_PRAGMAS']) + ['query_only']:
+                    print(f"  {name} = {connection.exec_driver_sql(f'PRAGMA {name}').scalar()}")
 
 # models
 
@@ -61,18 +244,34 @@ class Patient(db.Model):
         return f'<Patient {self.user.username}>'
 
 
+# On SQLite, dates and times are stored as 'YYYY-MM-DD' and 'HH:MM' text,
+# the same format the booking form has always written.
+AppointmentDate = db.Date().with_variant(
+    sqlite.DATE(storage_format='%(year)04d-%(month)02d-%(day)02d', regexp=r'(\d+)-(\d+)-(\d+)'),
+    'sqlite')
+AppointmentTime = db.Time().with_variant(
+    sqlite.TIME(storage_format='%(hour)02d:%(minute)02d', regexp=r'(\d+):(\d+)(?::(\d+))?'),
+    'sqlite')
+
+
 class Appointment(db.Model):
     __tablename__ = 'appointment'
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False)
     doctor_id = db.Column(db.Integer, db.ForeignKey('doctor.id'), nullable=False)
-    date = db.Column(db.String(20), nullable=False)  
-    time = db.Column(db.String(20), nullable=False)  
+    date = db.Column(AppointmentDate, nullable=False)
+    time = db.Column(AppointmentTime, nullable=False)
     status = db.Column(db.String(20), default='Booked', nullable=False)  
     patient = db.relationship('Patient', backref='appointments')
     doctor = db.relationship('Doctor', backref='appointments')
 
-    __table_args__ = (db.UniqueConstraint('doctor_id', 'date', 'time', name='_doctor_appointment_uc'),)
+    # The unique constraint's index also serves (doctor_id, date) range scans.
+    __table_args__ = (
+        db.UniqueConstraint('doctor_id', 'date', 'time', name='_doctor_appointment_uc'),
+        db.Index('ix_appointment_doctor_status', 'doctor_id', 'status'),
+        db.Index('ix_appointment_patient_status', 'patient_id', 'status'),
+        {'sqlite_autoincrement': True},  # archived ids are never handed out again
+    )
 
     def __repr__(self):
         return f'<Appointment {self.patient.user.username} with {self.doctor.user.username} on {self.date} {self.time}>'
@@ -88,52 +287,2751 @@ class Treatment(db.Model):
 
     appointment = db.relationship('Appointment', backref='treatment')
 
+    __table_args__ = {'sqlite_autoincrement': True}  # archived ids are never handed out again
+
     def __repr__(self):
         return f'<Treatment for Appointment ID {self.appointment_id}>'
 
 
-def create_auto_admin():
-    admin = User.query.filter_by(role='admin').first()
-    if not admin:
-        admin = User(username='Admin', password='@dmin123', role='admin')
-        db.session.add(admin)
-        db.session.commit()
-        print("Admin user created")
-    else:
-        print("Admin already exists")
-
-def create_departments():
-    departments = [
-        {'name': 'Cardiology', 'description': 'Heart and cardiovascular system'},
-        {'name': 'Neurology', 'description': 'Brain and nervous system'},
-        {'name': 'Orthopedics', 'description': 'Bones, muscles, and joints'},
-        {'name': 'Pediatrics', 'description': 'Child healthcare'},
-        {'name': 'General Medicine', 'description': 'General health and wellness'},
-        {'name': 'Surgery', 'description': 'Surgical procedures'},
-        {'name': 'Gynecology', 'description': 'Women health care'},
+class AppointmentArchive(db.Model):
+    """Closed appointments moved out of `appointment` by archive-appointments (ids kept)."""
+    __tablename__ = 'appointment_archive'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False)
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctor.id'), nullable=False)
+    date = db.Column(AppointmentDate, nullable=False)
+    time = db.Column(AppointmentTime, nullable=False)
+    status = db.Column(db.String(20), nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_appointment_archive_patient_date', 'patient_id', 'date'),
+        db.Index('ix_appointment_archive_doctor_date', 'doctor_id', 'date'),
+    )
+
+    def __repr__(self):
+        return f'<AppointmentArchive {self.id} {self.date} {self.status}>'
+
+
+class TreatmentArchive(db.Model):
+    __tablename__ = 'treatment_archive'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    appointment_id = db.Column(db.Integer, db.ForeignKey('appointment_archive.id'), nullable=False, index=True)
+    diagnosis = db.Column(db.String(255))
+    prescription = db.Column(db.String(255))
+    notes = db.Column(db.String(255))
+
+    def __repr__(self):
+        return f'<TreatmentArchive for Appointment ID {self.appointment_id}>'
+
+
+class DoctorSchedule(db.Model):
+    __tablename__ = 'doctor_schedule'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctor.id', ondelete='CASCADE'), nullable=False, index=True)
+    weekday = db.Column(db.Integer, nullable=False)  # 0 = Monday
+    start_time = db.Column(db.Time, nullable=False)
+    end_time = db.Column(db.Time, nullable=False)
+
+    doctor = db.relationship('Doctor', backref=db.backref('schedule', cascade='all, delete-orphan'))
+
+    def __repr__(self):
+        return f'<DoctorSchedule doctor={self.doctor_id} day={self.weekday} {self.start_time}-{self.end_time}>'
+
+
+class ScheduleException(db.Model):
+    __tablename__ = 'schedule_exception'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctor.id', ondelete='CASCADE'), nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    start_time = db.Column(db.Time, nullable=True)  # no times = the whole day
+    end_time = db.Column(db.Time, nullable=True)
+    available = db.Column(db.Boolean, nullable=False, default=False)  # extra hours vs. time off
+
+    doctor = db.relationship('Doctor', backref=db.backref('schedule_exceptions', cascade='all, delete-orphan'))
+
+    __table_args__ = (db.Index('ix_schedule_exception_doctor_date', 'doctor_id', 'date'),)
+
+    def __repr__(self):
+        return f'<ScheduleException doctor={self.doctor_id} {self.date} available={self.available}>'
+
+
+class UserName(db.Model):
+    __tablename__ = 'user_name'
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), primary_key=True)
+    name_key = db.Column(db.String(100), nullable=False, index=True)  # normalize_name(username)
+
+
+class UserNameTrigram(db.Model):
+    __tablename__ = 'user_name_trigram'
+    gram = db.Column(db.String(3), primary_key=True)
+    user_id = db.Column(db.Integer, primary_key=True)
+
+
+class StatCounter(db.Model):
+    __tablename__ = 'stat_counter'
+    name = db.Column(db.String(64), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<StatCounter {self.name}={self.value}>'
+
+
+class CacheVersion(db.Model):
+    __tablename__ = 'cache_version'
+    name = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<CacheVersion {self.name}={self.version}>'
+
+
+# ---------------- SEED ---------------- #
+# Seeding is idempotent: rows are inserted with ON CONFLICT DO NOTHING in
+# one statement per table, so rerunning it (or running it from several
+# workers at once) is cheap and safe.
+
+DEFAULT_DEPARTMENTS = [
+    {'name': 'Cardiology', 'description': 'Heart and cardiovascular system'},
+    {'name': 'Neurology', 'description': 'Brain and nervous system'},
+    {'name': 'Orthopedics', 'description': 'Bones, muscles, and joints'},
+    {'name': 'Pediatrics', 'description': 'Child healthcare'},
+    {'name': 'General Medicine', 'description': 'General health and wellness'},
+    {'name': 'Surgery', 'description': 'Surgical procedures'},
+    {'name': 'Gynecology', 'description': 'Women health care'},
+]
+
+
+def insert_missing(connection, table, rows, key):
+    """Insert the rows whose unique key is not taken yet; returns the inserted [(id, key)]."""
+    if not rows:
+        return []
+    dialect = connection.dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        insert = sqlite.insert if dialect == 'sqlite' else postgresql.insert
+        statement = insert(table).values(rows).on_conflict_do_nothing(index_elements=[key])
+        return connection.execute(statement.returning(table.c.id, table.c[key])).all()
+
+    taken = set(connection.execute(
+        db.select(table.c[key]).where(table.c[key].in_([row[key] for row in rows]))).scalars())
+    missing = [row for row in rows if row[key] not in taken]
+    inserted = []
+    for row in missing:
+        result = connection.execute(table.insert().values(row))
+        inserted.append((result.inserted_primary_key[0], row[key]))
+    return inserted
+
+
+def create_auto_admin(connection):
+    if connection.execute(db.select(User.id).where(User.role == 'admin').limit(1)).first():
+        return False
+    inserted = insert_missing(connection, User.__table__,
+                              [{'username': 'Admin', 'password': '@dmin123', 'role': 'admin'}], 'username')
+    _write_name_index(connection, inserted)
+    return bool(inserted)
+
+
+def create_departments(connection):
+    inserted = insert_missing(connection, Department.__table__, DEFAULT_DEPARTMENTS, 'name')
+    if inserted:
+        bump_cache_version(connection, 'directory')
+    return len(inserted)
+
+
+def seed_database():
+    """Create tables and search indexes, then the admin user and departments."""
+    db.create_all()
+    ensure_autoincrement_ids()
+    connection = db.session.connection()
+    if treatment_fts_available(connection):
+        ensure_treatment_fts(connection)
+    db.session.commit()
+    ensure_name_index()  # before the admin insert adds its own index rows
+
+    connection = db.session.connection()
+    admin_created = create_auto_admin(connection)
+    departments_created = create_departments(connection)
+    db.session.commit()
+    return admin_created, departments_created
+
+
+@commands.command('seed')
+def seed_command():
+    """Create the schema and the default admin and departments (safe to rerun)."""
+    admin_created, departments_created = seed_database()
+    print("Admin user created" if admin_created else "Admin already exists")
+    print(f"{departments_created} department(s) created")
+
+# ---------------- LIST QUERIES ---------------- #
+# Every list route builds its query here so the relationships its template
+# walks are loaded up front instead of one lazy SELECT per row. The large
+# admin tables select bare columns instead, skipping the identity map.
+
+def doctor_list_query():
+    return Doctor.query.options(
+        joinedload(Doctor.user),
+        joinedload(Doctor.department),
+    )
+
+
+def patient_list_query():
+    return Patient.query.options(joinedload(Patient.user))
+
+
+def appointment_list_query(with_treatment=False):
+    query = Appointment.query.options(
+        joinedload(Appointment.patient).joinedload(Patient.user),
+        joinedload(Appointment.doctor).joinedload(Doctor.user),
+        joinedload(Appointment.doctor).joinedload(Doctor.department),
+    )
+    if with_treatment:
+        query = query.options(selectinload(Appointment.treatment))
+    return query
+
+
+def appointment_row_select():
+    """The columns view_appointments.html shows, as plain rows rather than entities."""
+    patient_user = db.aliased(User)
+    doctor_user = db.aliased(User)
+    return db.select(
+        Appointment.id, Appointment.date, Appointment.time, Appointment.status,
+        patient_user.username.label('patient'),
+        doctor_user.username.label('doctor'),
+        Department.name.label('department'),
+    ).select_from(Appointment)\
+        .join(Patient, Appointment.patient_id == Patient.id)\
+        .join(patient_user, Patient.user_id == patient_user.id)\
+        .join(Doctor, Appointment.doctor_id == Doctor.id)\
+        .join(doctor_user, Doctor.user_id == doctor_user.id)\
+        .join(Department, Doctor.department_id == Department.id)
+
+
+def treatment_row_select(archived=False):
+    """The columns admin_treatments.html shows, as plain rows rather than entities."""
+    treatment, appointment = (TreatmentArchive, AppointmentArchive) if archived else (Treatment, Appointment)
+    patient_user = db.aliased(User)
+    doctor_user = db.aliased(User)
+    return db.select(
+        treatment.id,
+        patient_user.username.label('patient'),
+        doctor_user.username.label('doctor'),
+        appointment.date,
+        treatment.diagnosis, treatment.prescription, treatment.notes,
+    ).select_from(treatment)\
+        .join(appointment, treatment.appointment_id == appointment.id)\
+        .join(Patient, appointment.patient_id == Patient.id)\
+        .join(patient_user, Patient.user_id == patient_user.id)\
+        .join(Doctor, appointment.doctor_id == Doctor.id)\
+        .join(doctor_user, Doctor.user_id == doctor_user.id)
+
+# ---------------- STATS COUNTERS ---------------- #
+# Dashboard totals live in stat_counter and are adjusted in the same
+# transaction as the rows they count, so the admin dashboard reads one
+# small table instead of counting doctor/patient/appointment each time.
+#
+# Counter names: 'doctors', 'patients', 'appointments',
+# 'appointments:<status>' and 'department:<id>:doctors'.
+
+APPOINTMENT_STATUSES = ('Booked', 'Completed', 'Cancelled')
+
+
+def _old_value(obj, attr):
+    history = sa_inspect(obj).attrs[attr].history
+    if history.deleted:
+        return history.deleted[0]
+    return getattr(obj, attr)
+
+
+def _counter_deltas(session):
+    deltas = Counter()
+
+    for obj in session.new:
+        if isinstance(obj, Doctor):
+            deltas['doctors'] += 1
+            deltas[f'department:{obj.department_id}:doctors'] += 1
+        elif isinstance(obj, Patient):
+            deltas['patients'] += 1
+        elif isinstance(obj, Appointment):
+            deltas['appointments'] += 1
+            deltas[f'appointments:{obj.status or "Booked"}'] += 1
+
+    for obj in session.deleted:
+        if isinstance(obj, Doctor):
+            deltas['doctors'] -= 1
+            deltas[f'department:{_old_value(obj, "department_id")}:doctors'] -= 1
+        elif isinstance(obj, Patient):
+            deltas['patients'] -= 1
+        elif isinstance(obj, Appointment):
+            deltas['appointments'] -= 1
+            deltas[f'appointments:{_old_value(obj, "status")}'] -= 1
+
+    for obj in session.dirty:
+        if isinstance(obj, Appointment):
+            attr, key = 'status', 'appointments:{}'
+        elif isinstance(obj, Doctor):
+            attr, key = 'department_id', 'department:{}:doctors'
+        else:
+            continue
+        history = sa_inspect(obj).attrs[attr].history
+        for old in history.deleted:
+            deltas[key.format(old)] -= 1
+        for new in history.added:
+            deltas[key.format(new)] += 1
+
+    return deltas
+
+
+def _counter_query(name):
+    """SELECT that computes a single counter from the base tables."""
+    if name == 'doctors':
+        return db.select(func.count(Doctor.id))
+    if name == 'patients':
+        return db.select(func.count(Patient.id))
+    if name == 'appointments' or name.startswith('appointments:'):
+        # Live and archived, like compute_counters.
+        counts = []
+        for model in (Appointment, AppointmentArchive):
+            count = db.select(func.count(model.id))
+            if name != 'appointments':
+                count = count.where(model.status == name.split(':', 1)[1])
+            counts.append(count.scalar_subquery())
+        return db.select(counts[0] + counts[1])
+    if name.startswith('department:'):
+        department_id = name.split(':')[1]
+        return db.select(func.count(Doctor.id)).where(Doctor.department_id == department_id)
+    raise ValueError(f'Unknown counter {name!r}')
+
+
+def adjust_counters(connection, deltas):
+    table = StatCounter.__table__
+    for name, delta in deltas.items():
+        if not delta:
+            continue
+        result = connection.execute(
+            table.update().where(table.c.name == name).values(value=table.c.value + delta)
+        )
+        if result.rowcount == 0:
+            # Counter not seeded yet: the flush is already visible on this
+            # connection, so counting now gives the post-change value.
+            value = connection.execute(_counter_query(name)).scalar()
+            connection.execute(table.insert().values(name=name, value=value))
+
+
+@event.listens_for(Session, 'after_flush')
+def _update_counters(session, flush_context):
+    deltas = _counter_deltas(session)
+    if deltas:
+        adjust_counters(session.connection(), deltas)
+
+
+def compute_counters():
+    counters = {
+        'doctors': Doctor.query.count(),
+        'patients': Patient.query.count(),
+        'appointments': 0,
+    }
+    for status in APPOINTMENT_STATUSES:
+        counters[f'appointments:{status}'] = 0
+    for model in (Appointment, AppointmentArchive):  # totals include archived history
+        for status, count in db.session.query(model.status, func.count(model.id)).group_by(model.status):
+            counters['appointments'] += count
+            counters[f'appointments:{status}'] = counters.get(f'appointments:{status}', 0) + count
+
+    for (department_id,) in db.session.query(Department.id):
+        counters[f'department:{department_id}:doctors'] = 0
+    for department_id, count in db.session.query(Doctor.department_id, func.count(Doctor.id))\
+            .group_by(Doctor.department_id):
+        counters[f'department:{department_id}:doctors'] = count
+    return counters
+
+
+def rebuild_counters():
+    """Recompute every counter from scratch and return {name: (stored, actual)} for drifted ones."""
+    actual = compute_counters()
+    stored = dict(db.session.query(StatCounter.name, StatCounter.value).all())
+
+    drift = {}
+    for name in set(actual) | set(stored):
+        if stored.get(name, 0) != actual.get(name, 0):
+            drift[name] = (stored.get(name), actual.get(name, 0))
+
+    StatCounter.query.delete()
+    db.session.add_all(StatCounter(name=name, value=value) for name, value in actual.items())
+    db.session.commit()
+    return drift
+
+
+def read_counters():
+    """All counters, rebuilt in full first if any of them is missing.
+
+    adjust_counters seeds only the names a write touches, so a partly
+    seeded table must not be trusted for the rest.
+    """
+    counters = dict(db.session.query(StatCounter.name, StatCounter.value).all())
+    expected = {'doctors', 'patients', 'appointments'} | {f'appointments:{s}' for s in APPOINTMENT_STATUSES}
+    expected.update(f'department:{department_id}:doctors' for (department_id,) in db.session.query(Department.id))
+    if not expected <= counters.keys():
+        rebuild_counters()
+        counters = dict(db.session.query(StatCounter.name, StatCounter.value).all())
+    return counters
+
+
+@commands.command('reconcile-stats')
+def reconcile_stats_command():
+    """Rebuild the dashboard counters and report any drift."""
+    drift = rebuild_counters()
+    if not drift:
+        print("Counters are in sync")
+        return
+    for name in sorted(drift):
+        stored, actual = drift[name]
+        print(f"{name}: stored={stored} actual={actual}")
+    print(f"Fixed {len(drift)} drifted counter(s)")
+
+# ---------------- DASHBOARD CACHE ---------------- #
+# Doctor and patient dashboards are cached per principal for a few seconds.
+# Writes to a principal's appointments or treatments drop their entry once
+# the transaction commits.
+#
+# This and the other per-process caches (history, fragments, list counts)
+# are ExpiringLRUs: entries expire after a TTL and the least recently used
+# go once the cache holds more than its configured size.
+
+
+class ExpiringLRU:
+    """A thread-safe LRU of values with a TTL, sized and timed by two config keys."""
+
+    def __init__(self, size_setting, ttl_setting):
+        self._size_setting = size_setting
+        self._ttl_setting = ttl_setting
+        self._entries = OrderedDict()  # key -> (value, expires)
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, key, compute):
+        now = time.monotonic()
+        with self._lock:
+            hit = self._entries.get(key)
+            if hit and hit[1] > now:
+                self._entries.move_to_end(key)
+                return hit[0]
+        value = compute()
+        with self._lock:
+            self._entries[key] = (value, now + current_app.config[self._ttl_setting])
+            self._entries.move_to_end(key)
+            while len(self._entries) > current_app.config[self._size_setting]:
+                self._entries.popitem(last=False)
+        return value
+
+    def pop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_dashboard_cache = ExpiringLRU('DASHBOARD_CACHE_SIZE', 'DASHBOARD_CACHE_TTL')
+
+
+def cached_dashboard(principal, compute):
+    return _dashboard_cache.get_or_compute(principal, compute)
+
+
+def invalidate_dashboards(session, principals):
+    session.info.setdefault('dashboard_keys', set()).update(principals)
+
+
+def appointment_summary(owner, owner_id):
+    """Status counts and treatments on completed visits, live and archived, in one query.
+
+    owner is 'doctor_id' or 'patient_id'.
+    """
+    # Counting distinct appointment ids keeps the status totals right even
+    # if an appointment ever carries more than one treatment row.
+    def summary_select(appointment, treatment):
+        def status_count(status):
+            return func.count(distinct(case((appointment.status == status, appointment.id))))
+
+        return db.select(
+            func.count(distinct(appointment.id)),
+            status_count('Booked'),
+            status_count('Completed'),
+            status_count('Cancelled'),
+            func.count(treatment.id),
+        ).select_from(appointment).outerjoin(
+            treatment, and_(treatment.appointment_id == appointment.id, appointment.status == 'Completed')
+        ).where(getattr(appointment, owner) == owner_id)
+
+    rows = db.session.execute(db.union_all(summary_select(Appointment, Treatment),
+                                           summary_select(AppointmentArchive, TreatmentArchive))).all()
+    total, booked, completed, cancelled, treatments = (sum(column) for column in zip(*rows))
+    return {
+        'total': total,
+        'booked': booked,
+        'completed': completed,
+        'cancelled': cancelled,
+        'treatments': treatments,
+    }
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_dashboard_keys(session, flush_context):
+    principals = set()
+    appointment_ids = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Appointment):
+            for attr in ('doctor_id', 'patient_id'):
+                principals.add((attr[:-3], _old_value(obj, attr)))
+                principals.add((attr[:-3], getattr(obj, attr)))
+        elif isinstance(obj, Treatment):
+            appointment_ids.add(obj.appointment_id)
+
+    if appointment_ids:
+        rows = session.connection().execute(
+            db.select(Appointment.doctor_id, Appointment.patient_id)
+            .where(Appointment.id.in_(appointment_ids))
+        )
+        for doctor_id, patient_id in rows:
+            principals.add(('doctor', doctor_id))
+            principals.add(('patient', patient_id))
+
+    if principals:
+        invalidate_dashboards(session, principals)
+
+
+@event.listens_for(Session, 'after_commit')
+def _drop_dashboard_cache(session):
+    for doctor_or_patient, owner_id in session.info.pop('dashboard_keys', ()):
+        _dashboard_cache.pop((doctor_or_patient, int(owner_id)))
+        if doctor_or_patient == 'patient':
+            _history_cache.pop(int(owner_id))
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_dashboard_keys(session, previous_transaction):
+    session.info.pop('dashboard_keys', None)
+
+# ---------------- PATIENT HISTORY ---------------- #
+# A patient's timeline (appointments with doctor, department and any
+# treatment, live and archived) comes from one query and is cached per
+# patient. The
+# dashboard hooks above drop the entry when a commit touches that
+# patient's appointments or treatments; filters and pages are cut from
+# the cached tuple.
+
+HistoryEntry = namedtuple('HistoryEntry', 'appointment_id date time status doctor department '
+                                          'treatment_id diagnosis prescription notes')
+
+_history_cache = ExpiringLRU('HISTORY_CACHE_SIZE', 'HISTORY_CACHE_TTL')
+
+
+def load_patient_history(patient_id):
+    def history_select(appointment, treatment):
+        return db.select(
+            appointment.id, appointment.date, appointment.time, appointment.status,
+            User.username, Department.name,
+            treatment.id, treatment.diagnosis, treatment.prescription, treatment.notes,
+        ).select_from(appointment)\
+            .join(Doctor, appointment.doctor_id == Doctor.id)\
+            .join(User, Doctor.user_id == User.id)\
+            .join(Department, Doctor.department_id == Department.id)\
+            .outerjoin(treatment, treatment.appointment_id == appointment.id)\
+            .where(appointment.patient_id == patient_id)
+
+    rows = db.session.execute(db.union_all(history_select(Appointment, Treatment),
+                                           history_select(AppointmentArchive, TreatmentArchive)))
+    entries = sorted((HistoryEntry(*row) for row in rows),
+                     key=lambda entry: (entry.date, entry.time, entry.appointment_id), reverse=True)
+    return tuple(entries)
+
+
+def patient_history(patient_id):
+    """The patient's whole timeline, newest first, as HistoryEntry tuples."""
+    return _history_cache.get_or_compute(patient_id, lambda: load_patient_history(patient_id))
+
+
+def filter_history(entries, date_from=None, date_to=None, status=None, treated=False):
+    return [
+        entry for entry in entries
+        if (date_from is None or entry.date >= date_from)
+        and (date_to is None or entry.date <= date_to)
+        and (status is None or entry.status == status)
+        and (not treated or entry.treatment_id is not None)
     ]
-    
-    for dept_data in departments:
-        existing = Department.query.filter_by(name=dept_data['name']).first()
-        if not existing:
-            dept = Department(name=dept_data['name'], description=dept_data['description'])
-            db.session.add(dept)
-    
+
+
+def history_page(entries):
+    """Cut one page out of filtered entries, with cursors shaped like keyset_page()'s."""
+    after, before, per_page = page_args()
+    positions = {entry.appointment_id: n for n, entry in enumerate(entries)}
+    if before in positions:
+        end = positions[before]
+        start = max(0, end - per_page)
+    else:
+        start = positions[after] + 1 if after in positions else 0
+        end = start + per_page
+    rows = entries[start:end]
+    return rows, {
+        'per_page': per_page,
+        'total': len(entries),
+        'next_cursor': rows[-1].appointment_id if rows and end < len(entries) else None,
+        'prev_cursor': rows[0].appointment_id if rows and start > 0 else None,
+    }
+
+# ---------------- FRAGMENT CACHE ---------------- #
+# {% cache key, ... %}...{% endcache %} keeps the rendered HTML of a block
+# per template, line and key. Dashboards key their stat cards by principal
+# and a digest of the numbers shown, so the writes that move a counter or
+# drop a cached summary also retire the fragment built from it.
+
+_fragment_cache = ExpiringLRU('FRAGMENT_CACHE_SIZE', 'FRAGMENT_CACHE_TTL')
+
+
+def fragment_version(*values):
+    return hashlib.blake2b(repr(values).encode(), digest_size=8).hexdigest()
+
+
+def cached_fragment(key, render):
+    return _fragment_cache.get_or_compute(key, render)
+
+
+class FragmentCacheExtension(Extension):
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        key = [nodes.Const(f'{parser.name}:{lineno}'), parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            key.append(parser.parse_expression())
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+        call = self.call_method('_render', [nodes.Tuple(key, 'load')])
+        return nodes.CallBlock(call, [], [], body).set_lineno(lineno)
+
+    def _render(self, key, caller):
+        return cached_fragment(key, caller)
+
+# ---------------- DIRECTORY CACHE ---------------- #
+# Departments and the doctor directory are cached per process as tuples.
+# Writes to doctors, doctor users or departments bump the shared
+# cache_version row in the same transaction; every read checks that row
+# (one primary-key lookup), so all workers rebuild after a change.
+
+DirectoryDoctor = namedtuple('DirectoryDoctor', [
+    'id', 'user_id', 'username', 'contact', 'department_id', 'department', 'availability',
+    'name_key', 'department_key',
+])
+DirectoryDepartment = namedtuple('DirectoryDepartment', ['id', 'name', 'description'])
+
+_directory_cache = {'version': None, 'doctors': (), 'departments': ()}
+_directory_lock = threading.Lock()
+
+
+def bump_cache_version(connection, name):
+    table = CacheVersion.__table__
+    result = connection.execute(table.update().where(table.c.name == name).values(version=table.c.version + 1))
+    if result.rowcount == 0:
+        connection.execute(table.insert().values(name=name, version=1))
+
+
+@event.listens_for(Session, 'after_flush')
+def _bump_directory_version(session, flush_context):
+    changed = [obj for obj in session.dirty if session.is_modified(obj, include_collections=False)]
+    for obj in list(session.new) + changed + list(session.deleted):
+        if isinstance(obj, (Doctor, Department)) or (isinstance(obj, User) and obj.role == 'doctor'):
+            bump_cache_version(session.connection(), 'directory')
+            return
+
+
+def _load_directory():
+    doctors = tuple(
+        DirectoryDoctor(doctor_id, user_id, username, contact, department_id, department, availability,
+                        normalize_name(username), normalize_name(department))
+        for doctor_id, user_id, username, contact, department_id, department, availability in db.session.query(
+            Doctor.id, User.id, User.username, User.contact, Department.id, Department.name, Doctor.availability
+        ).join(User, Doctor.user_id == User.id).join(Department, Doctor.department_id == Department.id)
+        .order_by(Doctor.id)
+    )
+    departments = tuple(
+        DirectoryDepartment(*row) for row in
+        db.session.query(Department.id, Department.name, Department.description).order_by(Department.id)
+    )
+    return doctors, departments
+
+
+def directory():
+    """The cached (doctors, departments) tuples, rebuilt when the version moves."""
+    version = db.session.query(CacheVersion.version).filter(CacheVersion.name == 'directory').scalar() or 0
+    if _directory_cache['version'] != version:
+        with _directory_lock:
+            if _directory_cache['version'] != version:
+                doctors, departments = _load_directory()
+                _directory_cache.update(version=version, doctors=doctors, departments=departments)
+    return _directory_cache['doctors'], _directory_cache['departments']
+
+
+def search_directory(search):
+    """Doctors whose username or department contains search."""
+    doctors, _ = directory()
+    key = normalize_name(search)
+    if not key:
+        return list(doctors)
+    return [doctor for doctor in doctors if key in doctor.name_key or key in doctor.department_key]
+
+# ---------------- TREATMENT SEARCH ---------------- #
+# On SQLite, treatment text and the patient's username are mirrored into an
+# FTS5 table keyed by treatment id, covering live and archived treatments.
+# The flush hook keeps it in step with treatment and username writes;
+# other databases fall back to ILIKE.
+
+_fts_ready = False
+
+_FTS_SYNC_SQL = '''
+    INSERT INTO treatment_fts (rowid, diagnosis, prescription, notes, patient)
+    SELECT t.id, t.diagnosis, t.prescription, t.notes, user.username
+    FROM {treatment} AS t
+    JOIN {appointment} AS a ON a.id = t.appointment_id
+    JOIN patient ON patient.id = a.patient_id
+    JOIN user ON user.id = patient.user_id
+'''
+
+_FTS_SOURCES = (('treatment', 'appointment'), ('treatment_archive', 'appointment_archive'))
+
+
+def _fts_sync(connection, where='', params=None, expanding=(), archived=True):
+    """Index live (and archived) treatments matching where, a clause on alias t."""
+    for treatment, appointment in _FTS_SOURCES[:2 if archived else 1]:
+        statement = text(_FTS_SYNC_SQL.format(treatment=treatment, appointment=appointment) + where)
+        if expanding:
+            statement = statement.bindparams(*(bindparam(name, expanding=True) for name in expanding))
+        connection.execute(statement, params or {})
+
+
+def treatment_fts_available(connection):
+    return connection.dialect.name == 'sqlite'
+
+
+def ensure_treatment_fts(connection):
+    """Create and fill the FTS table if it is missing; True when it was created.
+
+    Creation is part of the caller's transaction, so the table is only
+    treated as ready once it has been seen committed.
+    """
+    global _fts_ready
+    if _fts_ready:
+        return False
+    exists = connection.execute(text(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'treatment_fts'"
+    )).first()
+    if exists:
+        _fts_ready = True
+        return False
+    connection.execute(text(
+        "CREATE VIRTUAL TABLE treatment_fts USING fts5(diagnosis, prescription, notes, patient)"
+    ))
+    _fts_sync(connection)
+    return True
+
+
+def rebuild_treatment_fts():
+    connection = db.session.connection()
+    ensure_treatment_fts(connection)
+    connection.execute(text("DELETE FROM treatment_fts"))
+    _fts_sync(connection)
+    indexed = connection.execute(text("SELECT count(*) FROM treatment_fts")).scalar()
+    db.session.commit()
+    return indexed
+
+
+@event.listens_for(Session, 'after_flush')
+def _sync_treatment_fts(session, flush_context):
+    treatment_ids = set()
+    user_ids = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Treatment):
+            treatment_ids.add(obj.id)
+        elif isinstance(obj, User) and sa_inspect(obj).attrs.username.history.has_changes():
+            user_ids.add(obj.id)
+    if not treatment_ids and not user_ids:
+        return
+
+    connection = session.connection()
+    if not treatment_fts_available(connection):
+        return
+    ensure_treatment_fts(connection)
+
+    if user_ids:
+        for treatment, appointment in _FTS_SOURCES:
+            rows = connection.execute(
+                text(f'''SELECT t.id FROM {treatment} AS t
+                         JOIN {appointment} AS a ON a.id = t.appointment_id
+                         JOIN patient ON patient.id = a.patient_id
+                         WHERE patient.user_id IN :user_ids''')
+                .bindparams(bindparam('user_ids', expanding=True)),
+                {'user_ids': list(user_ids)},
+            )
+            treatment_ids.update(treatment_id for (treatment_id,) in rows)
+    if not treatment_ids:
+        return
+
+    params = {'ids': list(treatment_ids)}
+    connection.execute(
+        text("DELETE FROM treatment_fts WHERE rowid IN :ids")
+        .bindparams(bindparam('ids', expanding=True)), params)
+    _fts_sync(connection, " WHERE t.id IN :ids", params, expanding=('ids',))
+
+
+def fts_match_query(search):
+    """Turn free text into an FTS5 query: every word as a quoted prefix term."""
+    return ' '.join('"{}"*'.format(word.replace('"', '""')) for word in search.split())
+
+
+def _snippet_markup(raw):
+    # snippet() wraps hits in \x02/\x03 so the text can be escaped before
+    # the markers become <mark> tags.
+    return Markup(str(escape(raw)).replace('\x02', '<mark>').replace('\x03', '</mark>'))
+
+
+def search_treatments(search, after, per_page):
+    """Ranked FTS page: returns ([(id, snippet)], next_cursor, total).
+
+    The cursor is "<bm25 score>:<id>", so later pages seek past the last
+    row shown instead of re-ranking and skipping earlier pages.
+    """
+    connection = db.session.connection()
+    if ensure_treatment_fts(connection):
+        db.session.commit()
+        connection = db.session.connection()
+    params = {'match': fts_match_query(search), 'limit': per_page + 1}
+
+    seek = ''
+    if after:
+        try:
+            score, last_id = after.split(':')
+            params['score'], params['last_id'] = float(score), int(last_id)
+            seek = ('AND (bm25(treatment_fts) > :score '
+                    'OR (bm25(treatment_fts) = :score AND rowid > :last_id))')
+        except ValueError:
+            pass
+
+    rows = connection.execute(text(f'''
+        SELECT rowid, bm25(treatment_fts) AS score,
+               snippet(treatment_fts, -1, char(2), char(3), '…', 12)
+        FROM treatment_fts
+        WHERE treatment_fts MATCH :match {seek}
+        ORDER BY score, rowid
+        LIMIT :limit
+    '''), params).all()
+
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        next_cursor = f'{rows[-1][1]!r}:{rows[-1][0]}'
+
+    total = cached_count(('treatments', search), lambda: connection.execute(
+        text("SELECT count(*) FROM treatment_fts WHERE treatment_fts MATCH :match"),
+        {'match': params['match']},
+    ).scalar())
+    return [(row[0], _snippet_markup(row[2])) for row in rows], next_cursor, total
+
+
+@commands.command('rebuild-treatment-search')
+def rebuild_treatment_search_command():
+    """Rebuild the treatment full-text index from the treatment table."""
+    if not treatment_fts_available(db.session.connection()):
+        print("Full-text treatment search needs SQLite FTS5; nothing to rebuild")
+        return
+    print(f"Indexed {rebuild_treatment_fts()} treatment record(s)")
+
+# ---------------- NAME SEARCH ---------------- #
+# Username search goes through user_name (a normalized key with a B-tree
+# index, used for prefix matches) and user_name_trigram (every 3-character
+# slice of the key, used to narrow substring matches before the final
+# LIKE). Both are kept in step with user writes by the flush hook.
+
+_name_index_ready = False
+
+
+def normalize_name(name):
+    return ' '.join((name or '').casefold().split())
+
+
+def name_trigrams(key):
+    return {key[i:i + 3] for i in range(len(key) - 2)}
+
+
+def _name_index_rows(users):
+    names, grams = [], []
+    for user_id, username in users:
+        key = normalize_name(username)
+        names.append({'user_id': user_id, 'name_key': key})
+        grams.extend({'gram': gram, 'user_id': user_id} for gram in name_trigrams(key))
+    return names, grams
+
+
+def _write_name_index(connection, users):
+    names, grams = _name_index_rows(users)
+    if names:
+        connection.execute(UserName.__table__.insert(), names)
+    if grams:
+        connection.execute(UserNameTrigram.__table__.insert(), grams)
+
+
+def rebuild_name_index(chunk_size=5000):
+    connection = db.session.connection()
+    connection.execute(UserNameTrigram.__table__.delete())
+    connection.execute(UserName.__table__.delete())
+
+    indexed = 0
+    users = db.session.execute(
+        db.select(User.id, User.username).order_by(User.id).execution_options(yield_per=chunk_size)
+    )
+    for chunk in users.partitions():
+        _write_name_index(connection, chunk)
+        indexed += len(chunk)
+    db.session.commit()
+    return indexed
+
+
+def ensure_name_index():
+    """Build the name index the first time it is needed on an existing database."""
+    global _name_index_ready
+    if _name_index_ready:
+        return
+    if db.session.query(UserName.user_id).first() is None and db.session.query(User.id).first() is not None:
+        rebuild_name_index()
+    _name_index_ready = True
+
+
+@event.listens_for(Session, 'after_flush')
+def _sync_name_index(session, flush_context):
+    changed = {}
+    removed = set()
+    for obj in session.new:
+        if isinstance(obj, User):
+            changed[obj.id] = obj.username
+    for obj in session.dirty:
+        if isinstance(obj, User) and sa_inspect(obj).attrs.username.history.has_changes():
+            changed[obj.id] = obj.username
+    for obj in session.deleted:
+        if isinstance(obj, User):
+            removed.add(obj.id)
+    if not changed and not removed:
+        return
+
+    connection = session.connection()
+    user_ids = list(set(changed) | removed)
+    connection.execute(UserNameTrigram.__table__.delete().where(UserNameTrigram.user_id.in_(user_ids)))
+    connection.execute(UserName.__table__.delete().where(UserName.user_id.in_(user_ids)))
+    _write_name_index(connection, changed.items())
+
+
+def user_ids_matching(search):
+    """SELECT of user ids whose username contains search (case-insensitive).
+
+    Terms shorter than three characters have no trigrams, so they match
+    name prefixes through the name_key index instead.
+    """
+    ensure_name_index()
+    key = normalize_name(search)
+    if len(key) < 3:
+        return db.select(UserName.user_id).where(
+            UserName.name_key >= key, UserName.name_key < key + '\U0010ffff'
+        )
+
+    # Non-overlapping grams that still cover the whole term are enough to
+    # narrow the candidates; the LIKE below confirms the exact substring.
+    # The scan is driven by the last gram (name suffixes are usually the
+    # most selective) and the rest are probed per candidate on the
+    # (gram, user_id) primary key.
+    grams = [key[i:i + 3] for i in range(0, len(key) - 2, 3)]
+    if len(key) % 3:
+        grams.append(key[-3:])
+    candidates = db.select(UserNameTrigram.user_id).where(UserNameTrigram.gram == grams[-1])
+    for gram in grams[:-1]:
+        other = db.aliased(UserNameTrigram)
+        candidates = candidates.where(
+            db.select(other.user_id).where(other.gram == gram, other.user_id == UserNameTrigram.user_id).exists()
+        )
+    return db.select(UserName.user_id).where(
+        UserName.user_id.in_(candidates),
+        UserName.name_key.contains(key, autoescape=True),
+    )
+
+
+@commands.command('rebuild-name-index')
+def rebuild_name_index_command():
+    """Rebuild the username search index from the user table."""
+    print(f"Indexed {rebuild_name_index()} user name(s)")
+
+
+# ---------------- APPOINTMENT MIGRATION ---------------- #
+# Older databases store appointment date/time as free strings. The migrate
+# command adds the composite indexes, then rewrites rows to the canonical
+# 'YYYY-MM-DD' / 'HH:MM' form in small batches. Each batch commits on its
+# own, so SQLite's write lock is only held briefly.
+
+LEGACY_DATE_FORMATS = ('%Y-%m-%d', '%Y/%m/%d', '%d-%m-%Y', '%d/%m/%Y')
+LEGACY_TIME_FORMATS = ('%H:%M', '%H:%M:%S', '%H:%M:%S.%f', '%I:%M %p', '%I:%M%p')
+
+
+def _parse_legacy(raw, formats):
+    for fmt in formats:
+        try:
+            return datetime.strptime(raw.strip(), fmt)
+        except ValueError:
+            continue
+    return None
+
+
+def _canonical_appointment_row(appointment_id, raw_date, raw_time):
+    """Return the normalized update for a row, None if it is already clean, or raise ValueError."""
+    if not isinstance(raw_date, str) or not isinstance(raw_time, str):
+        return None  # column already has a native date/time type
+    parsed_date = _parse_legacy(raw_date, LEGACY_DATE_FORMATS)
+    parsed_time = _parse_legacy(raw_time, LEGACY_TIME_FORMATS)
+    if parsed_date is None or parsed_time is None:
+        raise ValueError(f'{raw_date!r} {raw_time!r}')
+    new_date = parsed_date.strftime('%Y-%m-%d')
+    new_time = parsed_time.strftime('%H:%M')
+    if (new_date, new_time) == (raw_date, raw_time):
+        return None
+    return {'id': appointment_id, 'date': new_date, 'time': new_time}
+
+
+def migrate_appointment_rows(batch_size=1000, pause=0.0, report=print):
+    for index in Appointment.__table__.indexes:
+        index.create(db.engine, checkfirst=True)
+
+    update = text("UPDATE appointment SET date = :date, time = :time WHERE id = :id")
+    last_id, scanned, converted = 0, 0, 0
+    problems = []
+    while True:
+        rows = db.session.execute(
+            text("SELECT id, date, time FROM appointment WHERE id > :last_id ORDER BY id LIMIT :limit"),
+            {'last_id': last_id, 'limit': batch_size},
+        ).all()
+        if not rows:
+            break
+
+        updates = []
+        for appointment_id, raw_date, raw_time in rows:
+            try:
+                change = _canonical_appointment_row(appointment_id, raw_date, raw_time)
+            except ValueError as e:
+                problems.append((appointment_id, f'unparseable {e}'))
+                continue
+            if change:
+                updates.append(change)
+
+        if updates:
+            try:
+                db.session.execute(update, updates)
+                db.session.commit()
+                converted += len(updates)
+            except IntegrityError:
+                # Two spellings of the same slot collapsed into one; apply
+                # the rest of the batch row by row and report the clashes.
+                db.session.rollback()
+                for change in updates:
+                    try:
+                        db.session.execute(update, change)
+                        db.session.commit()
+                        converted += 1
+                    except IntegrityError:
+                        db.session.rollback()
+                        problems.append((change['id'], 'duplicate slot after normalizing'))
+        else:
+            db.session.commit()
+
+        scanned += len(rows)
+        last_id = rows[-1][0]
+        report(f"Scanned {scanned} appointment(s), converted {converted}")
+        if pause:
+            time.sleep(pause)
+
+    return scanned, converted, problems
+
+
+@commands.command('migrate-appointments')
+@click.option('--batch-size', default=1000, help='Rows rewritten per transaction.')
+@click.option('--pause', default=0.05, help='Seconds to sleep between batches.')
+def migrate_appointments_command(batch_size, pause):
+    """Add appointment indexes and normalize legacy date/time strings."""
+    scanned, converted, problems = migrate_appointment_rows(batch_size, pause)
+    for appointment_id, reason in problems:
+        print(f"Appointment {appointment_id}: {reason}")
+    print(f"Done: {scanned} scanned, {converted} converted, {len(problems)} need manual review")
+
+# ---------------- ARCHIVE ---------------- #
+# Completed and Cancelled appointments older than ARCHIVE_AFTER_DAYS move,
+# with their treatments, to appointment_archive / treatment_archive under
+# the same ids, one chunk per transaction. Lists, slot lookups and the
+# agenda read only the live tables. Reads that need full history (patient
+# history, dashboards and counters, treatment search, exports) union the
+# archive. Rows are copied with INSERT ... SELECT and deleted in bulk, so
+# the ORM flush hooks do not run. Counters and the search index already
+# cover both tables, but the .ics feed reads live rows only, so each chunk
+# bumps 'agenda:<doctor_id>' for the doctors whose rows it moved.
+#
+# Because ids are shared with the archive, appointment and treatment are
+# AUTOINCREMENT tables on SQLite: plain rowid tables hand out max(id) + 1,
+# which reuses archived ids once the newest live rows are archived or
+# deleted. Older databases are rebuilt in place the first time seeding or
+# archiving runs.
+
+CLOSED_STATUSES = ('Completed', 'Cancelled')
+
+
+def ensure_autoincrement_ids():
+    """Rebuild appointment/treatment as AUTOINCREMENT tables on SQLite; returns the tables rebuilt.
+
+    The id sequence starts past the highest archived id. Runs in the
+    caller's transaction.
+    """
+    connection = db.session.connection()
+    if connection.dialect.name != 'sqlite':
+        return []
+    rebuilt = []
+    for model, archive in ((Appointment, AppointmentArchive), (Treatment, TreatmentArchive)):
+        table = model.__table__
+        sql = connection.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                                 {'name': table.name}).scalar()
+        if sql is None or 'AUTOINCREMENT' in sql.upper():
+            continue
+        ddl = str(CreateTable(table).compile(dialect=connection.dialect))
+        connection.execute(text(ddl.replace(f'CREATE TABLE {table.name} ', f'CREATE TABLE {table.name}_new ', 1)))
+        columns = ', '.join(column.name for column in table.columns)
+        connection.execute(text(f'INSERT INTO {table.name}_new ({columns}) SELECT {columns} FROM {table.name}'))
+        connection.execute(text(f'DROP TABLE {table.name}'))
+        connection.execute(text(f'ALTER TABLE {table.name}_new RENAME TO {table.name}'))
+        for index in table.indexes:
+            index.create(connection)
+
+        high = max(connection.execute(db.select(func.max(model.id))).scalar() or 0,
+                   connection.execute(db.select(func.max(archive.id))).scalar() or 0)
+        connection.execute(text('DELETE FROM sqlite_sequence WHERE name = :name'), {'name': table.name})
+        connection.execute(text('INSERT INTO sqlite_sequence (name, seq) VALUES (:name, :seq)'),
+                           {'name': table.name, 'seq': high})
+        rebuilt.append(table.name)
+    return rebuilt
+
+
+def archive_closed_appointments(cutoff, chunk_size=1000, pause=0.0, report=print):
+    """Move closed appointments dated before cutoff into the archive; returns (appointments, treatments)."""
+    ensure_autoincrement_ids()
+    db.session.commit()
+
+    appointment_columns = [column.name for column in AppointmentArchive.__table__.columns]
+    treatment_columns = [column.name for column in TreatmentArchive.__table__.columns]
+    last_id, moved_appointments, moved_treatments = 0, 0, 0
+    while True:
+        rows = db.session.execute(
+            db.select(Appointment.id, Appointment.doctor_id).where(
+                Appointment.id > last_id,
+                Appointment.status.in_(CLOSED_STATUSES),
+                Appointment.date < cutoff,
+            ).order_by(Appointment.id).limit(chunk_size)).all()
+        if not rows:
+            break
+        ids = [appointment_id for appointment_id, _ in rows]
+
+        db.session.execute(AppointmentArchive.__table__.insert().from_select(
+            appointment_columns,
+            db.select(*(Appointment.__table__.c[name] for name in appointment_columns))
+            .where(Appointment.id.in_(ids))))
+        moved = db.session.execute(TreatmentArchive.__table__.insert().from_select(
+            treatment_columns,
+            db.select(*(Treatment.__table__.c[name] for name in treatment_columns))
+            .where(Treatment.appointment_id.in_(ids)))).rowcount
+        db.session.execute(Treatment.__table__.delete().where(Treatment.appointment_id.in_(ids)))
+        db.session.execute(Appointment.__table__.delete().where(Appointment.id.in_(ids)))
+        for doctor_id in sorted({doctor_id for _, doctor_id in rows}):
+            bump_cache_version(db.session.connection(), f'agenda:{doctor_id}')
+        db.session.commit()
+
+        moved_appointments += len(ids)
+        moved_treatments += moved
+        last_id = ids[-1]
+        report(f"Archived {moved_appointments} appointment(s), {moved_treatments} treatment(s)")
+        if pause:
+            time.sleep(pause)
+    return moved_appointments, moved_treatments
+
+
+@commands.command('archive-appointments')
+@click.option('--older-than-days', type=int, default=None,
+              help='Archive closed appointments at least this old (default: ARCHIVE_AFTER_DAYS).')
+@click.option('--chunk-size', default=1000, help='Appointments moved per transaction.')
+@click.option('--pause', default=0.05, help='Seconds to sleep between chunks.')
+def archive_appointments_command(older_than_days, chunk_size, pause):
+    """Move old Completed/Cancelled appointments and their treatments to the archive tables."""
+    days = current_app.config['ARCHIVE_AFTER_DAYS'] if older_than_days is None else older_than_days
+    if days < 1:
+        raise click.BadParameter('must be at least 1', param_hint='--older-than-days')
+    db.create_all()  # adds the archive tables to older databases
+    cutoff = datetime.now().date() - timedelta(days=days)
+    appointments, treatments = archive_closed_appointments(cutoff, chunk_size, pause)
+    print(f"Done: {appointments} appointment(s) and {treatments} treatment(s) dated before {cutoff} archived")
+
+# ---------------- DELETION ---------------- #
+# Deleting a patient or doctor removes their treatments and appointments
+# (live and archived) in DELETE_CHUNK_SIZE chunks, one transaction each,
+# and then the profile and user. Counters, the search index, agenda
+# versions and cached dashboards are adjusted chunk by chunk because the
+# bulk deletes skip the flush hooks. Histories longer than
+# DELETE_INLINE_LIMIT are handled by a background thread so the admin's
+# request returns at once.
+
+_deletion_jobs = set()
+_deletion_lock = threading.Lock()
+
+
+def _history_exceeds(owner, owner_id, limit):
+    """EXISTS-style check for more than limit appointments, without counting them all."""
+    return any(
+        db.session.query(model.id).filter(getattr(model, owner) == owner_id).offset(limit).limit(1).first()
+        for model in (Appointment, AppointmentArchive))
+
+
+def _delete_appointment_chunk(appointment, treatment, owner, owner_id, chunk_size):
+    """Delete up to chunk_size of the owner's appointments and their treatments; returns how many."""
+    rows = db.session.execute(
+        db.select(appointment.id, appointment.status, appointment.doctor_id, appointment.patient_id)
+        .where(getattr(appointment, owner) == owner_id).limit(chunk_size)).all()
+    if not rows:
+        return 0
+
+    ids = [row.id for row in rows]
+    connection = db.session.connection()
+    if treatment_fts_available(connection):
+        # A table created just now was filled from these rows too, so the delete always runs.
+        ensure_treatment_fts(connection)
+        connection.execute(
+            text(f"DELETE FROM treatment_fts WHERE rowid IN "
+                 f"(SELECT id FROM {treatment.__tablename__} WHERE appointment_id IN :ids)")
+            .bindparams(bindparam('ids', expanding=True)), {'ids': ids})
+    connection.execute(treatment.__table__.delete().where(treatment.appointment_id.in_(ids)))
+    connection.execute(appointment.__table__.delete().where(appointment.id.in_(ids)))
+
+    deltas = Counter({'appointments': -len(rows)})
+    deltas.update({f'appointments:{status}': -count for status, count in Counter(row.status for row in rows).items()})
+    adjust_counters(connection, deltas)
+    for doctor_id in sorted({row.doctor_id for row in rows}):
+        bump_cache_version(connection, f'agenda:{doctor_id}')
+    invalidate_dashboards(db.session, {('doctor', row.doctor_id) for row in rows}
+                          | {('patient', row.patient_id) for row in rows})
+    return len(rows)
+
+
+def delete_profile(kind, profile_id):
+    """Delete a patient or doctor ('patient' / 'doctor') with everything that hangs off it."""
+    owner = f'{kind}_id'
+    chunk_size = current_app.config['DELETE_CHUNK_SIZE']
+    tables = ((Appointment, Treatment), (AppointmentArchive, TreatmentArchive))
+    for appointment, treatment in tables:
+        while _delete_appointment_chunk(appointment, treatment, owner, profile_id, chunk_size):
+            db.session.commit()
+            time.sleep(current_app.config['DELETE_CHUNK_PAUSE'])
+
+    # Anything booked since the last chunk goes in the same transaction as the profile.
+    for appointment, treatment in tables:
+        while _delete_appointment_chunk(appointment, treatment, owner, profile_id, chunk_size):
+            pass
+    profile = db.session.get(Patient if kind == 'patient' else Doctor, profile_id)
+    if profile is not None:
+        user = profile.user
+        db.session.delete(profile)
+        if user:
+            db.session.delete(user)
+    db.session.commit()
+
+
+def _delete_in_background(app, kind, profile_id):
+    with app.app_context():
+        try:
+            delete_profile(kind, profile_id)
+        except Exception:
+            db.session.rollback()
+            app.logger.exception('Deleting %s %s failed', kind, profile_id)
+        finally:
+            with _deletion_lock:
+                _deletion_jobs.discard((kind, profile_id))
+
+
+def schedule_deletion(kind, profile_id):
+    """Delete now, or on a background thread for long histories.
+
+    Returns 'done', 'background', or 'running' when a deletion of the
+    same profile is already under way.
+    """
+    with _deletion_lock:
+        if (kind, profile_id) in _deletion_jobs:
+            return 'running'
+        _deletion_jobs.add((kind, profile_id))
+
+    if _history_exceeds(f'{kind}_id', profile_id, current_app.config['DELETE_INLINE_LIMIT']):
+        db.session.rollback()  # end the read transaction before the worker starts writing
+        threading.Thread(target=_delete_in_background, daemon=True,
+                         args=(current_app._get_current_object(), kind, profile_id)).start()
+        return 'background'
     try:
+        delete_profile(kind, profile_id)
+    finally:
+        with _deletion_lock:
+            _deletion_jobs.discard((kind, profile_id))
+    return 'done'
+
+
+DELETION_MESSAGES = {
+    'done': '{} and associated records deleted successfully!',
+    'background': '{} has a long history; deletion continues in the background.',
+    'running': '{} is already being deleted.',
+}
+
+
+def has_booked_appointments(owner, owner_id):
+    return db.session.query(
+        Appointment.query.filter(getattr(Appointment, owner) == owner_id, Appointment.status == 'Booked').exists()
+    ).scalar()
+
+# ---------------- BULK IMPORT ---------------- #
+# `flask import-data` streams CSV or JSONL files (one object per line) and
+# inserts them with multi-row INSERTs, one transaction per chunk. Rows
+# refer to each other by natural keys: usernames, department names and
+# (doctor, date, time) for appointments. Rows that already exist are
+# skipped, invalid rows are reported and skipped, and the line reached in
+# each file is checkpointed after every commit so a rerun resumes there.
+#
+# Columns:
+#   users        username, password, role, contact
+#   doctors      username, department, availability [, password, contact]
+#   patients     username, contact_info [, password, contact]
+#   appointments doctor, patient, date, time, status
+#   treatments   doctor, date, time, diagnosis, prescription, notes
+# A doctor or patient row with a password creates its user when missing.
+# A treatment row is skipped when its appointment already has a treatment.
+
+IMPORT_KINDS = ('users', 'doctors', 'patients', 'appointments', 'treatments')
+USER_ROLES = ('admin', 'doctor', 'patient')
+
+
+def read_import_rows(path):
+    """Yield (line number, row) from a .csv or .jsonl file; row is None if unreadable."""
+    with open(path, newline='', encoding='utf-8') as f:
+        if path.endswith('.csv'):
+            reader = csv.DictReader(f)
+            for row in reader:
+                yield reader.line_num, row
+            return
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            yield number, row
+
+
+def _field(row, name, required=True, max_length=255):
+    value = row.get(name)
+    value = '' if value is None else str(value).strip()
+    if required and not value:
+        raise ValueError(f'{name} is required')
+    if len(value) > max_length:
+        raise ValueError(f'{name} is longer than {max_length} characters')
+    return value or None
+
+
+def _slot_field(row):
+    day = _parse_legacy(_field(row, 'date'), LEGACY_DATE_FORMATS)
+    at = _parse_legacy(_field(row, 'time'), LEGACY_TIME_FORMATS)
+    if day is None or at is None:
+        raise ValueError(f"unreadable date/time {row.get('date')!r} {row.get('time')!r}")
+    return day.date(), at.time().replace(second=0, microsecond=0)
+
+
+def load_import_refs():
+    """Natural key -> id maps the importer resolves references with."""
+    return {
+        'users': {name: (user_id, role) for user_id, name, role
+                  in db.session.query(User.id, User.username, User.role)},
+        'departments': dict(db.session.query(Department.name, Department.id)),
+        'doctors': dict(db.session.query(Doctor.user_id, Doctor.id)),
+        'patients': dict(db.session.query(Patient.user_id, Patient.id)),
+    }
+
+
+def _insert_users(connection, users, refs):
+    if not users:
+        return
+    connection.execute(User.__table__.insert(), users)
+    created = connection.execute(
+        db.select(User.id, User.username).where(User.username.in_([user['username'] for user in users]))
+    ).all()
+    roles = {user['username']: user['role'] for user in users}
+    for user_id, username in created:
+        refs['users'][username] = (user_id, roles[username])
+    _write_name_index(connection, created)
+
+
+def _import_users(connection, batch, refs):
+    users, skipped, errors = [], 0, []
+    claimed = set()
+    for number, row in batch:
+        try:
+            username = _field(row, 'username', max_length=100)
+            if username in refs['users'] or username in claimed:
+                skipped += 1
+                continue
+            role = _field(row, 'role', max_length=20)
+            if role not in USER_ROLES:
+                raise ValueError(f'role must be one of {", ".join(USER_ROLES)}')
+            users.append({'username': username, 'password': _field(row, 'password', max_length=100),
+                          'role': role, 'contact': _field(row, 'contact', False, 50)})
+            claimed.add(username)
+        except ValueError as e:
+            errors.append((number, str(e)))
+    _insert_users(connection, users, refs)
+    return len(users), skipped, errors
+
+
+def _import_profiles(connection, batch, refs, role):
+    """Doctor or patient rows, creating their users when a password is given."""
+    model = Doctor if role == 'doctor' else Patient
+    profiles = refs[role + 's']
+    users, rows, skipped, errors = [], [], 0, []
+    claimed = set()
+    for number, row in batch:
+        try:
+            username = _field(row, 'username', max_length=100)
+            if username in claimed:
+                skipped += 1
+                continue
+            user = refs['users'].get(username)
+            if user is None:
+                if not row.get('password'):
+                    raise ValueError(f'unknown user {username!r} and no password to create it')
+                users.append({'username': username, 'password': _field(row, 'password', max_length=100),
+                              'role': role, 'contact': _field(row, 'contact', False, 50)})
+            elif user[1] != role:
+                raise ValueError(f'user {username!r} is a {user[1]}, not a {role}')
+            elif user[0] in profiles:
+                skipped += 1
+                continue
+
+            if role == 'doctor':
+                department = _field(row, 'department', max_length=100)
+                if department not in refs['departments']:
+                    raise ValueError(f'unknown department {department!r}')
+                values = {'department_id': refs['departments'][department],
+                          'availability': _field(row, 'availability', False)}
+            else:
+                values = {'contact_info': _field(row, 'contact_info', False)}
+            rows.append((username, values))
+            claimed.add(username)
+        except ValueError as e:
+            errors.append((number, str(e)))
+
+    _insert_users(connection, users, refs)
+    if rows:
+        records = [dict(values, user_id=refs['users'][username][0]) for username, values in rows]
+        connection.execute(model.__table__.insert(), records)
+        user_ids = [record['user_id'] for record in records]
+        profiles.update(connection.execute(
+            db.select(model.user_id, model.id).where(model.user_id.in_(user_ids))).all())
+
+        deltas = Counter({role + 's': len(records)})
+        if role == 'doctor':
+            deltas.update(f"department:{record['department_id']}:doctors" for record in records)
+            bump_cache_version(connection, 'directory')
+        adjust_counters(connection, deltas)
+    return len(rows), skipped, errors
+
+
+def _profile_id(refs, role, username):
+    user = refs['users'].get(username)
+    profile_id = refs[role + 's'].get(user[0]) if user else None
+    if profile_id is None:
+        raise ValueError(f'unknown {role} {username!r}')
+    return profile_id
+
+
+def _existing_slots(connection, keys):
+    slot = db.tuple_(Appointment.doctor_id, Appointment.date, Appointment.time)
+    rows = connection.execute(db.select(
+        Appointment.doctor_id, Appointment.date, Appointment.time, Appointment.id).where(slot.in_(keys))).all()
+    return {(doctor_id, day, at): appointment_id for doctor_id, day, at, appointment_id in rows}
+
+
+def _import_appointments(connection, batch, refs):
+    appointments, skipped, errors = {}, 0, []
+    for number, row in batch:
+        try:
+            doctor_id = _profile_id(refs, 'doctor', _field(row, 'doctor', max_length=100))
+            patient_id = _profile_id(refs, 'patient', _field(row, 'patient', max_length=100))
+            day, at = _slot_field(row)
+            status = _field(row, 'status', False, 20) or 'Booked'
+            if status not in APPOINTMENT_STATUSES:
+                raise ValueError(f'status must be one of {", ".join(APPOINTMENT_STATUSES)}')
+        except ValueError as e:
+            errors.append((number, str(e)))
+            continue
+        if (doctor_id, day, at) in appointments:
+            skipped += 1
+            continue
+        appointments[(doctor_id, day, at)] = {'patient_id': patient_id, 'doctor_id': doctor_id,
+                                              'date': day, 'time': at, 'status': status}
+
+    if appointments:
+        for key in _existing_slots(connection, list(appointments)):
+            del appointments[key]
+            skipped += 1
+    if appointments:
+        records = list(appointments.values())
+        connection.execute(Appointment.__table__.insert(), records)
+        deltas = Counter(f"appointments:{record['status']}" for record in records)
+        deltas['appointments'] = len(records)
+        adjust_counters(connection, deltas)
+        bump_cache_version(connection, 'agenda')
+    return len(appointments), skipped, errors
+
+
+def _import_treatments(connection, batch, refs):
+    rows, errors = [], []
+    for number, row in batch:
+        try:
+            doctor_id = _profile_id(refs, 'doctor', _field(row, 'doctor', max_length=100))
+            day, at = _slot_field(row)
+            rows.append((number, (doctor_id, day, at), {
+                'diagnosis': _field(row, 'diagnosis', False),
+                'prescription': _field(row, 'prescription', False),
+                'notes': _field(row, 'notes', False),
+            }))
+        except ValueError as e:
+            errors.append((number, str(e)))
+
+    appointment_ids = _existing_slots(connection, list({key for _, key, _ in rows})) if rows else {}
+    treated = set(connection.execute(db.select(Treatment.appointment_id).where(
+        Treatment.appointment_id.in_(list(appointment_ids.values())))).scalars()) if appointment_ids else set()
+    records, skipped = [], 0
+    for number, key, values in rows:
+        if key not in appointment_ids:
+            errors.append((number, 'no appointment for that doctor, date and time'))
+            continue
+        if appointment_ids[key] in treated:
+            skipped += 1
+            continue
+        treated.add(appointment_ids[key])
+        records.append(dict(values, appointment_id=appointment_ids[key]))
+
+    if records:
+        last_id = connection.execute(db.select(func.max(Treatment.id))).scalar() or 0
+        connection.execute(Treatment.__table__.insert(), records)
+        if treatment_fts_available(connection) and not ensure_treatment_fts(connection):
+            _fts_sync(connection, " WHERE t.id > :last_id", {'last_id': last_id}, archived=False)
+    return len(records), skipped, errors
+
+
+_IMPORTERS = {
+    'users': _import_users,
+    'doctors': lambda connection, batch, refs: _import_profiles(connection, batch, refs, 'doctor'),
+    'patients': lambda connection, batch, refs: _import_profiles(connection, batch, refs, 'patient'),
+    'appointments': _import_appointments,
+    'treatments': _import_treatments,
+}
+
+
+def _save_checkpoint(path, state):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(path + '.tmp', path)
+
+
+def import_file(kind, path, refs, checkpoint, checkpoint_path, chunk_size=5000, report=print):
+    """Import one file in chunks; returns (imported, skipped, errors)."""
+    done = checkpoint.get(kind, {})
+    resume_after = done.get('line', 0) if done.get('path') == os.path.abspath(path) else 0
+    if resume_after:
+        report(f"{kind}: resuming after line {resume_after}")
+
+    totals = Counter()
+    errors = []
+    started = time.perf_counter()
+
+    def flush(batch):
+        connection = db.session.connection()
+        good, bad = [], []
+        for number, row in batch:
+            (good if isinstance(row, dict) else bad).append((number, row))
+        imported, skipped, rejected = _IMPORTERS[kind](connection, good, refs)
         db.session.commit()
-        print("Departments created successfully")
-    except Exception as e:
-        db.session.rollback()
-        print(f"Error creating departments: {e}")
+        rejected += [(number, 'not a JSON object') for number, _ in bad]
+
+        checkpoint[kind] = {'path': os.path.abspath(path), 'line': batch[-1][0]}
+        _save_checkpoint(checkpoint_path, checkpoint)
+        totals.update(imported=imported, skipped=skipped, rows=len(batch))
+        errors.extend((f'{path}:{number}', reason) for number, reason in rejected)
+        rate = totals['rows'] / max(time.perf_counter() - started, 1e-9)
+        report(f"{kind}: {totals['rows']} rows read, {totals['imported']} imported, "
+               f"{totals['skipped']} skipped, {len(errors)} rejected ({rate:.0f} rows/s)")
+
+    batch = []
+    for number, row in read_import_rows(path):
+        if number <= resume_after:
+            continue
+        batch.append((number, row))
+        if len(batch) >= chunk_size:
+            flush(batch)
+            batch = []
+    if batch:
+        flush(batch)
+    return totals['imported'], totals['skipped'], errors
+
+
+@commands.command('import-data')
+@click.option('--users', type=click.Path(exists=True, dir_okay=False), help='Users file (.csv or .jsonl).')
+@click.option('--doctors', type=click.Path(exists=True, dir_okay=False), help='Doctors file.')
+@click.option('--patients', type=click.Path(exists=True, dir_okay=False), help='Patients file.')
+@click.option('--appointments', type=click.Path(exists=True, dir_okay=False), help='Appointments file.')
+@click.option('--treatments', type=click.Path(exists=True, dir_okay=False), help='Treatments file.')
+@click.option('--chunk-size', default=5000, help='Rows per INSERT batch and transaction.')
+@click.option('--checkpoint', 'checkpoint_path', default='import-checkpoint.json',
+              help='Progress file; rerunning with it resumes where the last run stopped.')
+@click.option('--max-errors', default=50, help='Rejected rows to print.')
+def import_data_command(chunk_size, checkpoint_path, max_errors, **paths):
+    """Bulk-load users, doctors, patients, appointments and treatments."""
+    if not any(paths.values()):
+        raise click.UsageError('Give at least one file to import')
+    checkpoint = {}
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as f:
+            checkpoint = json.load(f)
+
+    refs = load_import_refs()
+    rejected = []
+    for kind in IMPORT_KINDS:
+        if paths[kind]:
+            imported, skipped, errors = import_file(kind, paths[kind], refs, checkpoint, checkpoint_path, chunk_size)
+            rejected.extend(errors)
+
+    for where, reason in rejected[:max_errors]:
+        print(f"{where}: {reason}")
+    if len(rejected) > max_errors:
+        print(f"... and {len(rejected) - max_errors} more rejected row(s)")
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    print(f"Import finished, {len(rejected)} row(s) rejected")
+
+# ---------------- EXPORT ---------------- #
+# Exports select plain columns (no ORM objects) and fetch them in
+# yield_per partitions, which also asks the driver for a server-side
+# cursor where it has one. Each partition is serialized into one chunk, so
+# memory stays flat however many rows are exported.
+
+EXPORT_KINDS = ('appointments', 'treatments')
+EXPORT_PARTITION_ROWS = 2000
+
+
+def export_select(kind, date_from=None, date_to=None, status=None, archived=False):
+    appointment, treatment = (AppointmentArchive, TreatmentArchive) if archived else (Appointment, Treatment)
+    patient_user = db.aliased(User)
+    doctor_user = db.aliased(User)
+    columns = [
+        appointment.id.label('appointment_id'),
+        type_coerce(appointment.date, db.String).label('date'),
+        type_coerce(appointment.time, db.String).label('time'),
+        appointment.status,
+        patient_user.username.label('patient'),
+        doctor_user.username.label('doctor'),
+        Department.name.label('department'),
+    ]
+    if kind == 'treatments':
+        columns = [treatment.id.label('treatment_id')] + columns + [
+            treatment.diagnosis, treatment.prescription, treatment.notes]
+        query = db.select(*columns).select_from(treatment)\
+            .join(appointment, treatment.appointment_id == appointment.id)
+    else:
+        query = db.select(*columns).select_from(appointment)
+
+    query = query.join(Patient, appointment.patient_id == Patient.id)\
+        .join(patient_user, Patient.user_id == patient_user.id)\
+        .join(Doctor, appointment.doctor_id == Doctor.id)\
+        .join(doctor_user, Doctor.user_id == doctor_user.id)\
+        .join(Department, Doctor.department_id == Department.id)
+    if date_from:
+        query = query.where(appointment.date >= date_from)
+    if date_to:
+        query = query.where(appointment.date <= date_to)
+    if status:
+        query = query.where(appointment.status == status)
+    return query.order_by(columns[0]).execution_options(yield_per=EXPORT_PARTITION_ROWS)
+
+
+def export_chunks(kind, fmt, **filters):
+    """Yield the export as encoded text chunks, one per fetched partition.
+
+    Live rows come first, then archived ones.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer) if fmt == 'csv' else None
+    for archived in (False, True):
+        result = db.session.execute(export_select(kind, archived=archived, **filters))
+        fields = list(result.keys())
+        if writer and not archived:
+            writer.writerow(fields)
+
+        for rows in result.partitions():
+            if writer:
+                writer.writerows(rows)
+            else:
+                for row in rows:
+                    buffer.write(json.dumps(dict(zip(fields, row)), default=str))
+                    buffer.write('\n')
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31: gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_filters(date_from, date_to, status):
+    """Validate export filters given as strings; raises ValueError."""
+    filters = {}
+    for name, value in (('date_from', date_from), ('date_to', date_to)):
+        if value:
+            try:
+                filters[name] = datetime.strptime(value, '%Y-%m-%d').date()
+            except ValueError:
+                raise ValueError(f'Invalid date {value!r}, expected YYYY-MM-DD')
+    if status:
+        if status not in APPOINTMENT_STATUSES:
+            raise ValueError(f'Unknown status {status!r}')
+        filters['status'] = status
+    return filters
+
+
+@commands.command('export-data')
+@click.argument('kind', type=click.Choice(EXPORT_KINDS))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), default='csv')
+@click.option('--from', 'date_from', help='First appointment date (YYYY-MM-DD).')
+@click.option('--to', 'date_to', help='Last appointment date (YYYY-MM-DD).')
+@click.option('--status', help='Only appointments with this status.')
+@click.option('--gzip', 'compress', is_flag=True, help='Write gzip-compressed output.')
+@click.option('--output', '-o', type=click.File('wb'), default='-', help='Output file (default stdout).')
+def export_data_command(kind, fmt, date_from, date_to, status, compress, output):
+    """Stream appointments or treatments as CSV or JSON Lines."""
+    try:
+        filters = export_filters(date_from, date_to, status)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    chunks = export_chunks(kind, fmt, **filters)
+    if compress:
+        chunks = gzip_chunks(chunks)
+    for chunk in chunks:
+        output.write(chunk)
+
+# ---------------- SCHEDULES ---------------- #
+# A day is an int bitmap of SLOT_MINUTES slots: bit i is the slot starting
+# i * SLOT_MINUTES after midnight. Weekly hours set bits, exceptions add or
+# clear them and existing appointments clear the slot they fall in.
+# Cancelled appointments still hold their slot because the unique
+# constraint on (doctor_id, date, time) would reject a second booking.
+
+WEEKDAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+
+
+def _minutes(value):
+    """Minutes past midnight of a time, or of its 'HH:MM[:SS]' text."""
+    if isinstance(value, str):
+        return int(value[:2]) * 60 + int(value[3:5])
+    return value.hour * 60 + value.minute
+
+
+def slot_mask(start, end):
+    """Bits for every whole slot between start and end."""
+    size = current_app.config['SLOT_MINUTES']
+    first = -(-_minutes(start) // size)
+    last = _minutes(end) // size
+    if last <= first:
+        return 0
+    return (1 << last) - (1 << first)
+
+
+def day_mask():
+    return (1 << (24 * 60 // current_app.config['SLOT_MINUTES'])) - 1
+
+
+def slot_time(index):
+    minutes = index * current_app.config['SLOT_MINUTES']
+    return datetime.min.time().replace(hour=minutes // 60, minute=minutes % 60)
+
+
+def mask_times(mask):
+    times = []
+    index = 0
+    while mask:
+        if mask & 1:
+            times.append(slot_time(index))
+        mask >>= 1
+        index += 1
+    return times
+
+
+def doctor_has_schedule(doctor_id):
+    return db.session.query(DoctorSchedule.query.filter_by(doctor_id=doctor_id).exists()).scalar()
+
+
+# The loaders below read date/time columns through type_coerce(..., String)
+# so busy departments skip per-row date/time parsing: values arrive as
+# 'YYYY-MM-DD' / 'HH:MM' text on SQLite, and are str()-ed elsewhere.
+
+def load_weekly_masks(doctor_ids=None):
+    """Weekly bitmaps {doctor_id: [mask per weekday]}, for every doctor if no ids are given."""
+    query = db.session.query(
+        DoctorSchedule.doctor_id,
+        DoctorSchedule.weekday,
+        type_coerce(DoctorSchedule.start_time, db.String),
+        type_coerce(DoctorSchedule.end_time, db.String))
+    if doctor_ids is not None:
+        query = query.filter(DoctorSchedule.doctor_id.in_(doctor_ids))
+    weekly = {}
+    for doctor_id, weekday, start, end in query:
+        masks = weekly.setdefault(doctor_id, [0] * 7)
+        masks[weekday] |= slot_mask(str(start), str(end))
+    return weekly
+
+
+def load_day_exceptions(doctor_ids, start_date, end_date):
+    """Schedule exceptions keyed by (doctor_id, date)."""
+    exceptions = {}
+    for row in ScheduleException.query.filter(
+            ScheduleException.doctor_id.in_(doctor_ids),
+            ScheduleException.date.between(start_date, end_date)):
+        exceptions.setdefault((row.doctor_id, row.date), []).append(row)
+    return exceptions
+
+
+def load_taken_masks(doctor_ids, start_date, end_date):
+    """Taken-slot bitmaps keyed by (doctor_id, 'YYYY-MM-DD').
+
+    On SQLite, where times are 'HH:MM' text, the database ORs each day's
+    slot bits itself (a SUM over the distinct bits), so a busy department
+    returns one row per doctor and day instead of one per appointment.
+    """
+    size = current_app.config['SLOT_MINUTES']
+    in_range = (Appointment.doctor_id.in_(doctor_ids), Appointment.date.between(start_date, end_date))
+    taken = Counter()
+    if db.engine.dialect.name == 'sqlite' and 24 * 60 // size < 63:
+        minutes = (func.cast(func.substr(Appointment.time, 1, 2), db.Integer) * 60
+                   + func.cast(func.substr(Appointment.time, 4, 2), db.Integer))
+        bit = literal(1).op('<<')(minutes / size)
+        for doctor_id, day, mask in db.session.query(
+                Appointment.doctor_id, type_coerce(Appointment.date, db.String), func.sum(distinct(bit)))\
+                .filter(*in_range).group_by(Appointment.doctor_id, Appointment.date):
+            taken[(doctor_id, str(day))] = int(mask)
+        return taken
+    for doctor_id, day, at in db.session.query(
+            Appointment.doctor_id,
+            type_coerce(Appointment.date, db.String),
+            type_coerce(Appointment.time, db.String)).filter(*in_range):
+        taken[(doctor_id, str(day))] |= 1 << (_minutes(str(at)) // size)
+    return taken
+
+
+def load_day_adjustments(doctor_ids, start_date, end_date):
+    """Exceptions and taken-slot bitmaps keyed by (doctor_id, date)."""
+    return (load_day_exceptions(doctor_ids, start_date, end_date),
+            load_taken_masks(doctor_ids, start_date, end_date))
+
+
+def day_open_mask(weekly, adjustments, doctor_id, day, now):
+    exceptions, taken = adjustments
+    masks = weekly.get(doctor_id)
+    mask = masks[day.weekday()] if masks else 0
+    for exception in exceptions.get((doctor_id, day), ()):
+        if exception.start_time and exception.end_time:
+            window = slot_mask(exception.start_time, exception.end_time)
+        else:
+            window = day_mask()
+        mask = mask | window if exception.available else mask & ~window
+    if not mask:
+        return 0
+    mask &= ~taken[(doctor_id, day.isoformat())]
+    if day < now.date():
+        return 0
+    if day == now.date():
+        size = current_app.config['SLOT_MINUTES']
+        mask &= ~((1 << -(-_minutes(now) // size)) - 1)
+    return mask
+
+
+def open_slot_masks(doctor_ids, start_date, days, now=None):
+    """Open-slot bitmaps {doctor_id: {date: mask}} for a date range.
+
+    Loads the schedules, the exceptions and the appointments for the
+    whole range with one query each, whatever the number of days.
+    """
+    doctor_ids = list(doctor_ids)
+    now = now or datetime.now()
+    weekly = load_weekly_masks(doctor_ids)
+    adjustments = load_day_adjustments(doctor_ids, start_date, start_date + timedelta(days=days - 1))
+
+    result = {}
+    for doctor_id in doctor_ids:
+        per_day = result[doctor_id] = {}
+        for offset in range(days):
+            day = start_date + timedelta(days=offset)
+            per_day[day] = day_open_mask(weekly, adjustments, doctor_id, day, now)
+    return result
+
+
+def earliest_department_slots(department_id, start_date, days, limit, now=None):
+    """The first `limit` open (date, time, doctor_id, username) slots across a department.
+
+    Days are read in windows of 1, 2, 4, ... days (at most 16), so a search
+    that fills up on the first day never reads the rest of the horizon.
+    Each day ORs the doctors' bitmaps and walks the union from its lowest
+    set bit.
+    """
+    now = now or datetime.now()
+    names = dict(db.session.query(Doctor.id, User.username).join(User, Doctor.user_id == User.id)
+                 .filter(Doctor.department_id == department_id))
+    doctor_ids = list(names)
+    if not doctor_ids or days < 1:
+        return []
+    weekly = load_weekly_masks(doctor_ids)
+    exceptions = load_day_exceptions(doctor_ids, start_date, start_date + timedelta(days=days - 1))
+
+    found = []
+    offset, chunk_days = 0, 1
+    while offset < days and len(found) < limit:
+        span = min(chunk_days, days - offset)
+        chunk_start = start_date + timedelta(days=offset)
+        chunk_end = chunk_start + timedelta(days=span - 1)
+        adjustments = (exceptions, load_taken_masks(doctor_ids, chunk_start, chunk_end))
+        for day in (chunk_start + timedelta(days=n) for n in range(span)):
+            masks = [(doctor_id, day_open_mask(weekly, adjustments, doctor_id, day, now)) for doctor_id in doctor_ids]
+            union = 0
+            for _, mask in masks:
+                union |= mask
+            while union and len(found) < limit:
+                lowest = union & -union
+                at = slot_time(lowest.bit_length() - 1)
+                for doctor_id, mask in masks:
+                    if mask & lowest and len(found) < limit:
+                        found.append((day, at, doctor_id, names[doctor_id]))
+                union ^= lowest
+            if len(found) >= limit:
+                break
+        offset += span
+        chunk_days = min(chunk_days * 2, 16)
+    return found
+
+
+def open_slots(doctor_id, start_date, days, now=None):
+    """Open slot times {date: [time, ...]} for one doctor."""
+    masks = open_slot_masks([doctor_id], start_date, days, now)[doctor_id]
+    return {day: mask_times(mask) for day, mask in masks.items()}
+
+
+# Booking checks a time against the weekly hours and exceptions only, from
+# a per-process copy of every schedule. Schedule writes bump the shared
+# 'schedule' cache_version row, which each check reads (one primary-key
+# lookup). Whether the slot is still free is left to the unique constraint.
+
+ExceptionHours = namedtuple('ExceptionHours', ['start_time', 'end_time', 'available'])
+
+_schedule_cache = {'version': None, 'weekly': {}, 'exceptions': {}}
+_schedule_lock = threading.Lock()
+
+
+@event.listens_for(Session, 'after_flush')
+def _bump_schedule_version(session, flush_context):
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, (DoctorSchedule, ScheduleException)):
+            bump_cache_version(session.connection(), 'schedule')
+            return
+
+
+def cached_schedules():
+    """(weekly masks, exceptions from today on), rebuilt when the version moves."""
+    version = db.session.query(CacheVersion.version).filter(CacheVersion.name == 'schedule').scalar() or 0
+    if _schedule_cache['version'] != version:
+        with _schedule_lock:
+            if _schedule_cache['version'] != version:
+                exceptions = {}
+                for doctor_id, day, start, end, available in db.session.query(
+                        ScheduleException.doctor_id, ScheduleException.date, ScheduleException.start_time,
+                        ScheduleException.end_time, ScheduleException.available).filter(
+                        ScheduleException.date >= datetime.now().date()):
+                    exceptions.setdefault((doctor_id, day), []).append(ExceptionHours(start, end, available))
+                _schedule_cache.update(version=version, weekly=load_weekly_masks(), exceptions=exceptions)
+    return _schedule_cache['weekly'], _schedule_cache['exceptions']
+
+
+def is_scheduled_slot(doctor_id, day, at, now=None):
+    """False if the doctor keeps weekly hours and `at` is not one of that day's slots."""
+    weekly, exceptions = cached_schedules()
+    if doctor_id not in weekly:
+        return True
+    size = current_app.config['SLOT_MINUTES']
+    minutes = _minutes(at)
+    if minutes % size:
+        return False
+    mask = day_open_mask(weekly, (exceptions, Counter()), doctor_id, day, now or datetime.now())
+    return bool(mask >> (minutes // size) & 1)
+
+
+def _parse_hours(value):
+    start, end = value.split('-')
+    start = datetime.strptime(start.strip(), '%H:%M').time()
+    end = datetime.strptime(end.strip(), '%H:%M').time()
+    if end <= start:
+        raise ValueError(f'{value} ends before it starts')
+    return start, end
+
+
+def parse_weekly_schedule(value):
+    """Parse lines like "Mon 09:00-13:00" into (weekday, start, end) tuples."""
+    entries = []
+    for number, line in enumerate((value or '').splitlines(), start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            day, hours = line.split(None, 1)
+            weekday = [d.lower() for d in WEEKDAYS].index(day[:3].lower())
+            entries.append((weekday, *_parse_hours(hours)))
+        except ValueError:
+            raise ValueError(f'Weekly schedule line {number} should look like "Mon 09:00-13:00": {line}')
+    return entries
+
+
+def parse_schedule_exceptions(value):
+    """Parse "2030-01-05 off", "2030-01-05 off 12:00-14:00" or "2030-01-05 16:00-18:00"."""
+    entries = []
+    for number, line in enumerate((value or '').splitlines(), start=1):
+        parts = line.split()
+        if not parts:
+            continue
+        try:
+            day = datetime.strptime(parts[0], '%Y-%m-%d').date()
+            available = parts[1:2] != ['off']
+            hours = parts[1:] if available else parts[2:]
+            if available and not hours:
+                raise ValueError(line)
+            start, end = _parse_hours(''.join(hours)) if hours else (None, None)
+            entries.append((day, start, end, available))
+        except (ValueError, IndexError):
+            raise ValueError(f'Exception line {number} should look like "2030-01-05 off" '
+                             f'or "2030-01-05 16:00-18:00": {line}')
+    return entries
+
+
+def format_weekly_schedule(doctor):
+    rows = sorted(doctor.schedule, key=lambda row: (row.weekday, row.start_time))
+    return '\n'.join(f'{WEEKDAYS[row.weekday]} {row.start_time:%H:%M}-{row.end_time:%H:%M}' for row in rows)
+
+
+def format_schedule_exceptions(doctor):
+    lines = []
+    for row in sorted(doctor.schedule_exceptions, key=lambda row: (row.date, row.start_time or datetime.min.time())):
+        hours = f' {row.start_time:%H:%M}-{row.end_time:%H:%M}' if row.start_time else ''
+        lines.append(f'{row.date:%Y-%m-%d}{"" if row.available else " off"}{hours}')
+    return '\n'.join(lines)
+
+
+# ---------------- BOOKING ---------------- #
+# Bookings are insert-first: the unique (doctor_id, date, time) constraint
+# decides who gets a slot, so concurrent requests can't both pass a
+# pre-check. The time is only checked against the cached schedules, so the
+# one read before the insert is the schedule cache's version row.
+
+def is_slot_conflict(error):
+    """True if an IntegrityError is the _doctor_appointment_uc violation."""
+    message = str(getattr(error, 'orig', error))
+    # PostgreSQL/MySQL name the constraint; SQLite lists its columns.
+    return '_doctor_appointment_uc' in message or \
+        'UNIQUE constraint failed: appointment.doctor_id, appointment.date, appointment.time' in message
+
+
+def book_slot(patient_id, doctor_id, day, at, session=None):
+    """Insert a Booked appointment; returns None if the slot is already taken."""
+    session = session or db.session
+    appointment = Appointment(patient_id=patient_id, doctor_id=doctor_id,
+                              date=day, time=at, status='Booked')
+    session.add(appointment)
+    try:
+        session.commit()
+    except IntegrityError as error:
+        session.rollback()
+        if is_slot_conflict(error):
+            return None
+        raise
+    return appointment
+
+
+# ---------------- AGENDA ---------------- #
+# Doctors page through day/week/month windows of their appointments, read
+# with a (doctor_id, date) range scan on the unique constraint's index.
+# The .ics feed is addressed by a signed token, so calendar clients need
+# no session. Its ETag is built from cache_version rows: a flush touching
+# a doctor's appointments bumps 'agenda:<doctor_id>', and bulk loads or
+# patient renames bump 'agenda'. A digest of the doctor's name (the
+# calendar name) is part of the tag too. An unchanged feed gets a 304
+# from those rows and the doctor lookup alone.
+
+AGENDA_WINDOWS = {'day': 1, 'week': 7, 'month': 30}
+
+
+def agenda_window(view, start):
+    """(view, first day, last day); unknown views mean a week, bad dates mean today."""
+    if view not in AGENDA_WINDOWS:
+        view = 'week'
+    try:
+        first = datetime.strptime(start or '', '%Y-%m-%d').date()
+    except ValueError:
+        first = datetime.now().date()
+    return view, first, first + timedelta(days=AGENDA_WINDOWS[view] - 1)
+
+
+def agenda_appointments(doctor_id, first, last):
+    return Appointment.query.options(
+        joinedload(Appointment.patient).joinedload(Patient.user),
+        selectinload(Appointment.treatment),
+    ).filter(
+        Appointment.doctor_id == doctor_id,
+        Appointment.date.between(first, last),
+    ).order_by(Appointment.date, Appointment.time).all()
+
+
+@event.listens_for(Session, 'after_flush')
+def _bump_agenda_versions(session, flush_context):
+    names = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Appointment) and (obj in session.new or obj in session.deleted
+                                             or session.is_modified(obj, include_collections=False)):
+            names.update(f'agenda:{doctor_id}' for doctor_id in (_old_value(obj, 'doctor_id'), obj.doctor_id))
+        elif isinstance(obj, User) and obj.role == 'patient' and (
+                obj in session.deleted or sa_inspect(obj).attrs.username.history.has_changes()):
+            names.add('agenda')
+    for name in sorted(names):
+        bump_cache_version(session.connection(), name)
+
+
+def _feed_serializer():
+    return URLSafeSerializer(current_app.config['SECRET_KEY'], salt='agenda-feed')
+
+
+def agenda_feed_token(doctor_id):
+    return _feed_serializer().dumps(doctor_id)
+
+
+def agenda_etag(doctor_id, doctor_name, today):
+    names = ('agenda', f'agenda:{doctor_id}')
+    versions = dict(db.session.query(CacheVersion.name, CacheVersion.version).filter(CacheVersion.name.in_(names)))
+    name_digest = hashlib.blake2b(doctor_name.encode(), digest_size=4).hexdigest()
+    return f"{doctor_id}-{versions.get(names[0], 0)}-{versions.get(names[1], 0)}-{name_digest}-{today:%Y%m%d}"
+
+
+def _ics_text(value):
+    return value.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+
+def _ics_line(line):
+    """Fold a content line to 75 octets as RFC 5545 asks."""
+    data = line.encode()
+    parts = []
+    while len(data) > (74 if parts else 75):  # continuation lines start with a space
+        cut = 74 if parts else 75
+        while cut and (data[cut] & 0xC0) == 0x80:  # don't split a UTF-8 sequence
+            cut -= 1
+        parts.append(data[:cut].decode())
+        data = data[cut:]
+    parts.append(data.decode())
+    return '\r\n '.join(parts) + '\r\n'
+
+
+def agenda_ics(doctor_name, rows, today):
+    """iCalendar text for (id, date, time, status, patient) rows, one event at a time."""
+    stamp = f'{today:%Y%m%d}T000000Z'  # fixed per day so the body matches its ETag
+    length = timedelta(minutes=current_app.config['SLOT_MINUTES'])
+    yield ('BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//Hospital Management//Agenda//EN\r\n'
+           'CALSCALE:GREGORIAN\r\n' + _ics_line(f'X-WR-CALNAME:{_ics_text(f"Dr. {doctor_name}")}'))
+    for appointment_id, day, at, status, patient in rows:
+        start = datetime.combine(day, at)
+        yield ('BEGIN:VEVENT\r\n'
+               f'UID:appointment-{appointment_id}@hospital\r\n'
+               f'DTSTAMP:{stamp}\r\n'
+               f'DTSTART:{start:%Y%m%dT%H%M%S}\r\n'
+               f'DTEND:{start + length:%Y%m%dT%H%M%S}\r\n'
+               + _ics_line(f'SUMMARY:{_ics_text(f"{patient} ({status})")}')
+               + f"STATUS:{'CANCELLED' if status == 'Cancelled' else 'CONFIRMED'}\r\n"
+               'END:VEVENT\r\n')
+    yield 'END:VCALENDAR\r\n'
+
+# ---------------- PAGINATION ---------------- #
+# Keyset pagination: pages are addressed by the last/first id seen rather
+# than an OFFSET, so page N costs the same index seek as page 1.
+
+_count_cache = ExpiringLRU('LIST_COUNT_CACHE_SIZE', 'LIST_COUNT_TTL')
+
+
+def cached_count(key, count):
+    """Return count(), reusing the value for LIST_COUNT_TTL seconds."""
+    return _count_cache.get_or_compute(key, count)
+
+
+def page_args():
+    def _int(name):
+        try:
+            return int(request.args.get(name, ''))
+        except ValueError:
+            return None
+
+    per_page = _int('per_page') or current_app.config['LIST_PAGE_SIZE']
+    per_page = max(1, min(per_page, current_app.config['LIST_MAX_PAGE_SIZE']))
+    return _int('after'), _int('before'), per_page
+
+
+def keyset_page(query, key, count_key):
+    """One page of an ORM query or a column select, plus its cursors and total."""
+    after, before, per_page = page_args()
+    if isinstance(query, Select):
+        fetch = lambda q: db.session.execute(q).all()
+        count = lambda: db.session.scalar(db.select(func.count()).select_from(query.order_by(None).subquery()))
+    else:
+        fetch = lambda q: q.all()
+        count = lambda: query.order_by(None).count()
+    total = cached_count(count_key, count)
+
+    if before is not None:
+        rows = fetch(query.filter(key < before).order_by(key.desc()).limit(per_page + 1))
+        has_more = len(rows) > per_page
+        rows = rows[:per_page][::-1]
+        prev_cursor = rows[0].id if has_more and rows else None
+        next_cursor = rows[-1].id if rows else None
+    else:
+        if after is not None:
+            query = query.filter(key > after)
+        rows = fetch(query.order_by(key).limit(per_page + 1))
+        has_more = len(rows) > per_page
+        rows = rows[:per_page]
+        prev_cursor = rows[0].id if after is not None and rows else None
+        next_cursor = rows[-1].id if has_more else None
+
+    return rows, {
+        'per_page': per_page,
+        'total': total,
+        'next_cursor': next_cursor,
+        'prev_cursor': prev_cursor,
+    }
+
+
+def stream_page(template, **context):
+    """Send a list page as it renders.
+
+    Flashes are popped before the first byte: the session cookie goes
+    out with the headers, so popping them mid-stream would not stick.
+    """
+    get_flashed_messages()
+    return Response(stream_template(template, **context))
+
+# ---------------- METRICS ---------------- #
+# When METRICS_ENABLED, cursor events and request hooks record per request
+# the query count, DB time, template render time and slowest statements.
+# Totals are aggregated per endpoint in this process and served in the
+# Prometheus text format at /admin/metrics. Queries over SLOW_QUERY_MS and
+# requests over SLOW_REQUEST_MS are logged as warnings.
+
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_metrics_lock = threading.Lock()
+_endpoint_metrics = {}
+
+
+def _statement_text(statement):
+    return ' '.join(statement.split())[:300]
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.metrics_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, 'metrics_started', None)
+    if started is None or not has_app_context():
+        return
+    elapsed = time.perf_counter() - started
+    stats = g.get('request_metrics')
+    if stats is not None:
+        stats['queries'] += 1
+        stats['db'] += elapsed
+        slowest = stats['slowest']
+        if len(slowest) < current_app.config['METRICS_TOP_STATEMENTS'] or elapsed > slowest[0][0]:
+            heapq.heappush(slowest, (elapsed, statement))
+            if len(slowest) > current_app.config['METRICS_TOP_STATEMENTS']:
+                heapq.heappop(slowest)
+    if elapsed * 1000 >= current_app.config['SLOW_QUERY_MS']:
+        current_app.logger.warning('slow query %.1f ms in %s: %s', elapsed * 1000,
+                                   request.endpoint if has_request_context() else 'cli',
+                                   _statement_text(statement))
+
+
+def _start_request_metrics():
+    g.request_metrics = {'started': time.perf_counter(), 'queries': 0, 'db': 0.0, 'render': 0.0,
+                         'slowest': []}
+
+
+def _before_render(sender, template, context, **extra):
+    stats = g.get('request_metrics')
+    if stats is not None:
+        stats['render_started'] = time.perf_counter()
+
+
+def _after_render(sender, template, context, **extra):
+    stats = g.get('request_metrics')
+    if stats is not None and 'render_started' in stats:
+        stats['render'] += time.perf_counter() - stats.pop('render_started')
+
+
+def _finish_request_metrics(app, endpoint, stats):
+    """Add one request to its endpoint's totals; returns its duration in seconds."""
+    elapsed = time.perf_counter() - stats['started']
+    top = app.config['METRICS_TOP_STATEMENTS']
+    with _metrics_lock:
+        totals = _endpoint_metrics.get(endpoint)
+        if totals is None:
+            totals = _endpoint_metrics[endpoint] = {
+                'requests': 0, 'seconds': 0.0, 'buckets': [0] * len(METRIC_BUCKETS),
+                'queries': 0, 'db': 0.0, 'render': 0.0, 'slowest': {},
+            }
+        totals['requests'] += 1
+        totals['seconds'] += elapsed
+        totals['queries'] += stats['queries']
+        totals['db'] += stats['db']
+        totals['render'] += stats['render']
+        bucket = bisect.bisect_left(METRIC_BUCKETS, elapsed)
+        if bucket < len(METRIC_BUCKETS):
+            totals['buckets'][bucket] += 1
+        slowest = totals['slowest']
+        for seconds, statement in stats['slowest']:
+            key = _statement_text(statement)
+            if seconds > slowest.get(key, 0):
+                slowest[key] = seconds
+        if len(slowest) > top:
+            totals['slowest'] = dict(sorted(slowest.items(), key=lambda item: -item[1])[:top])
+
+    if elapsed * 1000 >= app.config['SLOW_REQUEST_MS']:
+        app.logger.warning('slow request %.1f ms %s: %d queries, %.1f ms db, %.1f ms render',
+                           elapsed * 1000, endpoint, stats['queries'], stats['db'] * 1000,
+                           stats['render'] * 1000)
+    return elapsed
+
+
+def _record_request_metrics(response):
+    endpoint = request.endpoint or 'unmatched'
+    app = current_app._get_current_object()
+    if response.is_streamed:
+        # Streamed pages query and render while the body is sent, after this
+        # hook. g outlives the hook for them, so the cursor and render hooks
+        # keep adding to the same stats until the body is exhausted or closed.
+        # The headers are already out by then, so there is no Server-Timing.
+        stats = g.get('request_metrics')
+        if stats is not None:
+            body = response.response
+
+            def measured_body():
+                try:
+                    yield from body
+                finally:
+                    _finish_request_metrics(app, endpoint, stats)
+
+            response.response = measured_body()
+        return response
+
+    stats = g.pop('request_metrics', None)
+    if stats is None:
+        return response
+    elapsed = _finish_request_metrics(app, endpoint, stats)
+    response.headers['Server-Timing'] = (
+        f"db;dur={stats['db'] * 1000:.1f}, render;dur={stats['render'] * 1000:.1f}, "
+        f"total;dur={elapsed * 1000:.1f}")
+    return response
+
+
+def install_metrics(app):
+    """Hook the instrumentation into an app and its engines."""
+    with app.app_context():
+        for engine in db.engines.values():
+            event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+            event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    app.before_request(_start_request_metrics)
+    app.after_request(_record_request_metrics)
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_after_render, app)
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_metrics():
+    """Per-endpoint totals in the Prometheus text exposition format."""
+    with _metrics_lock:
+        snapshot = {endpoint: dict(totals, buckets=list(totals['buckets']), slowest=dict(totals['slowest']))
+                    for endpoint, totals in _endpoint_metrics.items()}
+
+    lines = ['# HELP hospital_request_duration_seconds Request latency by endpoint.',
+             '# TYPE hospital_request_duration_seconds histogram']
+    for endpoint, totals in sorted(snapshot.items()):
+        label = f'endpoint="{_label(endpoint)}"'
+        cumulative = 0
+        for bound, count in zip(METRIC_BUCKETS, totals['buckets']):
+            cumulative += count
+            lines.append(f'hospital_request_duration_seconds_bucket{{{label},le="{bound}"}} {cumulative}')
+        lines.append(f'hospital_request_duration_seconds_bucket{{{label},le="+Inf"}} {totals["requests"]}')
+        lines.append(f'hospital_request_duration_seconds_sum{{{label}}} {totals["seconds"]:.6f}')
+        lines.append(f'hospital_request_duration_seconds_count{{{label}}} {totals["requests"]}')
+
+    for name, key, kind, help_text in (
+        ('hospital_db_queries_total', 'queries', 'counter', 'SQL statements executed by endpoint.'),
+        ('hospital_db_seconds_total', 'db', 'counter', 'Time spent in SQL by endpoint.'),
+        ('hospital_render_seconds_total', 'render', 'counter', 'Time spent rendering templates by endpoint.'),
+    ):
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+        for endpoint, totals in sorted(snapshot.items()):
+            value = totals[key]
+            lines.append(f'{name}{{endpoint="{_label(endpoint)}"}} {value if key == "queries" else f"{value:.6f}"}')
+
+    lines += ['# HELP hospital_slowest_statement_seconds Slowest statements seen per endpoint.',
+              '# TYPE hospital_slowest_statement_seconds gauge']
+    for endpoint, totals in sorted(snapshot.items()):
+        for statement, seconds in sorted(totals['slowest'].items(), key=lambda item: -item[1]):
+            lines.append(f'hospital_slowest_statement_seconds{{endpoint="{_label(endpoint)}",'
+                         f'statement="{_label(statement)}"}} {seconds:.6f}')
+
+    with _metrics_lock:
+        rejections = sorted(_admission_rejections.items())
+    lines += ['# HELP hospital_admission_rejections_total Requests answered 429 by admission control.',
+              '# TYPE hospital_admission_rejections_total counter']
+    for (endpoint, reason), count in rejections:
+        lines.append(f'hospital_admission_rejections_total{{endpoint="{_label(endpoint)}",'
+                     f'reason="{reason}"}} {count}')
+    return '\n'.join(lines) + '\n'
+
+# ---------------- ADMISSION CONTROL ---------------- #
+# ADMISSION_RULES guard chosen endpoints before the principal is loaded: a
+# per-process concurrency limit lets `concurrency` requests run while up to
+# `queue` more wait at most ADMISSION_BUDGET_MS for a slot, then token
+# buckets per user and per doctor (doctor_id from the URL or form) shed a
+# flood from one client or onto one calendar. Everything else gets an
+# immediate 429 with Retry-After instead of piling up behind SQLite's
+# single writer. A request spends its tokens only once it holds a slot, and
+# only if every bucket has one.
+#
+# The doctor bucket is for logged-in requests naming a doctor in the
+# cached directory, so made-up ids cannot grow the store, and a bucket that
+# has refilled is dropped on the next prune. The default doctor_rate lets
+# a few bookings a second through to any one calendar, far more than real
+# patients make and far below what one process serves (about 190 posts a
+# second in `flask --app devtools load-test-admission`).
+#
+# Buckets live in process memory, or with ADMISSION_BACKEND=sqlite:<path>
+# in a small SQLite file shared by all workers on the host. Concurrency
+# slots are always per process. If the shared file is locked the request
+# is admitted rather than stalled.
+
+_admission_rejections = Counter()
+ADMISSION_PRUNE_SECONDS = 60  # how often a bucket store drops buckets that have refilled
+
+
+def _refill(tokens, updated, now, rate, burst):
+    """Bucket level at `now` and the seconds until one token is available."""
+    tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+    return tokens, 0.0 if tokens >= 1 else (1 - tokens) / rate
+
+
+def _spend(levels, takes, now):
+    """Spend one token from every bucket in takes, or none of them.
+
+    levels maps key -> (tokens, updated) for the buckets that exist; takes
+    is [(key, (rate, burst))]. Returns (new rows, None) when admitted, else
+    (None, (key, seconds to wait)). A row is (key, tokens, updated, full_at),
+    full_at being when the bucket is full again and can be dropped, since a
+    missing bucket counts as full.
+    """
+    rows = []
+    for key, (rate, burst) in takes:
+        tokens, wait = _refill(*levels.get(key, (burst, now)), now, rate, burst)
+        if wait:
+            return None, (key, wait)
+        rows.append((key, tokens - 1, now, now + (burst - tokens + 1) / rate))
+    return rows, None
+
+
+class MemoryBuckets:
+    """Token buckets in this process."""
+
+    def __init__(self):
+        self._buckets = {}  # key -> (tokens, updated, full_at)
+        self._lock = threading.Lock()
+        self._next_prune = 0.0
+
+    def take(self, takes):
+        """Spend a token from each bucket in takes, all or nothing.
+
+        Returns None if admitted, else (key, seconds to wait) for the
+        first bucket that is empty.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if now >= self._next_prune:
+                self._buckets = {key: entry for key, entry in self._buckets.items() if entry[2] > now}
+                self._next_prune = now + ADMISSION_PRUNE_SECONDS
+            rows, denied = _spend({key: self._buckets[key][:2] for key, _ in takes if key in self._buckets},
+                                  takes, now)
+            for key, tokens, updated, full_at in rows or ():
+                self._buckets[key] = (tokens, updated, full_at)
+        return denied
+
+
+class SQLiteBuckets:
+    """Token buckets in a SQLite file, shared by the worker processes on one host."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._next_prune = 0.0
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=0.05, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=OFF')  # losing buckets in a crash is harmless
+            connection.execute('CREATE TABLE IF NOT EXISTS token_bucket (key TEXT PRIMARY KEY, '
+                               'tokens REAL NOT NULL, updated REAL NOT NULL, full_at REAL NOT NULL)')
+            self._local.connection = connection
+        return connection
+
+    def take(self, takes):
+        """Spend a token from each bucket in takes, all or nothing.
+
+        Returns None if admitted, else (key, seconds to wait) for the
+        first bucket that is empty.
+        """
+        now = time.time()  # wall clock, comparable across processes
+        try:
+            connection = self._connection()
+            connection.execute('BEGIN IMMEDIATE')
+        except sqlite3.Error:
+            return None
+        try:
+            if now >= self._next_prune:
+                self._next_prune = now + ADMISSION_PRUNE_SECONDS
+                connection.execute('DELETE FROM token_bucket WHERE full_at <= ?', (now,))
+            keys = [key for key, _ in takes]
+            levels = {key: (tokens, updated) for key, tokens, updated in connection.execute(
+                f"SELECT key, tokens, updated FROM token_bucket WHERE key IN ({', '.join('?' * len(keys))})",
+                keys)}
+            rows, denied = _spend(levels, takes, now)
+            if rows:
+                connection.executemany(
+                    'INSERT INTO token_bucket (key, tokens, updated, full_at) VALUES (?, ?, ?, ?) '
+                    'ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated, '
+                    'full_at = excluded.full_at', rows)
+            connection.execute('COMMIT')
+        except sqlite3.Error:
+            if connection.in_transaction:
+                connection.execute('ROLLBACK')
+            return None
+        return denied
+
+
+def admission_buckets(backend):
+    """The bucket store named by ADMISSION_BACKEND ('memory' or 'sqlite:<path>')."""
+    if backend == 'memory':
+        return MemoryBuckets()
+    if backend.startswith('sqlite:'):
+        return SQLiteBuckets(backend[len('sqlite:'):])
+    raise ValueError(f'unknown ADMISSION_BACKEND {backend!r}')
+
+
+class ConcurrencyLimit:
+    """At most `limit` requests inside an endpoint, with a bounded queue in front."""
+
+    def __init__(self, limit, queue):
+        self._slots = threading.BoundedSemaphore(limit)
+        self._queue = queue
+        self._waiting = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout):
+        if self._slots.acquire(blocking=False):
+            return True
+        with self._lock:
+            if self._waiting >= self._queue:
+                return False
+            self._waiting += 1
+        try:
+            return self._slots.acquire(timeout=timeout)
+        finally:
+            with self._lock:
+                self._waiting -= 1
+
+    def release(self):
+        self._slots.release()
+
+
+def _reject(reason, retry_after):
+    with _metrics_lock:
+        _admission_rejections[(request.endpoint, reason)] += 1
+    seconds = max(1, math.ceil(retry_after))
+    if request.path.startswith('/api/'):
+        response = jsonify({'error': 'Too many requests, please try again shortly.', 'retry_after': seconds})
+    else:
+        response = Response('Too many requests right now, please try again in a few seconds.\n',
+                            mimetype='text/plain')
+    response.status_code = 429
+    response.headers['Retry-After'] = str(seconds)
+    return response
+
+
+def _admit():
+    rule = current_app.config['ADMISSION_RULES'].get(request.endpoint)
+    if rule is None or request.method not in rule.get('methods', ('POST',)):
+        return None
+    state = current_app.extensions['admission']
+
+    # The slot comes first, so a request turned away as busy spends no tokens.
+    limit = state['limits'].get(request.endpoint)
+    if limit is not None:
+        if not limit.acquire(current_app.config['ADMISSION_BUDGET_MS'] / 1000):
+            return _reject('busy', 1)
+        g.admission_limit = limit
+
+    takes = []
+    user_id = session.get('user_id')
+    if 'user_rate' in rule:
+        takes.append((f'user:{user_id}' if user_id is not None else f'ip:{request.remote_addr}',
+                      rule['user_rate']))
+    doctor_id = str((request.view_args or {}).get('doctor_id') or request.form.get('doctor_id', ''))
+    if 'doctor_rate' in rule and user_id is not None and doctor_id.isdigit() \
+            and int(doctor_id) in {doctor.id for doctor in directory()[0]}:
+        takes.append((f'doctor:{int(doctor_id)}', rule['doctor_rate']))
+    denied = state['buckets'].take([(f'{request.endpoint}:{key}', rate) for key, rate in takes]) if takes else None
+    if denied:
+        _release_admission()
+        key, wait = denied
+        return _reject(key.split(':')[1], wait)
+    return None
+
+
+def _release_admission(error=None):
+    limit = g.pop('admission_limit', None)
+    if limit is not None:
+        limit.release()
+
+
+def install_admission(app):
+    """Attach the admission hooks; must run before the other before_request hooks."""
+    rules = app.config['ADMISSION_RULES']
+    app.extensions['admission'] = {
+        'buckets': admission_buckets(app.config['ADMISSION_BACKEND']),
+        'limits': {endpoint: ConcurrencyLimit(rule['concurrency'], rule.get('queue', 0))
+                   for endpoint, rule in rules.items() if rule.get('concurrency')},
+    }
+    app.before_request(_admit)
+    app.teardown_request(_release_admission)
+
+
+# ---------------- PRINCIPAL ---------------- #
+# The logged-in user and their doctor/patient row are loaded once per
+# request into g.user / g.doctor / g.patient, with one query.
+
+
+@before_request
+def load_principal():
+    g.user = g.doctor = g.patient = None
+    user_id = session.get('user_id')
+    if user_id is None or request.endpoint == 'static':
+        return
+
+    role = session.get('role')
+    if role in ('doctor', 'patient'):
+        profile = Doctor if role == 'doctor' else Patient
+        row = db.session.query(User, profile).outerjoin(profile, profile.user_id == User.id)\
+            .filter(User.id == user_id).first()
+        user, profile_row = row if row else (None, None)
+    else:
+        user, profile_row = db.session.get(User, user_id), None
+
+    if user is None or user.role != role:
+        session.clear()  # account deleted or role changed since login
+        return
+    g.user = user
+    if role == 'doctor':
+        g.doctor = profile_row
+    elif role == 'patient':
+        g.patient = profile_row
+
+
+def require_role(*roles):
+    """Allow only logged-in users with one of roles (any role if none given)."""
+    def decorator(view):
+        @wraps(view)
+        def wrapped(*args, **kwargs):
+            if g.user is None or (roles and g.user.role not in roles):
+                if request.path.startswith('/api/'):
+                    return jsonify({'error': 'login required'}), 401
+                flash('Access denied', 'error')
+                return redirect(url_for('login'))
+            if g.user.role == 'doctor' and g.doctor is None:
+                flash('Doctor profile not found', 'error')
+                return redirect(url_for('login'))
+            return view(*args, **kwargs)
+        return wrapped
+    return decorator
+
+
+def owned_appointment(appointment_id, *options):
+    """Load an appointment of the current doctor or patient in one query.
+
+    Aborts with 404 if it does not exist and returns None if it belongs to
+    someone else.
+    """
+    appointment = Appointment.query.options(*options).filter(Appointment.id == appointment_id).first()
+    if appointment is None:
+        abort(404)
+    if g.doctor is not None and appointment.doctor_id == g.doctor.id:
+        return appointment
+    if g.patient is not None and appointment.patient_id == g.patient.id:
+        return appointment
+    return None
 
 # ---------------- AUTH ROUTES ---------------- #
 
-@app.route('/')
+@route('/')
 def home():
     return redirect(url_for('login'))
 
 
-@app.route('/signup', methods=['GET', 'POST'])
+@route('/signup', methods=['GET', 'POST'])
 def signup():
     if request.method == 'GET':
         return render_template("signup.html")
@@ -167,7 +3065,7 @@ def signup():
         return redirect(url_for('signup'))
 
 
-@app.route('/login', methods=['GET', 'POST'])
+@route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
         username = request.form['username']
@@ -197,7 +3095,7 @@ def login():
     return render_template('login.html')
 
 
-@app.route('/logout')
+@route('/logout')
 def logout():
     session.clear()
     flash('Logged out successfully!', 'success')
@@ -206,7 +3104,7 @@ def logout():
 
 # ---------------- ADMIN ROUTES ---------------- #
 
-# @app.route('/admin/dashboard')
+# @route('/admin/dashboard')
 # def admin_dashboard():
 #     if 'user_id' not in session or session.get('role') != 'admin':
 #         flash('Access denied', 'error')
@@ -225,19 +3123,17 @@ def logout():
 #                            pending_appointments=pending_appointments,
 #                            completed_appointments=completed_appointments)
 
-@app.route('/admin/dashboard')
+@route('/admin/dashboard')
+@require_role('admin')
 def admin_dashboard():
-    if 'user_id' not in session or session.get('role') != 'admin':
-        flash('Access denied', 'error')
-        return redirect(url_for('login'))
-
     #count
-    total_doctors = Doctor.query.count()
-    total_patients = Patient.query.count()
-    total_appointments = Appointment.query.count()
-    pending_appointments = Appointment.query.filter_by(status='Booked').count()
-    completed_appointments = Appointment.query.filter_by(status='Completed').count()
-    cancelled_appointments = Appointment.query.filter_by(status='Cancelled').count()
+    counters = read_counters()
+    total_doctors = counters.get('doctors', 0)
+    total_patients = counters.get('patients', 0)
+    total_appointments = counters.get('appointments', 0)
+    pending_appointments = counters.get('appointments:Booked', 0)
+    completed_appointments = counters.get('appointments:Completed', 0)
+    cancelled_appointments = counters.get('appointments:Cancelled', 0)
 
     # Cal percent
     completion_rate = round((completed_appointments / total_appointments * 100) if total_appointments > 0 else 0)
@@ -245,12 +3141,11 @@ def admin_dashboard():
     efficiency_score = 85   
 
     # FIXED: Use Department.name instead of Doctor.specialization
-    from sqlalchemy import func
-    specialization_data = db.session.query(
-        Department.name,
-        func.count(Doctor.id).label('count')
-    ).join(Department, Doctor.department_id == Department.id)\
-     .group_by(Department.name).all()
+    specialization_data = []
+    for department_id, name in db.session.query(Department.id, Department.name).order_by(Department.name):
+        count = counters.get(f'department:{department_id}:doctors', 0)
+        if count:
+            specialization_data.append((name, count))
 
     max_count = max([s[1] for s in specialization_data]) if specialization_data else 1
 
@@ -266,6 +3161,7 @@ def admin_dashboard():
         })
 
     return render_template('admin_dashboard.html',
+                           data_version=fragment_version(sorted(counters.items()), specialization_data),
                            total_doctors=total_doctors,
                            total_patients=total_patients,
                            total_appointments=total_appointments,
@@ -277,34 +3173,28 @@ def admin_dashboard():
                            efficiency_score=efficiency_score,
                            specializations=specializations)
 
-@app.route('/admin/doctors')
+@route('/admin/doctors')
+@require_role('admin')
+@read_replica
 def view_doc():
-    if 'user_id' not in session or session.get('role') != 'admin':
-        flash('Access denied', 'error')
-        return redirect(url_for('login'))
-    
     search = request.args.get('search', '').strip()
     
+    query = doctor_list_query()
     if search:
-        doctors = Doctor.query.join(User).join(Department).filter(
+        query = query.join(Department).filter(
             or_(
-                User.username.ilike(f'%{search}%'),
+                Doctor.user_id.in_(user_ids_matching(search)),
                 Department.name.ilike(f'%{search}%')
             )
-        ).all()
-    else:
-        doctors = Doctor.query.all()
-    
-    return render_template('view_doc.html', doctors=doctors, search=search)
+        )
 
+    doctors, page = keyset_page(query, Doctor.id, ('doctors', search))
+    return render_template('view_doc.html', doctors=doctors, search=search, page=page)
 
 
-@app.route('/admin/add_doctor', methods=['GET', 'POST'])
+@route('/admin/add_doctor', methods=['GET', 'POST'])
+@require_role('admin')
 def add_doctor():
-    if 'user_id' not in session or session.get('role') != 'admin':
-        flash('Access denied', 'error')
-        return redirect(url_for('login'))
-
     if request.method == 'POST':
         username = request.form.get('username')
         password = request.form.get('password')
@@ -327,19 +3217,23 @@ def add_doctor():
 
         flash('Doctor added successfully!', 'success')
         return redirect(url_for('view_doc'))
-    departments = Department.query.all()
+    _, departments = directory()
     return render_template('add_doc.html', departments=departments)
 
 
-@app.route('/admin/edit_doctor/<int:doctor_id>', methods=['GET', 'POST'])
+@route('/admin/edit_doctor/<int:doctor_id>', methods=['GET', 'POST'])
+@require_role('admin')
 def edit_doc(doctor_id):
-    if 'user_id' not in session or session.get('role') != 'admin':
-        flash('Access denied', 'error')
-        return redirect(url_for('login'))
-
     doctor = Doctor.query.get_or_404(doctor_id)
 
     if request.method == 'POST':
+        try:
+            weekly = parse_weekly_schedule(request.form.get('weekly_schedule'))
+            exceptions = parse_schedule_exceptions(request.form.get('schedule_exceptions'))
+        except ValueError as e:
+            flash(str(e), 'error')
+            return redirect(url_for('edit_doc', doctor_id=doctor_id))
+
         doctor.user.username = request.form.get('username')
         doctor.user.contact = request.form.get('contact')
 
@@ -349,164 +3243,186 @@ def edit_doc(doctor_id):
 
         doctor.department_id = request.form.get('department_id')
         doctor.availability = request.form.get('availability')
+        doctor.schedule = [
+            DoctorSchedule(weekday=weekday, start_time=start, end_time=end)
+            for weekday, start, end in weekly
+        ]
+        doctor.schedule_exceptions = [
+            ScheduleException(date=day, start_time=start, end_time=end, available=available)
+            for day, start, end, available in exceptions
+        ]
         
         db.session.commit()
 
         flash('Doctor updated successfully!', 'success')
         return redirect(url_for('view_doc'))
 
-    departments = Department.query.all()
-    return render_template('edit_doc.html', doctor=doctor, departments=departments)
-
+    _, departments = directory()
+    return render_template('edit_doc.html', doctor=doctor, departments=departments,
+                           weekly_schedule=format_weekly_schedule(doctor),
+                           schedule_exceptions=format_schedule_exceptions(doctor))
 
 
-@app.route('/admin/delete_doctor/<int:doctor_id>')
+@route('/admin/delete_doctor/<int:doctor_id>')
+@require_role('admin')
 def delete_doc(doctor_id):
-    if 'user_id' not in session or session.get('role') != 'admin':
-        flash('Access denied', 'error')
-        return redirect(url_for('login'))
-
-    doctor = Doctor.query.get_or_404(doctor_id)
+    Doctor.query.get_or_404(doctor_id)
 
-    if Appointment.query.filter_by(doctor_id=doctor_id).count() > 0:
-        flash('Cannot delete doctor with existing appointments!', 'error')
+    if has_booked_appointments('doctor_id', doctor_id):
+        flash('Cannot delete doctor with booked appointments! Please cancel or complete them first.', 'error')
         return redirect(url_for('view_doc'))
 
-    db.session.delete(doctor)
-    db.session.delete(doctor.user)
-    db.session.commit()
+    try:
+        outcome = schedule_deletion('doctor', doctor_id)
+    except Exception as e:
+        db.session.rollback()
+        flash(f'Error deleting doctor: {str(e)}', 'error')
+        return redirect(url_for('view_doc'))
 
-    flash('Doctor deleted successfully!', 'success')
+    flash(DELETION_MESSAGES[outcome].format('Doctor'), 'warning' if outcome == 'running' else 'success')
     return redirect(url_for('view_doc'))
 
 
-@app.route('/admin/appointments')
+@route('/admin/appointments')
+@require_role('admin')
+@read_replica
 def view_appointments():
-    if 'user_id' not in session or session.get('role') != 'admin':
-        flash('Access denied', 'error')
-        return redirect(url_for('login'))
-    
     search = request.args.get('search', '').strip()
     
+    query = appointment_row_select()
     if search:
-        appointments = []
-        
-        
-        patient_appointments = Appointment.query.join(
-            Patient
-        ).join(
-            User, Patient.user_id == User.id
-        ).filter(
-            User.username.ilike(f'%{search}%')
-        ).all()
-        
+        matching_users = user_ids_matching(search)
+        query = query.filter(
+            or_(
+                Patient.user_id.in_(matching_users),
+                Doctor.user_id.in_(matching_users)
+            )
+        )
 
-        doctor_appointments = Appointment.query.join(
-            Doctor
-        ).join(
-            User, Doctor.user_id == User.id
-        ).filter(
-            User.username.ilike(f'%{search}%')
-        ).all()
-        
-        appointments = list(set(patient_appointments + doctor_appointments))
-    else:
-        appointments = Appointment.query.all()
-    
-    return render_template('view_appointments.html', appointments=appointments, search=search)
+    appointments, page = keyset_page(query, Appointment.id, ('appointments', search))
+    return stream_page('view_appointments.html', appointments=appointments, search=search, page=page)
 
 
-@app.route('/admin/treatments')
+@route('/admin/treatments')
+@require_role('admin')
 def view_all_treatments():
-    if 'user_id' not in session or session.get('role') != 'admin':
-        flash('Access denied', 'error')
-        return redirect(url_for('login'))
-    
     search = request.args.get('search', '').strip()
     
+    if search and treatment_fts_available(db.session.connection()):
+        _, _, per_page = page_args()
+        hits, next_cursor, total = search_treatments(search, request.args.get('after'), per_page)
+        hit_ids = [h[0] for h in hits]
+        rows = db.session.execute(db.union_all(*(
+            query.filter(query.selected_columns.id.in_(hit_ids))
+            for query in (treatment_row_select(), treatment_row_select(archived=True)))))
+        by_id = {row.id: row for row in rows}
+        treatments = [by_id[treatment_id] for treatment_id, _ in hits if treatment_id in by_id]
+        page = {'per_page': per_page, 'total': total, 'next_cursor': next_cursor, 'prev_cursor': None}
+        return stream_page('admin_treatments.html', treatments=treatments, search=search,
+                           page=page, snippets=dict(hits))
+
+    # The plain list shows live treatments only; a search also covers the archive.
+    query, key = treatment_row_select(), Treatment.id
     if search:
-        treatments = Treatment.query.join(
-            Appointment
-        ).join(
-            Patient, Appointment.patient_id == Patient.id
-        ).join(
-            User, Patient.user_id == User.id
-        ).filter(
-            or_(
-                User.username.ilike(f'%{search}%'),
-                Treatment.diagnosis.ilike(f'%{search}%'),
-                Treatment.prescription.ilike(f'%{search}%'),
-                Treatment.notes.ilike(f'%{search}%')
+        def matching(query):
+            columns = query.selected_columns
+            return query.filter(
+                or_(
+                    columns.patient.ilike(f'%{search}%'),
+                    columns.diagnosis.ilike(f'%{search}%'),
+                    columns.prescription.ilike(f'%{search}%'),
+                    columns.notes.ilike(f'%{search}%')
+                )
             )
-        ).all()
-    else:
-        treatments = Treatment.query.all()
-    
-    return render_template('admin_treatments.html', treatments=treatments, search=search)
 
+        rows = db.union_all(matching(treatment_row_select()),
+                            matching(treatment_row_select(archived=True))).subquery()
+        query, key = db.select(rows), rows.c.id
 
-@app.route('/admin/patients')
-def view_user():
-    if 'user_id' not in session or session.get('role') != 'admin':
+    treatments, page = keyset_page(query, key, ('treatments', search))
+    return stream_page('admin_treatments.html', treatments=treatments, search=search, page=page)
+
+
+@route('/admin/export/<kind>')
+@require_role('admin')
+def export_records(kind):
+    if kind not in EXPORT_KINDS:
+        abort(404)
+
+    back = url_for('view_appointments' if kind == 'appointments' else 'view_all_treatments')
+    fmt = request.args.get('format', 'csv')
+    if fmt not in ('csv', 'jsonl'):
+        flash('Export format must be csv or jsonl', 'error')
+        return redirect(back)
+    try:
+        filters = export_filters(request.args.get('from'), request.args.get('to'), request.args.get('status'))
+    except ValueError as e:
+        flash(str(e), 'error')
+        return redirect(back)
+
+    chunks = export_chunks(kind, fmt, **filters)
+    filename = f"{kind}.{fmt}"
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    if request.args.get('gzip'):
+        chunks = gzip_chunks(chunks)
+        filename += '.gz'
+        mimetype = 'application/gzip'
+    return Response(stream_with_context(chunks), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+
+@route('/admin/metrics')
+def metrics():
+    if not current_app.config['METRICS_ENABLED']:
+        abort(404)
+    token = current_app.config['METRICS_TOKEN']
+    scraper = token and hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}')
+    if not scraper and (g.user is None or g.user.role != 'admin'):
         flash('Access denied', 'error')
         return redirect(url_for('login'))
-    
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+
+@route('/admin/patients')
+@require_role('admin')
+@read_replica
+def view_user():
     search = request.args.get('search', '').strip()
     
+    query = patient_list_query()
     if search:
-        patients = Patient.query.join(User).filter(
-            User.username.ilike(f'%{search}%')
-        ).all()
-    else:
-        patients = Patient.query.all()
-    
-    return render_template('view_user.html', patients=patients, search=search)
-
+        query = query.filter(
+            Patient.user_id.in_(user_ids_matching(search))
+        )
 
-@app.route('/admin/delete_patient/<int:patient_id>')
-def delete_patient(patient_id):
-    if 'user_id' not in session or session.get('role') != 'admin':
-        flash('Access denied', 'error')
-        return redirect(url_for('login'))
+    patients, page = keyset_page(query, Patient.id, ('patients', search))
+    return render_template('view_user.html', patients=patients, search=search, page=page)
 
-    patient = Patient.query.get_or_404(patient_id)
 
-    # Only check for ACTIVE (Booked) appointments
-    booked_count = Appointment.query.filter_by(
-        patient_id=patient_id,
-        status='Booked'
-    ).count()
+@route('/admin/delete_patient/<int:patient_id>')
+@require_role('admin')
+def delete_patient(patient_id):
+    Patient.query.get_or_404(patient_id)
 
-    if booked_count > 0:
-        flash(f'Cannot delete patient! This patient has {booked_count} booked appointment(s). Please cancel or complete them first.', 'error')
+    # Only ACTIVE (Booked) appointments block the deletion
+    if has_booked_appointments('patient_id', patient_id):
+        flash('Cannot delete patient! This patient has booked appointments. Please cancel or complete them first.', 'error')
         return redirect(url_for('view_user'))
 
-    # Store user reference
-    user = patient.user
-
     try:
-        # Delete ALL appointments first (including completed/cancelled)
-        Appointment.query.filter_by(patient_id=patient_id).delete()
-        
-        # Then delete patient
-        db.session.delete(patient)
-        
-        # Then delete user
-        if user:
-            db.session.delete(user)
-        
-        db.session.commit()
-        flash('Patient and associated records deleted successfully!', 'success')
+        outcome = schedule_deletion('patient', patient_id)
     except Exception as e:
         db.session.rollback()
         flash(f'Error deleting patient: {str(e)}', 'error')
+        return redirect(url_for('view_user'))
 
+    flash(DELETION_MESSAGES[outcome].format('Patient'), 'warning' if outcome == 'running' else 'success')
     return redirect(url_for('view_user'))
 
 
 # ---------------- DOCTOR ROUTES ---------------- #
 
-# @app.route('/doctor/dashboard')
+# @route('/doctor/dashboard')
 # def doc_dashboard():
 #     if 'user_id' not in session or session.get('role') != 'doctor':
 #         flash('Access denied', 'error')
@@ -525,22 +3441,19 @@ def delete_patient(patient_id):
 #                            total_appointments=total_appointments,
 #                            pending=pending, completed=completed)
 
-@app.route('/doctor/dashboard')
+@route('/doctor/dashboard')
+@require_role('doctor')
+@read_replica
 def doc_dashboard():
-    if 'user_id' not in session or session.get('role') != 'doctor':
-        flash('Access denied', 'error')
-        return redirect(url_for('login'))
-
-    doctor = Doctor.query.filter_by(user_id=session['user_id']).first()
-    if not doctor:
-        flash('Doctor profile not found', 'error')
-        return redirect(url_for('login'))
+    doctor = g.doctor
 
     # Appointment counts
-    total_appointments = Appointment.query.filter_by(doctor_id=doctor.id).count()
-    pending = Appointment.query.filter_by(doctor_id=doctor.id, status='Booked').count()
-    completed = Appointment.query.filter_by(doctor_id=doctor.id, status='Completed').count()
-    cancelled = Appointment.query.filter_by(doctor_id=doctor.id, status='Cancelled').count()
+    summary = cached_dashboard(('doctor', doctor.id),
+                               lambda: appointment_summary('doctor_id', doctor.id))
+    total_appointments = summary['total']
+    pending = summary['booked']
+    completed = summary['completed']
+    cancelled = summary['cancelled']
 
     # Calculate percentages for pie chart (FIXED)
     if total_appointments > 0:
@@ -553,13 +3466,13 @@ def doc_dashboard():
         cancelled_percentage = 0
 
     # Treatment success rate
-    completed_appointment_ids = [a.id for a in Appointment.query.filter_by(doctor_id=doctor.id, status='Completed').all()]
-    treatments_given = Treatment.query.filter(Treatment.appointment_id.in_(completed_appointment_ids)).count() if completed_appointment_ids else 0
+    treatments_given = summary['treatments']
     successful_treatments = treatments_given  # Assuming all treatments are successful
     success_rate = round((successful_treatments / completed * 100) if completed > 0 else 0)
 
     return render_template('doc_dashboard.html',
                            doctor=doctor,
+                           data_version=fragment_version(summary),
                            total_appointments=total_appointments,
                            pending=pending,
                            completed=completed,
@@ -571,27 +3484,62 @@ def doc_dashboard():
                            treatments_given=treatments_given,
                            successful_treatments=successful_treatments)
 
-@app.route('/doctor/appointments')
+@route('/doctor/appointments')
+@require_role('doctor')
+@read_replica
 def doc_appointments():
-    if 'user_id' not in session or session.get('role') != 'doctor':
-        flash('Access denied', 'error')
-        return redirect(url_for('login'))
-
-    doctor = Doctor.query.filter_by(user_id=session['user_id']).first()
-    appointments = Appointment.query.filter_by(doctor_id=doctor.id).all()
-    return render_template('doc_appointments.html', appointments=appointments, doctor=doctor)
-
-
-@app.route('/doctor/complete_appointment/<int:appointment_id>')
+    doctor = g.doctor
+    view, first, last = agenda_window(request.args.get('view'), request.args.get('start'))
+    appointments = agenda_appointments(doctor.id, first, last)
+    span = timedelta(days=AGENDA_WINDOWS[view])
+    return render_template('doc_appointments.html', appointments=appointments, doctor=doctor,
+                           view=view, first=first, last=last, windows=AGENDA_WINDOWS,
+                           previous_start=first - span, next_start=first + span,
+                           feed_url=url_for('agenda_feed', token=agenda_feed_token(doctor.id), _external=True))
+
+
+@route('/calendar/<token>.ics')
+@read_replica
+def agenda_feed(token):
+    try:
+        doctor_id = _feed_serializer().loads(token)
+    except BadSignature:
+        abort(404)
+    doctor_name = db.session.query(User.username).join(Doctor, Doctor.user_id == User.id)\
+        .filter(Doctor.id == doctor_id).scalar()
+    if doctor_name is None:
+        abort(404)
+
+    today = datetime.now().date()
+    etag = agenda_etag(doctor_id, doctor_name, today)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    # The cursor is opened here, inside @read_replica, and drained as the
+    # body streams.
+    rows = db.session.execute(
+        db.select(Appointment.id, Appointment.date, Appointment.time, Appointment.status, User.username)
+        .join(Patient, Appointment.patient_id == Patient.id)
+        .join(User, Patient.user_id == User.id)
+        .where(Appointment.doctor_id == doctor_id,
+               Appointment.date.between(today - timedelta(days=current_app.config['AGENDA_FEED_PAST_DAYS']),
+                                        today + timedelta(days=current_app.config['AGENDA_FEED_DAYS'])))
+        .order_by(Appointment.date, Appointment.time)
+        .execution_options(yield_per=500)
+    )
+    response = Response(stream_with_context(agenda_ics(doctor_name, rows, today)), mimetype='text/calendar')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+@route('/doctor/complete_appointment/<int:appointment_id>')
+@require_role('doctor')
 def complete_appointment(appointment_id):
-    if 'user_id' not in session or session.get('role') != 'doctor':
-        flash('Access denied', 'error')
-        return redirect(url_for('login'))
-
-    appointment = Appointment.query.get_or_404(appointment_id)
-    doctor = Doctor.query.filter_by(user_id=session['user_id']).first()
-
-    if appointment.doctor_id != doctor.id:
+    appointment = owned_appointment(appointment_id)
+    if appointment is None:
         flash('Unauthorized access', 'error')
         return redirect(url_for('doc_appointments'))
 
@@ -602,16 +3550,11 @@ def complete_appointment(appointment_id):
     return redirect(url_for('doc_appointments'))
 
 
-@app.route('/doctor/add_treatment/<int:appointment_id>', methods=['GET', 'POST'])
+@route('/doctor/add_treatment/<int:appointment_id>', methods=['GET', 'POST'])
+@require_role('doctor')
 def add_treatment(appointment_id):
-    if 'user_id' not in session or session.get('role') != 'doctor':
-        flash('Access denied', 'error')
-        return redirect(url_for('login'))
-    
-    appointment = Appointment.query.get_or_404(appointment_id)
-    doctor = Doctor.query.filter_by(user_id=session['user_id']).first()
-    
-    if appointment.doctor_id != doctor.id:
+    appointment = owned_appointment(appointment_id, joinedload(Appointment.treatment))
+    if appointment is None:
         flash('Unauthorized access', 'error')
         return redirect(url_for('doc_appointments'))
     
@@ -620,7 +3563,7 @@ def add_treatment(appointment_id):
         return redirect(url_for('doc_appointments'))
     
  
-    existing_treatment = Treatment.query.filter_by(appointment_id=appointment_id).first()
+    existing_treatment = appointment.treatment[0] if appointment.treatment else None
     
     if request.method == 'POST':
         diagnosis = request.form.get('diagnosis')
@@ -650,16 +3593,11 @@ def add_treatment(appointment_id):
 
     return render_template('add_treatment.html', appointment=appointment, treatment=existing_treatment)
 
-@app.route('/doctor/cancel_appointment/<int:appointment_id>')
+@route('/doctor/cancel_appointment/<int:appointment_id>')
+@require_role('doctor')
 def doctor_cancel_appointment(appointment_id):
-    if 'user_id' not in session or session.get('role') != 'doctor':
-        flash('Access denied', 'error')
-        return redirect(url_for('login'))
-
-    appointment = Appointment.query.get_or_404(appointment_id)
-    doctor = Doctor.query.filter_by(user_id=session['user_id']).first()
-
-    if appointment.doctor_id != doctor.id:
+    appointment = owned_appointment(appointment_id)
+    if appointment is None:
         flash('Unauthorized access', 'error')
         return redirect(url_for('doc_appointments'))
 
@@ -674,21 +3612,15 @@ def doctor_cancel_appointment(appointment_id):
     return redirect(url_for('doc_appointments'))
 
 
-
-@app.route('/doctor/edit_treatment/<int:appointment_id>', methods=['GET', 'POST'])
+@route('/doctor/edit_treatment/<int:appointment_id>', methods=['GET', 'POST'])
+@require_role('doctor')
 def edit_treatment(appointment_id):
-    if 'user_id' not in session or session.get('role') != 'doctor':
-        flash('Access denied', 'error')
-        return redirect(url_for('login'))
-    
-    appointment = Appointment.query.get_or_404(appointment_id)
-    doctor = Doctor.query.filter_by(user_id=session['user_id']).first()
-    
-    if appointment.doctor_id != doctor.id:
+    appointment = owned_appointment(appointment_id, joinedload(Appointment.treatment))
+    if appointment is None:
         flash('Unauthorized access', 'error')
         return redirect(url_for('doc_appointments'))
     
-    treatment = Treatment.query.filter_by(appointment_id=appointment_id).first()
+    treatment = appointment.treatment[0] if appointment.treatment else None
     
     if not treatment:
         flash('No treatment record found', 'warning')
@@ -708,32 +3640,30 @@ def edit_treatment(appointment_id):
 
 # ---------------- PATIENT ROUTES ---------------- #
 
-@app.route('/patient/dashboard')
+@route('/patient/dashboard')
+@require_role('patient')
 def user_dashboard():
-    if 'user_id' not in session or session.get('role') != 'patient':
-        flash('Access denied', 'error')
-        return redirect(url_for('login'))
-
-    patient = Patient.query.filter_by(user_id=session['user_id']).first()
+    patient = g.patient
     if not patient:
-        patient = Patient(user_id=session['user_id'])
+        patient = Patient(user_id=g.user.id)
         db.session.add(patient)
         db.session.commit()
 
  
-    total_appointments = Appointment.query.filter_by(patient_id=patient.id).count()
-    upcoming = Appointment.query.filter_by(patient_id=patient.id, status='Booked').count()
-    completed = Appointment.query.filter_by(patient_id=patient.id, status='Completed').count()
+    summary = cached_dashboard(('patient', patient.id),
+                               lambda: appointment_summary('patient_id', patient.id))
+    total_appointments = summary['total']
+    upcoming = summary['booked']
+    completed = summary['completed']
 
     
     completion_rate = round((completed / total_appointments * 100) if total_appointments > 0 else 0)
 
-   
-    completed_appointment_ids = [a.id for a in Appointment.query.filter_by(patient_id=patient.id, status='Completed').all()]
-    treatments_received = Treatment.query.filter(Treatment.appointment_id.in_(completed_appointment_ids)).count() if completed_appointment_ids else 0
+    treatments_received = summary['treatments']
 
     return render_template('user_dashboard.html',
                            patient=patient,
+                           data_version=fragment_version(summary),
                            total_appointments=total_appointments,
                            upcoming=upcoming,
                            completed=completed,
@@ -741,14 +3671,10 @@ def user_dashboard():
                            treatments_received=treatments_received)
 
 
-
-@app.route('/patient/edit_profile', methods=['GET', 'POST'])
+@route('/patient/edit_profile', methods=['GET', 'POST'])
+@require_role('patient')
 def edit_patient_profile():
-    if 'user_id' not in session or session.get('role') != 'patient':
-        flash('Access denied', 'error')
-        return redirect(url_for('login'))
-    
-    patient = Patient.query.filter_by(user_id=session['user_id']).first()
+    patient = g.patient
     
     if not patient:
         flash('Patient profile not found', 'error')
@@ -780,13 +3706,10 @@ def edit_patient_profile():
     return render_template('edit_patient_profile.html', patient=patient)
 
 
-@app.route('/patient/book_appointment', methods=['GET', 'POST'])
+@route('/patient/book_appointment', methods=['GET', 'POST'])
+@require_role('patient')
 def book_appointment():
-    if 'user_id' not in session or session.get('role') != 'patient':
-        flash('Access denied', 'error')
-        return redirect(url_for('login'))
-
-    patient = Patient.query.filter_by(user_id=session['user_id']).first()
+    patient = g.patient
     if not patient:
         flash('Patient profile not found', 'error')
         return redirect(url_for('login'))
@@ -802,7 +3725,9 @@ def book_appointment():
 
    
         try:
+            doctor_id = int(doctor_id)
             appointment_date = datetime.strptime(date, '%Y-%m-%d').date()
+            appointment_time = datetime.strptime(time, '%H:%M').time()
             today = datetime.now().date()
             
             if appointment_date < today:
@@ -811,7 +3736,6 @@ def book_appointment():
             
 
             if appointment_date == today:
-                appointment_time = datetime.strptime(time, '%H:%M').time()
                 current_time = datetime.now().time()
                 if appointment_time < current_time:
                     flash('Cannot book appointments for a time that has already passed!', 'error')
@@ -821,80 +3745,68 @@ def book_appointment():
             flash('Invalid date or time format!', 'error')
             return redirect(url_for('book_appointment'))
 
-        existing = Appointment.query.filter_by(doctor_id=doctor_id, date=date, time=time).first()
-        if existing:
-            flash('This time slot is already booked!', 'warning')
+        if not is_scheduled_slot(doctor_id, appointment_date, appointment_time):
+            flash("That time is outside the doctor's open slots. Please pick one from the list.", 'warning')
             return redirect(url_for('book_appointment'))
 
         try:
-            new_appointment = Appointment(
-                patient_id=patient.id,
-                doctor_id=doctor_id,
-                date=date,
-                time=time,
-                status='Booked'
-            )
-            db.session.add(new_appointment)
-            db.session.commit()
-            flash('Appointment booked successfully!', 'success')
-            return redirect(url_for('user_appointments'))
+            booked = book_slot(patient.id, doctor_id, appointment_date, appointment_time)
         except Exception:
             db.session.rollback()
             flash('Error booking appointment. Please try again.', 'error')
             return redirect(url_for('book_appointment'))
+        if booked is None:
+            flash('This time slot is already booked!', 'warning')
+            return redirect(url_for('book_appointment'))
+        flash('Appointment booked successfully!', 'success')
+        return redirect(url_for('user_appointments'))
 
     search = request.args.get('search', '').strip()
-    query = Doctor.query
-    if search:
-        pattern = f"%{search}%"
-        query = query.join(User).filter(or_(
-            User.username.ilike(pattern),
-            Department.name.ilike(pattern)
-        ))
-
-    doctors = query.all()
+    doctors = search_directory(search)
     return render_template('book_appointment.html', doctors=doctors, search=search)
 
 
-@app.route('/patient/appointments')
+@route('/patient/appointments')
+@require_role('patient')
+@read_replica
 def user_appointments():
-    if 'user_id' not in session or session.get('role') != 'patient':
-        flash('Access denied', 'error')
-        return redirect(url_for('login'))
-
-    patient = Patient.query.filter_by(user_id=session['user_id']).first()
-    appointments = Appointment.query.filter_by(patient_id=patient.id).all()
+    patient = g.patient
+    appointments = appointment_list_query().filter(Appointment.patient_id == patient.id).all()
     return render_template('user_appointments.html', appointments=appointments)
 
 
-@app.route('/patient/treatments')
+@route('/patient/treatments')
+@require_role('patient')
+@read_replica
 def view_treatments():
-    if 'user_id' not in session or session.get('role') != 'patient':
-        flash('Access denied', 'error')
-        return redirect(url_for('login'))
+    patient = g.patient
+    treatments = filter_history(patient_history(patient.id), status='Completed', treated=True)
+    return render_template('view_treatments.html', treatments=treatments)
 
-    patient = Patient.query.filter_by(user_id=session['user_id']).first()
-    appointments = Appointment.query.filter_by(patient_id=patient.id, status='Completed').all()
 
-    treatments_data = []
-    for appointment in appointments:
-        treatment = Treatment.query.filter_by(appointment_id=appointment.id).first()
-        if treatment:
-            treatments_data.append({'appointment': appointment, 'treatment': treatment})
+@route('/patient/history')
+@require_role('patient')
+@read_replica
+def patient_timeline():
+    args = {name: request.args.get(name, '').strip() for name in ('from', 'to', 'status')}
+    try:
+        filters = export_filters(args['from'], args['to'], args['status'])
+    except ValueError as e:
+        flash(str(e), 'error')
+        return redirect(url_for('patient_timeline'))
 
-    return render_template('view_treatments.html', treatments_data=treatments_data)
+    entries = filter_history(patient_history(g.patient.id), **filters)
+    entries, page = history_page(entries)
+    page['filters'] = {name: value for name, value in args.items() if value}
+    return render_template('patient_history.html', entries=entries, page=page,
+                           statuses=APPOINTMENT_STATUSES, **args)
 
 
-@app.route('/patient/cancel_appointment/<int:appointment_id>')
+@route('/patient/cancel_appointment/<int:appointment_id>')
+@require_role('patient')
 def cancel_appointment(appointment_id):
-    if 'user_id' not in session or session.get('role') != 'patient':
-        flash('Access denied', 'error')
-        return redirect(url_for('login'))
-
-    appointment = Appointment.query.get_or_404(appointment_id)
-    patient = Patient.query.filter_by(user_id=session['user_id']).first()
-
-    if appointment.patient_id != patient.id:
+    appointment = owned_appointment(appointment_id)
+    if appointment is None:
         flash('Unauthorized access', 'error')
         return redirect(url_for('user_appointments'))
 
@@ -909,10 +3821,154 @@ def cancel_appointment(appointment_id):
     return redirect(url_for('user_appointments'))
 
 
+# ---------------- API ROUTES ---------------- #
+
+@route('/api/doctors/<int:doctor_id>/slots')
+@require_role()
+def doctor_slots(doctor_id):
+    try:
+        start = datetime.strptime(request.args.get('start', ''), '%Y-%m-%d').date()
+    except ValueError:
+        start = datetime.now().date()
+    try:
+        days = int(request.args.get('days', 1))
+    except ValueError:
+        days = 1
+    days = max(1, min(days, current_app.config['SLOT_MAX_DAYS']))
+
+    if not db.session.get(Doctor, doctor_id):
+        abort(404)
+
+    slots = open_slots(doctor_id, start, days)
+    return jsonify({
+        'doctor_id': doctor_id,
+        'scheduled': doctor_has_schedule(doctor_id),
+        'slot_minutes': current_app.config['SLOT_MINUTES'],
+        'days': [
+            {'date': day.isoformat(), 'slots': [f'{at:%H:%M}' for at in times]}
+            for day, times in slots.items()
+        ],
+    })
+
+
+@route('/api/departments/<int:department_id>/earliest_slots')
+@require_role()
+def department_earliest_slots(department_id):
+    try:
+        start = datetime.strptime(request.args.get('start', ''), '%Y-%m-%d').date()
+    except ValueError:
+        start = datetime.now().date()
+    try:
+        days = int(request.args.get('days', current_app.config['EARLIEST_SLOT_MAX_DAYS']))
+        limit = int(request.args.get('limit', 10))
+    except ValueError:
+        days, limit = current_app.config['EARLIEST_SLOT_MAX_DAYS'], 10
+    days = max(1, min(days, current_app.config['EARLIEST_SLOT_MAX_DAYS']))
+    limit = max(1, min(limit, 100))
+
+    if not db.session.get(Department, department_id):
+        abort(404)
+
+    slots = earliest_department_slots(department_id, start, days, limit)
+    return jsonify({
+        'department_id': department_id,
+        'slots': [
+            {'date': day.isoformat(), 'time': f'{at:%H:%M}', 'doctor_id': doctor_id, 'doctor': username}
+            for day, at, doctor_id, username in slots
+        ],
+    })
+
+
+@route('/api/patients/<int:patient_id>/history')
+@require_role()
+def patient_history_api(patient_id):
+    if not db.session.get(Patient, patient_id):
+        abort(404)
+    if g.user.role == 'patient':
+        allowed = g.patient is not None and g.patient.id == patient_id
+    elif g.user.role == 'doctor':
+        # Visits that have since been archived still count.
+        allowed = db.session.query(or_(*(
+            db.select(model.id).where(model.doctor_id == g.doctor.id, model.patient_id == patient_id).exists()
+            for model in (Appointment, AppointmentArchive)))).scalar()
+    else:
+        allowed = True
+    if not allowed:
+        return jsonify({'error': 'forbidden'}), 403
+
+    try:
+        filters = export_filters(request.args.get('from'), request.args.get('to'), request.args.get('status'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    entries, page = history_page(filter_history(patient_history(patient_id), **filters))
+    return jsonify({
+        'patient_id': patient_id,
+        'page': page,
+        'entries': [
+            dict(entry._asdict(), date=entry.date.isoformat(), time=f'{entry.time:%H:%M}')
+            for entry in entries
+        ],
+    })
+
+# ---------------- APP FACTORY ---------------- #
+
+def reset_process_caches():
+    """Forget every per-process cache and readiness flag (used when switching databases)."""
+    global _fts_ready, _name_index_ready
+    _fts_ready = _name_index_ready = False
+    _dashboard_cache.clear()
+    _history_cache.clear()
+    _fragment_cache.clear()
+    _count_cache.clear()
+    _directory_cache.update(version=None, doctors=(), departments=())
+    _schedule_cache.update(version=None, weekly={}, exceptions={})
+
+
+def create_app(config=None):
+    """Build the app: settings, engines, routes, hooks and CLI commands.
+
+    Nothing connects to the database here; engines open connections on
+    first use and templates compile on first render. Seeding is a
+    separate step ('flask seed').
+    """
+    app = Flask(__name__)
+    app.config.update(default_config())
+    app.config.update(config or {})
+    # Compiled templates are shared through the filesystem, so a new worker
+    # loads bytecode instead of recompiling the dashboards.
+    bytecode_dir = app.config['JINJA_BYTECODE_CACHE_DIR'] or os.path.join(app.instance_path, 'jinja-cache')
+    os.makedirs(bytecode_dir, exist_ok=True)
+    app.jinja_options = {**app.jinja_options,
+                         'bytecode_cache': FileSystemBytecodeCache(bytecode_dir),
+                         'extensions': [FragmentCacheExtension]}
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS',
+                          engine_options(app.config, app.config['SQLALCHEMY_DATABASE_URI']))
+    replica_url = app.config['DATABASE_REPLICA_URL']
+    if replica_url:
+        app.config.setdefault('SQLALCHEMY_BINDS', {
+            'replica': dict(engine_options(app.config, replica_url), url=replica_url)})
+
+    db.init_app(app)
+    with app.app_context():
+        for key, engine in db.engines.items():
+            install_sqlite_pragmas(engine, app.config['SQLITE_PRAGMAS'], read_only=key == 'replica')
+    if app.config['METRICS_ENABLED']:
+        install_metrics(app)  # first, so its before_request timing covers the others
+    if app.config['ADMISSION_ENABLED']:
+        install_admission(app)  # before the principal is loaded, so rejections cost no query
+
+    for rule, view, options in _routes:
+        app.add_url_rule(rule, view_func=view, **options)
+    for hook in _before_request:
+        app.before_request(hook)
+    for command in commands.commands.values():
+        app.cli.add_command(command)
+    return app
+
 
 if __name__ == '__main__':
+    app = create_app()
     with app.app_context():
-        db.create_all()
-        create_auto_admin()
-        create_departments()  
+        seed_database()
     app.run(debug=True)
@@ -0,0 +1,660 @@
+"""Development commands: synthetic data, benchmarks and load tests.
+
+None of these are registered on the production app. The create_app()
+below builds the normal app and adds them, so they run as e.g.
+
+    flask --app devtools generate-data
+    flask --app devtools bench-routes --scales 1,10
+"""
+import click
+import itertools
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime, timedelta
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import create_engine, event, func, text
+from sqlalchemy.orm import Session
+
+import app as hospital
+from app import (
+    Appointment, AppointmentArchive, Department, Doctor, DoctorSchedule, Patient, Treatment, User,
+    _admission_rejections, _metrics_lock, _write_name_index, agenda_feed_token, book_slot, bump_cache_version, db,
+    default_config, earliest_department_slots, ensure_name_index, install_sqlite_pragmas, mask_times, open_slot_masks,
+    rebuild_counters, rebuild_name_index, rebuild_treatment_fts, reset_process_caches, seed_database,
+    slot_mask, slot_time, treatment_fts_available, user_ids_matching,
+)
+
+dev_commands = AppGroup('hospital-dev')
+
+# ---------------- SYNTHETIC DATA ---------------- #
+# generate_hospital_data() fills a database with a deterministic synthetic
+# hospital (same seed, same rows relative to today).
+
+NAME_SYLLABLES = ['an', 'bel', 'car', 'dor', 'el', 'fin', 'gar', 'hal', 'is', 'jo', 'ka', 'lin',
+                  'mar', 'nor', 'os', 'per', 'ra', 'sam', 'tor', 'ul', 'vin', 'wil', 'yan', 'zo']
+DIAGNOSES = ['Hypertension', 'Migraine', 'Influenza', 'Fracture', 'Asthma', 'Diabetes type 2',
+             'Bronchitis', 'Sprained ankle', 'Dermatitis', 'Anemia']
+PRESCRIPTIONS = ['Rest and fluids', 'Paracetamol 500mg', 'Ibuprofen 400mg', 'Amoxicillin 500mg',
+                 'Physiotherapy', 'Inhaler twice daily', 'Metformin 500mg', 'Iron supplements']
+BENCH_PASSWORD = 'password'
+
+
+def _synthetic_name(rng, prefix, n):
+    return prefix + ''.join(rng.choice(NAME_SYLLABLES) for _ in range(rng.randint(2, 3))) + str(n)
+
+
+def generate_hospital_data(doctors=20, patients=200, appointments=2000, treatment_ratio=0.9,
+                           seed=42, past_days=180, future_days=60):
+    """Insert synthetic doctors, patients, appointments and treatments; returns the counts.
+
+    Past appointments are mostly Completed (some Cancelled or still
+    Booked), future ones mostly Booked. Half the doctors get Mon-Fri
+    09:00-17:00 schedules. Derived tables (counters, search indexes,
+    directory version) are rebuilt at the end.
+    """
+    rng = random.Random(seed)
+    connection = db.session.connection()
+    department_ids = [row[0] for row in connection.execute(db.select(Department.id).order_by(Department.id))]
+    if not department_ids:
+        raise ValueError('No departments: run seed_database() first')
+
+    first_user = (connection.execute(db.select(func.max(User.id))).scalar() or 0) + 1
+    first_doctor = (connection.execute(db.select(func.max(Doctor.id))).scalar() or 0) + 1
+    first_patient = (connection.execute(db.select(func.max(Patient.id))).scalar() or 0) + 1
+    users = []
+    for n in range(doctors):
+        users.append({'id': first_user + n, 'username': _synthetic_name(rng, 'dr_', first_doctor + n),
+                      'password': BENCH_PASSWORD, 'role': 'doctor', 'contact': f'555-{n:04d}'})
+    for n in range(patients):
+        users.append({'id': first_user + doctors + n, 'username': _synthetic_name(rng, '', first_patient + n),
+                      'password': BENCH_PASSWORD, 'role': 'patient', 'contact': f'555-{n:04d}'})
+    for chunk in range(0, len(users), 5000):
+        connection.execute(User.__table__.insert(), users[chunk:chunk + 5000])
+
+    doctor_ids = [first_doctor + n for n in range(doctors)]
+    patient_ids = [first_patient + n for n in range(patients)]
+    connection.execute(Doctor.__table__.insert(), [
+        {'id': doctor_id, 'user_id': first_user + n, 'department_id': rng.choice(department_ids),
+         'availability': 'Mon-Fri 9AM-5PM'} for n, doctor_id in enumerate(doctor_ids)])
+    connection.execute(Patient.__table__.insert(), [
+        {'id': patient_id, 'user_id': first_user + doctors + n, 'contact_info': f'{n} Main Street'}
+        for n, patient_id in enumerate(patient_ids)])
+    opens, closes = datetime.strptime('09:00', '%H:%M').time(), datetime.strptime('17:00', '%H:%M').time()
+    connection.execute(DoctorSchedule.__table__.insert(), [
+        {'doctor_id': doctor_id, 'weekday': weekday, 'start_time': opens, 'end_time': closes}
+        for doctor_id in doctor_ids[::2] for weekday in range(5)])
+
+    today = datetime.now().date()
+    slot_times = mask_times(slot_mask(opens, closes))
+    capacity = doctors * (past_days + future_days) * len(slot_times)
+    appointments = min(appointments, capacity)
+    taken = set()
+    rows = []
+    while len(rows) < appointments:
+        doctor_id = rng.choice(doctor_ids)
+        day = today + timedelta(days=rng.randint(-past_days, future_days - 1))
+        at = rng.choice(slot_times)
+        if (doctor_id, day, at) in taken:
+            continue
+        taken.add((doctor_id, day, at))
+        roll = rng.random()
+        if day < today:
+            status = 'Completed' if roll < 0.8 else 'Cancelled' if roll < 0.95 else 'Booked'
+        else:
+            status = 'Booked' if roll < 0.9 else 'Cancelled'
+        rows.append({'patient_id': rng.choice(patient_ids), 'doctor_id': doctor_id, 'date': day, 'time': at,
+                     'status': status})
+    first_appointment = max(connection.execute(db.select(func.max(model.id))).scalar() or 0
+                            for model in (Appointment, AppointmentArchive)) + 1
+    for n, row in enumerate(rows):
+        row['id'] = first_appointment + n
+    for chunk in range(0, len(rows), 5000):
+        connection.execute(Appointment.__table__.insert(), rows[chunk:chunk + 5000])
+
+    treatments = [
+        {'appointment_id': row['id'], 'diagnosis': rng.choice(DIAGNOSES),
+         'prescription': rng.choice(PRESCRIPTIONS), 'notes': f'Follow up in {rng.randint(1, 8)} weeks'}
+        for row in rows if row['status'] == 'Completed' and rng.random() < treatment_ratio
+    ]
+    for chunk in range(0, len(treatments), 5000):
+        connection.execute(Treatment.__table__.insert(), treatments[chunk:chunk + 5000])
+    bump_cache_version(connection, 'directory')
+    bump_cache_version(connection, 'agenda')
+    bump_cache_version(connection, 'schedule')
+    db.session.commit()
+
+    rebuild_counters()
+    rebuild_name_index()
+    if treatment_fts_available(db.session.connection()):
+        rebuild_treatment_fts()
+    return {'doctors': doctors, 'patients': patients, 'appointments': len(rows), 'treatments': len(treatments)}
+
+
+@dev_commands.command('generate-data')
+@click.option('--doctors', default=20)
+@click.option('--patients', default=200)
+@click.option('--appointments', default=2000)
+@click.option('--treatment-ratio', default=0.9, help='Share of completed appointments with a treatment.')
+@click.option('--seed', default=42)
+def generate_data_command(doctors, patients, appointments, treatment_ratio, seed):
+    """Add a deterministic synthetic hospital to the configured database."""
+    seed_database()
+    counts = generate_hospital_data(doctors, patients, appointments, treatment_ratio, seed)
+    print(', '.join(f'{count} {name}' for name, count in counts.items()))
+
+
+# ---------------- SEARCH & SLOT BENCHMARKS ---------------- #
+# Timings for the indexed name search and the department slot search.
+
+@dev_commands.command('bench-name-search')
+@click.option('--users', default=100000, help='Synthetic users to add for the run.')
+@click.option('--repeat', default=20, help='Timed runs per search term.')
+def bench_name_search_command(users, repeat):
+    """Compare indexed name search against the old ILIKE scan.
+
+    The synthetic users are inserted in a savepoint that is rolled back at
+    the end, so the database is left as it was.
+    """
+    ensure_name_index()
+    rng = random.Random(42)
+
+    connection = db.session.connection()
+    savepoint = connection.begin_nested()
+    try:
+        first_id = (db.session.query(func.max(User.id)).scalar() or 0) + 1
+        batch = []
+        for offset in range(users):
+            name = ''.join(rng.choice(NAME_SYLLABLES) for _ in range(rng.randint(2, 4)))
+            batch.append({'id': first_id + offset, 'username': f'bench_{name}{offset}',
+                          'password': 'x', 'role': 'patient'})
+            if len(batch) == 5000 or offset == users - 1:
+                connection.execute(User.__table__.insert(), batch)
+                _write_name_index(connection, [(row['id'], row['username']) for row in batch])
+                batch = []
+
+        print(f"{'term':<12}{'ilike rows':>12}{'ilike ms':>10}{'index rows':>12}{'index ms':>10}")
+        for term in ['ma', 'bel', 'dorel', 'rasam', 'zz9', 'bench_wil']:
+            results = []
+            for query in (
+                db.session.query(User.id).filter(User.username.ilike(f'%{term}%')),
+                db.session.query(User.id).filter(User.id.in_(user_ids_matching(term))),
+            ):
+                started = time.perf_counter()
+                for _ in range(repeat):
+                    matches = len(query.all())
+                results.append((matches, (time.perf_counter() - started) * 1000 / repeat))
+            (ilike_rows, ilike_ms), (index_rows, index_ms) = results
+            print(f"{term:<12}{ilike_rows:>12}{ilike_ms:>10.2f}{index_rows:>12}{index_ms:>10.2f}")
+    finally:
+        savepoint.rollback()
+        db.session.rollback()
+
+
+@dev_commands.command('bench-earliest-slots')
+@click.option('--doctors', default=300, help='Doctors in the synthetic department.')
+@click.option('--days', default=90, help='Search horizon in days.')
+@click.option('--fill', default=0.8, help='Share of scheduled weekday slots already booked.')
+@click.option('--limit', default=10, help='Slots to return.')
+@click.option('--repeat', default=20, help='Timed runs.')
+def bench_earliest_slots_command(doctors, days, fill, limit, repeat):
+    """Time the department earliest-slot search on a synthetic department.
+
+    Everything is inserted in a savepoint that is rolled back at the end.
+    """
+    rng = random.Random(42)
+    connection = db.session.connection()
+    savepoint = connection.begin_nested()
+    try:
+        start = datetime.now().date() + timedelta(days=1)
+        department_id = connection.execute(Department.__table__.insert().values(
+            name=f'Bench department {rng.random()}')).inserted_primary_key[0]
+        first_user = (db.session.query(func.max(User.id)).scalar() or 0) + 1
+        first_doctor = (db.session.query(func.max(Doctor.id)).scalar() or 0) + 1
+        users = [{'id': first_user + n, 'username': f'bench_doctor_{first_user + n}', 'password': 'x',
+                  'role': 'doctor'} for n in range(doctors + 1)]
+        connection.execute(User.__table__.insert(), users)
+        patient_id = connection.execute(Patient.__table__.insert().values(
+            user_id=first_user + doctors)).inserted_primary_key[0]
+        doctor_ids = [first_doctor + n for n in range(doctors)]
+        connection.execute(Doctor.__table__.insert(), [
+            {'id': doctor_id, 'user_id': first_user + n, 'department_id': department_id}
+            for n, doctor_id in enumerate(doctor_ids)])
+
+        opens, closes = datetime.strptime('09:00', '%H:%M').time(), datetime.strptime('17:00', '%H:%M').time()
+        connection.execute(DoctorSchedule.__table__.insert(), [
+            {'doctor_id': doctor_id, 'weekday': weekday, 'start_time': opens, 'end_time': closes}
+            for doctor_id in doctor_ids for weekday in range(5)])
+
+        slot_times = mask_times(slot_mask(opens, closes))
+        booked = []
+        for offset in range(days):
+            day = start + timedelta(days=offset)
+            if day.weekday() >= 5:
+                continue
+            for doctor_id in doctor_ids:
+                booked.extend({'patient_id': patient_id, 'doctor_id': doctor_id, 'date': day, 'time': at,
+                               'status': 'Booked'} for at in slot_times if rng.random() < fill)
+        for chunk in range(0, len(booked), 20000):
+            connection.execute(Appointment.__table__.insert(), booked[chunk:chunk + 20000])
+        print(f"{doctors} doctors, {days} days, {len(booked)} booked appointments")
+
+        for label, run in (
+            (f'earliest {limit}', lambda: earliest_department_slots(department_id, start, days, limit)),
+            ('full horizon bitmaps', lambda: open_slot_masks(doctor_ids, start, days)),
+        ):
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                run()
+                timings.append((time.perf_counter() - started) * 1000)
+            timings.sort()
+            print(f"{label:<22} p50 {timings[len(timings) // 2]:8.2f} ms   max {timings[-1]:8.2f} ms")
+    finally:
+        savepoint.rollback()
+        db.session.rollback()
+
+
+# ---------------- LOAD TESTS ---------------- #
+# Concurrent booking, straight through book_slot() and through the routes.
+
+@dev_commands.command('load-test-booking')
+@click.option('--threads', default=8, help='Concurrent booking threads.')
+@click.option('--attempts', default=250, help='Booking attempts per thread.')
+@click.option('--slots', default=200, help='Distinct (doctor, date, time) slots competed for.')
+@click.option('--path', default=None, help='SQLite file to use (default: a temporary file).')
+def load_test_booking_command(threads, attempts, slots, path):
+    """Hammer book_slot() from several threads on a SQLite/WAL database.
+
+    Runs against a scratch database, never the app's own, and checks
+    afterwards that no slot was booked twice.
+    """
+    workdir = None
+    if path is None:
+        workdir = tempfile.mkdtemp(prefix='booking-load-')
+        path = os.path.join(workdir, 'load.db')
+    engine = create_engine(f'sqlite:///{path}', connect_args={'timeout': 30, 'check_same_thread': False})
+    install_sqlite_pragmas(engine, current_app.config['SQLITE_PRAGMAS'])
+
+    try:
+        db.metadata.create_all(engine)
+        with engine.begin() as connection:
+            department_id = connection.execute(Department.__table__.insert().values(
+                name='Load test')).inserted_primary_key[0]
+            connection.execute(User.__table__.insert(), [
+                {'id': n, 'username': f'load_user_{n}', 'password': 'x',
+                 'role': 'doctor' if n <= 10 else 'patient'} for n in range(1, 11 + threads)])
+            connection.execute(Doctor.__table__.insert(), [
+                {'id': n, 'user_id': n, 'department_id': department_id} for n in range(1, 11)])
+            connection.execute(Patient.__table__.insert(), [
+                {'id': n, 'user_id': 10 + n} for n in range(1, threads + 1)])
+
+        first_day = datetime.now().date() + timedelta(days=1)
+        pool = [(1 + n % 10, first_day + timedelta(days=n // 160), slot_time(18 + n // 10 % 16))
+                for n in range(slots)]
+        outcomes = Counter()
+        lock = threading.Lock()
+        start_line = threading.Barrier(threads)
+
+        def worker(patient_id):
+            rng = random.Random(patient_id)
+            local = Counter()
+            with Session(engine) as worker_session:
+                start_line.wait()
+                for _ in range(attempts):
+                    doctor_id, day, at = rng.choice(pool)
+                    try:
+                        booked = book_slot(patient_id, doctor_id, day, at, session=worker_session)
+                        local['booked' if booked else 'taken'] += 1
+                    except Exception as error:
+                        worker_session.rollback()
+                        local[type(error).__name__] += 1
+            with lock:
+                outcomes.update(local)
+
+        workers = [threading.Thread(target=worker, args=(n,)) for n in range(1, threads + 1)]
+        started = time.perf_counter()
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        with engine.connect() as connection:
+            rows = connection.execute(text('SELECT count(*) FROM appointment')).scalar()
+            doubles = connection.execute(text(
+                'SELECT count(*) FROM (SELECT 1 FROM appointment GROUP BY doctor_id, date, time '
+                'HAVING count(*) > 1)')).scalar()
+            mode = connection.execute(text('PRAGMA journal_mode')).scalar()
+
+        total = threads * attempts
+        print(f"{threads} threads x {attempts} attempts on {slots} slots ({mode} journal)")
+        print(f"outcomes: {dict(outcomes)}")
+        print(f"{total / elapsed:.0f} attempts/s, {outcomes['booked'] / elapsed:.0f} bookings/s over {elapsed:.2f} s")
+        print(f"rows {rows}, double-booked slots {doubles}")
+        if doubles or rows != outcomes['booked']:
+            raise click.ClickException('booking outcomes do not match the stored appointments')
+    finally:
+        engine.dispose()
+        if workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+@dev_commands.command('load-test-admission')
+@click.option('--threads', default=32, help='Concurrent client threads.')
+@click.option('--requests', 'requests_per_thread', default=20, help='Booking posts per thread.')
+@click.option('--patients', default=320, help='Distinct logged-in patients sharing the threads.')
+@click.option('--backend', default='memory', help="ADMISSION_BACKEND for the second run, e.g. sqlite:/tmp/buckets.db.")
+@click.option('--doctor-rate', default=1000.0,
+              help='Booking posts per second allowed at the doctor (burst twice that); '
+                   'high by default so the run measures the concurrency limit.')
+@click.option('--seed', default=7)
+def load_test_admission_command(threads, requests_per_thread, patients, backend, doctor_rate, seed):
+    """Surge booking posts at one doctor, with admission control off and then on.
+
+    Runs on a scratch database and prints status counts and latency
+    percentiles for both runs, so the tail under overload can be compared.
+    The default per-doctor rate would turn away nearly the whole surge, so
+    the run uses --doctor-rate instead.
+    """
+    rules = {endpoint: dict(rule) for endpoint, rule in default_config()['ADMISSION_RULES'].items()}
+    rules['book_appointment']['doctor_rate'] = (doctor_rate, doctor_rate * 2)
+    workdir = tempfile.mkdtemp(prefix='admission-load-')
+    uri = f"sqlite:///{os.path.join(workdir, 'load.db')}"
+    print(f"{threads} threads x {requests_per_thread} booking posts, {patients} patients, one doctor")
+    print(f"{'admission':<11}{'processed':>10}{'429':>6}{'other':>7}{'req/s':>8}"
+          f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}{'p99 ok ms':>11}")
+    try:
+        for run, enabled in enumerate((False, True)):
+            load_app = create_app({'SQLALCHEMY_DATABASE_URI': uri, 'METRICS_ENABLED': False,
+                                   'ADMISSION_ENABLED': enabled, 'ADMISSION_BACKEND': backend,
+                                   'ADMISSION_RULES': rules})
+            with load_app.app_context():
+                reset_process_caches()
+                if run == 0:
+                    seed_database()
+                    generate_hospital_data(doctors=4, patients=patients, appointments=0, seed=seed)
+                doctor_id = db.session.query(Doctor.id).filter(~Doctor.schedule.any()).limit(1).scalar()
+                usernames = [name for name, in db.session.query(User.username).filter_by(role='patient')
+                             .order_by(User.id).limit(patients)]
+                times = [slot_time(n).strftime('%H:%M') for n in range(48)]
+                db.session.remove()
+
+            clients = []
+            for username in usernames:
+                client = load_app.test_client()
+                client.post('/login', data={'username': username, 'password': BENCH_PASSWORD})
+                clients.append(client)
+
+            first_day = datetime.now().date() + timedelta(days=1 + run * 60)
+            results = []
+            lock = threading.Lock()
+            start_line = threading.Barrier(threads)
+            with _metrics_lock:
+                _admission_rejections.clear()
+
+            def worker(number):
+                rng = random.Random(seed * 1000 + number)
+                mine = clients[number::threads]
+                local = []
+                start_line.wait()
+                for n in range(requests_per_thread):
+                    form = {'doctor_id': doctor_id,
+                            'date': (first_day + timedelta(days=rng.randrange(30))).isoformat(),
+                            'time': rng.choice(times)}
+                    started = time.perf_counter()
+                    response = mine[n % len(mine)].post('/patient/book_appointment', data=form)
+                    response.get_data()
+                    local.append((response.status_code, (time.perf_counter() - started) * 1000))
+                with lock:
+                    results.extend(local)
+
+            workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+            started = time.perf_counter()
+            for thread in workers:
+                thread.start()
+            for thread in workers:
+                thread.join()
+            elapsed = time.perf_counter() - started
+
+            statuses = Counter(status for status, _ in results)
+            timings = [ms for _, ms in results]
+            processed = [ms for status, ms in results if status == 302]
+            p99_ok = f"{_percentile(processed, 0.99):>11.1f}" if processed else f"{'-':>11}"
+            print(f"{'on' if enabled else 'off':<11}{statuses[302]:>10}{statuses[429]:>6}"
+                  f"{len(results) - statuses[302] - statuses[429]:>7}{len(results) / elapsed:>8.0f}"
+                  f"{_percentile(timings, 0.5):>9.1f}{_percentile(timings, 0.95):>9.1f}"
+                  f"{_percentile(timings, 0.99):>9.1f}{max(timings):>9.1f}{p99_ok}")
+            if _admission_rejections:
+                print(' ' * 11 + '429 by reason: ' + ', '.join(
+                    f'{reason} {count}' for (_, reason), count in sorted(_admission_rejections.items())))
+            with load_app.app_context():
+                db.engine.dispose()
+            reset_process_caches()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+# ---------------- ROUTE & STARTUP BENCHMARKS ---------------- #
+# 'flask bench-routes' builds one scratch SQLite database per scale, drives
+# the routes through the test client as each role and compares the results
+# with a baseline. 'flask bench-startup' times fresh worker processes.
+
+# (role, name, method, url). Urls are formatted with the ids picked by
+# _bench_ids(); state-changing GET routes (complete, cancel, delete) are left out.
+BENCH_ROUTES = [
+    ('admin', 'admin_dashboard', 'GET', '/admin/dashboard'),
+    ('admin', 'view_doc', 'GET', '/admin/doctors'),
+    ('admin', 'view_doc search', 'GET', '/admin/doctors?search=an'),
+    ('admin', 'add_doctor', 'GET', '/admin/add_doctor'),
+    ('admin', 'edit_doc', 'GET', '/admin/edit_doctor/{doctor_id}'),
+    ('admin', 'view_appointments', 'GET', '/admin/appointments'),
+    ('admin', 'view_appointments search', 'GET', '/admin/appointments?search=mar'),
+    ('admin', 'view_all_treatments', 'GET', '/admin/treatments'),
+    ('admin', 'view_all_treatments search', 'GET', '/admin/treatments?search=migraine'),
+    ('admin', 'view_user', 'GET', '/admin/patients'),
+    ('admin', 'view_user search', 'GET', '/admin/patients?search=el'),
+    ('doctor', 'doc_dashboard', 'GET', '/doctor/dashboard'),
+    ('doctor', 'doc_appointments', 'GET', '/doctor/appointments'),
+    ('doctor', 'doc_appointments month', 'GET', '/doctor/appointments?view=month'),
+    ('doctor', 'agenda_feed', 'GET', '/calendar/{feed_token}.ics'),
+    ('doctor', 'add_treatment', 'GET', '/doctor/add_treatment/{completed_id}'),
+    ('patient', 'user_dashboard', 'GET', '/patient/dashboard'),
+    ('patient', 'user_appointments', 'GET', '/patient/appointments'),
+    ('patient', 'view_treatments', 'GET', '/patient/treatments'),
+    ('patient', 'patient_timeline', 'GET', '/patient/history'),
+    ('patient', 'patient_history_api', 'GET', '/api/patients/{patient_id}/history'),
+    ('patient', 'edit_patient_profile', 'GET', '/patient/edit_profile'),
+    ('patient', 'book_appointment', 'GET', '/patient/book_appointment'),
+    ('patient', 'book_appointment search', 'GET', '/patient/book_appointment?search=card'),
+    ('patient', 'book_appointment POST', 'POST', '/patient/book_appointment'),
+    ('patient', 'doctor_slots', 'GET', '/api/doctors/{doctor_id}/slots?days=7'),
+    ('patient', 'department_earliest_slots', 'GET', '/api/departments/{department_id}/earliest_slots'),
+]
+
+
+def _bench_ids():
+    doctor_id = db.session.query(Appointment.doctor_id).group_by(Appointment.doctor_id)\
+        .order_by(func.count().desc()).limit(1).scalar()
+    patient_id = db.session.query(Appointment.patient_id).group_by(Appointment.patient_id)\
+        .order_by(func.count().desc()).limit(1).scalar()
+    doctor = db.session.get(Doctor, doctor_id)
+    patient = db.session.get(Patient, patient_id)
+    completed_id = db.session.query(Appointment.id).filter_by(doctor_id=doctor_id, status='Completed')\
+        .limit(1).scalar()
+    return {
+        'doctor_id': doctor_id, 'department_id': doctor.department_id, 'completed_id': completed_id,
+        'patient_id': patient_id, 'feed_token': agenda_feed_token(doctor_id),
+        'doctor_username': doctor.user.username, 'patient_username': patient.user.username,
+        'booking_doctor_id': db.session.query(Doctor.id).filter(~Doctor.schedule.any()).limit(1).scalar(),
+    }
+
+
+def _percentile(values, share):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+
+def bench_routes(client, ids, requests, queries):
+    """Time every BENCH_ROUTES entry; returns {name: {p50_ms, p95_ms, queries, peak_kib, status}}."""
+    logins = {'admin': ('Admin', '@dmin123'), 'doctor': (ids['doctor_username'], BENCH_PASSWORD),
+              'patient': (ids['patient_username'], BENCH_PASSWORD)}
+    booking_day = datetime.now().date() + timedelta(days=365)
+    booking = itertools.count()
+    results = {}
+    current_role = None
+    for role, name, method, url in BENCH_ROUTES:
+        if role != current_role:
+            client.get('/logout')
+            username, password = logins[role]
+            client.post('/login', data={'username': username, 'password': password})
+            current_role = role
+        url = url.format(**ids)
+
+        def call():
+            if method == 'POST':
+                n = next(booking)
+                response = client.post(url, data={
+                    'doctor_id': ids['booking_doctor_id'], 'date': (booking_day + timedelta(days=n // 48)).isoformat(),
+                    'time': slot_time(n % 48).strftime('%H:%M')})
+            else:
+                response = client.get(url)
+            response.get_data()  # streamed pages render while the body is read
+            return response
+
+        status = call().status_code  # warm-up
+        timings = []
+        for _ in range(requests):
+            started = time.perf_counter()
+            call()
+            timings.append((time.perf_counter() - started) * 1000)
+        queries.clear()
+        call()
+        per_request = len(queries)
+        tracemalloc.start()
+        call()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results[name] = {'p50_ms': round(_percentile(timings, 0.5), 3), 'p95_ms': round(_percentile(timings, 0.95), 3),
+                         'queries': per_request, 'peak_kib': round(peak / 1024, 1), 'status': status}
+    return results
+
+
+@dev_commands.command('bench-routes')
+@click.option('--scales', default='1,10', help='Comma-separated multipliers of the base data size.')
+@click.option('--doctors', default=20, help='Doctors at scale 1.')
+@click.option('--patients', default=200, help='Patients at scale 1.')
+@click.option('--appointments', default=2000, help='Appointments at scale 1.')
+@click.option('--requests', 'requests_per_route', default=30, help='Timed requests per route.')
+@click.option('--seed', default=42)
+@click.option('--baseline', type=click.Path(dir_okay=False), default='bench-baseline.json',
+              help='Baseline JSON to compare with.')
+@click.option('--save-baseline', is_flag=True, help='Write these results as the new baseline.')
+@click.option('--tolerance', default=0.2, help='Slowdown (fraction of p50) reported as a regression.')
+def bench_routes_command(scales, doctors, patients, appointments, requests_per_route, seed, baseline,
+                         save_baseline, tolerance):
+    """Benchmark every route per role at several data scales."""
+    previous = {}
+    if os.path.exists(baseline):
+        with open(baseline) as f:
+            previous = json.load(f)
+
+    report = {}
+    workdir = tempfile.mkdtemp(prefix='hospital-bench-')
+    try:
+        for scale in [int(value) for value in scales.split(',')]:
+            path = os.path.join(workdir, f'scale-{scale}.db')
+            bench_app = create_app({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{path}', 'METRICS_ENABLED': False,
+                                    'ADMISSION_ENABLED': False})
+            with bench_app.app_context():
+                reset_process_caches()
+                seed_database()
+                counts = generate_hospital_data(doctors * scale, patients * scale, appointments * scale,
+                                                seed=seed)
+                ids = _bench_ids()
+                queries = []
+                event.listen(db.engine, 'before_cursor_execute', lambda *args: queries.append(1))
+                results = bench_routes(bench_app.test_client(), ids, requests_per_route, queries)
+                db.session.remove()
+                db.engine.dispose()
+            reset_process_caches()
+            report[str(scale)] = results
+
+            print(f"\nscale {scale}: " + ', '.join(f'{count} {name}' for name, count in counts.items()))
+            print(f"{'route':<30}{'p50 ms':>9}{'p95 ms':>9}{'queries':>9}{'peak KiB':>10}  vs baseline")
+            for name, row in results.items():
+                old = previous.get(str(scale), {}).get(name)
+                note = '' if row['status'] < 400 else f"status {row['status']}"
+                if old:
+                    change = (row['p50_ms'] - old['p50_ms']) / old['p50_ms'] if old['p50_ms'] else 0
+                    note += f"p50 {change:+.0%}"
+                    if row['queries'] != old['queries']:
+                        note += f", queries {old['queries']} -> {row['queries']}"
+                    if change > tolerance:
+                        note += '  REGRESSION'
+                print(f"{name:<30}{row['p50_ms']:>9.2f}{row['p95_ms']:>9.2f}{row['queries']:>9}"
+                      f"{row['peak_kib']:>10.1f}  {note}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if save_baseline:
+        with open(baseline, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print(f"\nSaved baseline to {baseline}")
+
+
+@dev_commands.command('bench-startup')
+@click.option('--workers', default=4, help='Worker processes started at the same time.')
+@click.option('--url', default='/login', help='Path of the first request.')
+def bench_startup_command(workers, url):
+    """Time import-to-first-response for N fresh worker processes.
+
+    Each worker is a new interpreter that imports this module, calls
+    create_app() and serves one request through the test client, like a
+    pre-fork server worker booting.
+    """
+    script = (
+        "import sys, time; started = time.perf_counter(); "
+        f"sys.path.insert(0, {os.path.dirname(os.path.abspath(__file__))!r}); "
+        "import app as module; imported = time.perf_counter(); "
+        "flask_app = module.create_app(); created = time.perf_counter(); "
+        f"response = flask_app.test_client().get({url!r}); "
+        "done = time.perf_counter(); "
+        "print(response.status_code, imported - started, created - imported, done - created)"
+    )
+    started = time.perf_counter()
+    processes = [subprocess.Popen([sys.executable, '-c', script], stdout=subprocess.PIPE, text=True)
+                 for _ in range(workers)]
+    results = []
+    for process in processes:
+        out, _ = process.communicate()
+        if process.returncode:
+            raise click.ClickException('a worker failed to start')
+        status, *timings = out.split()
+        results.append((int(status), *(float(value) * 1000 for value in timings)))
+    wall = (time.perf_counter() - started) * 1000
+
+    print(f"{'worker':<8}{'status':>8}{'import ms':>12}{'create ms':>12}{'first req ms':>14}{'total ms':>12}")
+    for n, (status, imported, created, first) in enumerate(results, 1):
+        print(f"{n:<8}{status:>8}{imported:>12.1f}{created:>12.1f}{first:>14.1f}{imported + created + first:>12.1f}")
+    totals = sorted(sum(timings) for _, *timings in results)
+    print(f"p50 {totals[len(totals) // 2]:.1f} ms, max {totals[-1]:.1f} ms, all {workers} ready in {wall:.1f} ms")
+
+
+# ---------------- APP FACTORY ---------------- #
+
+def create_app(config=None):
+    """The production app with the development commands added."""
+    app = hospital.create_app(config)
+    for command in dev_commands.commands.values():
+        app.cli.add_command(command)
+    return app
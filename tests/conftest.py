@@ -0,0 +1,57 @@
+"""Shared fixtures: a seeded app on a scratch SQLite database, and row factories."""
+import os
+import sys
+from datetime import datetime
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as hospital  # noqa: E402
+import devtools  # noqa: E402
+
+
+@pytest.fixture
+def app(tmp_path):
+    """A seeded app with its context pushed; per-process caches start empty."""
+    hospital.reset_process_caches()
+    seeded = devtools.create_app({'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'test.db'}",
+                                  'METRICS_ENABLED': False, 'ADMISSION_ENABLED': False})
+    with seeded.app_context():
+        hospital.seed_database()
+        yield seeded
+        hospital.db.session.remove()
+        hospital.db.engine.dispose()
+    hospital.reset_process_caches()
+
+
+@pytest.fixture
+def make_doctor(app):
+    """make_doctor(username, schedule=((weekday, 'HH:MM', 'HH:MM'), ...)) -> committed Doctor."""
+    def make(username, schedule=(), department_id=1):
+        user = hospital.User(username=username, password=devtools.BENCH_PASSWORD, role='doctor')
+        doctor = hospital.Doctor(user=user, department_id=department_id)
+        hospital.db.session.add(doctor)
+        hospital.db.session.flush()
+        for weekday, start, end in schedule:
+            hospital.db.session.add(hospital.DoctorSchedule(
+                doctor_id=doctor.id, weekday=weekday, start_time=parse_time(start), end_time=parse_time(end)))
+        hospital.db.session.commit()
+        return doctor
+    return make
+
+
+@pytest.fixture
+def make_patient(app):
+    """make_patient(username) -> committed Patient."""
+    def make(username):
+        patient = hospital.Patient(user=hospital.User(username=username, password=devtools.BENCH_PASSWORD,
+                                                      role='patient'))
+        hospital.db.session.add(patient)
+        hospital.db.session.commit()
+        return patient
+    return make
+
+
+def parse_time(value):
+    return datetime.strptime(value, '%H:%M').time()
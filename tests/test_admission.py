@@ -0,0 +1,51 @@
+"""Default admission rules throttle a booking surge at one doctor."""
+from datetime import datetime, timedelta
+
+import pytest
+
+import app as hospital
+import devtools
+
+
+@pytest.fixture
+def guarded(tmp_path):
+    hospital.reset_process_caches()
+    hospital._admission_rejections.clear()
+    guarded = devtools.create_app({'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'test.db'}",
+                                   'METRICS_ENABLED': False, 'ADMISSION_ENABLED': True})
+    with guarded.app_context():
+        hospital.seed_database()
+        devtools.generate_hospital_data(doctors=1, patients=20, appointments=0, seed=5)
+        hospital.db.session.remove()
+    yield guarded
+    with guarded.app_context():
+        hospital.db.engine.dispose()
+    hospital.reset_process_caches()
+
+
+def test_surge_at_one_doctor_is_throttled(guarded):
+    with guarded.app_context():
+        doctor_id = hospital.db.session.query(hospital.Doctor.id).scalar()
+        usernames = [name for name, in hospital.db.session.query(hospital.User.username).filter_by(role='patient')]
+        hospital.db.session.remove()
+    day = (datetime.now().date() + timedelta(days=400)).isoformat()
+    _, burst = guarded.config['ADMISSION_RULES']['book_appointment']['doctor_rate']
+
+    statuses = []
+    for n, username in enumerate(usernames):
+        client = guarded.test_client()
+        client.post('/login', data={'username': username, 'password': devtools.BENCH_PASSWORD})
+        statuses.append(client.post('/patient/book_appointment',
+                                    data={'doctor_id': doctor_id, 'date': day, 'time': f'{n:02d}:00'}).status_code)
+
+    assert statuses.count(429) >= len(usernames) - burst - 1  # refill while the loop runs is at most a token
+    assert 429 not in statuses[:burst]
+    assert hospital._admission_rejections[('book_appointment', 'doctor')] == statuses.count(429)
+
+
+def test_anonymous_posts_do_not_create_doctor_buckets(guarded):
+    client = guarded.test_client()
+    for doctor_id in range(1000, 1010):
+        client.post('/patient/book_appointment', data={'doctor_id': doctor_id, 'date': '2030-01-01', 'time': '09:00'})
+    keys = guarded.extensions['admission']['buckets']._buckets
+    assert not [key for key in keys if ':doctor:' in key]
@@ -0,0 +1,66 @@
+"""Archived appointment and treatment ids are never handed out again."""
+import shutil
+import sqlite3
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import app as hospital
+import devtools
+from conftest import parse_time
+
+BASELINE_DB = Path(__file__).resolve().parent.parent / 'instance' / 'hospital.db'
+
+
+def _visit(doctor, patient, days_ago, status='Completed'):
+    appointment = hospital.Appointment(doctor_id=doctor.id, patient_id=patient.id, status=status,
+                                       date=datetime.now().date() - timedelta(days=days_ago),
+                                       time=parse_time('09:00'))
+    hospital.db.session.add(appointment)
+    hospital.db.session.commit()
+    return appointment
+
+
+def test_new_booking_after_archive_and_deletion_gets_a_fresh_id(make_doctor, make_patient):
+    doctor = make_doctor('doctor')
+    kept, deleted = make_patient('kept'), make_patient('deleted')
+    archived_ids = [_visit(doctor, kept, 60).id, _visit(doctor, kept, 50).id]
+    newest_id = _visit(doctor, deleted, 40, status='Booked').id
+    hospital.db.session.add(hospital.Treatment(appointment_id=archived_ids[0], diagnosis='Flu'))
+    hospital.db.session.commit()
+
+    assert hospital.archive_closed_appointments(datetime.now().date(), report=lambda line: None) == (2, 1)
+    hospital.delete_profile('patient', deleted.id)
+    hospital.db.session.commit()
+
+    booked = hospital.book_slot(kept.id, doctor.id, datetime.now().date() + timedelta(days=3), parse_time('10:00'))
+    assert booked.id > newest_id
+    hospital.db.session.add(hospital.Treatment(appointment_id=booked.id, diagnosis='Cough'))
+    hospital.db.session.commit()
+
+    history_ids = [entry.appointment_id for entry in hospital.load_patient_history(kept.id)]
+    assert sorted(history_ids) == sorted(archived_ids + [booked.id])
+
+
+def test_seeding_rebuilds_a_legacy_database_with_autoincrement_ids(tmp_path):
+    path = tmp_path / 'legacy.db'
+    shutil.copy(BASELINE_DB, path)
+    with sqlite3.connect(path) as connection:
+        before = connection.execute('SELECT * FROM appointment ORDER BY id').fetchall()
+
+    hospital.reset_process_caches()
+    legacy = devtools.create_app({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{path}', 'ADMISSION_ENABLED': False})
+    try:
+        with legacy.app_context():
+            hospital.seed_database()
+            hospital.db.engine.dispose()
+    finally:
+        hospital.reset_process_caches()
+
+    with sqlite3.connect(path) as connection:
+        for table in ('appointment', 'treatment'):
+            sql = connection.execute("SELECT sql FROM sqlite_master WHERE name = ?", (table,)).fetchone()[0]
+            assert 'AUTOINCREMENT' in sql
+        assert connection.execute('SELECT * FROM appointment ORDER BY id').fetchall() == before
+        indexes = {name for name, in connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'appointment'")}
+        assert {'ix_appointment_doctor_status', 'ix_appointment_patient_status'} <= indexes
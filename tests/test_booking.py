@@ -0,0 +1,51 @@
+"""Booking relies on the unique slot constraint to detect a taken slot."""
+from datetime import datetime, timedelta
+
+import app as hospital
+import devtools
+from conftest import parse_time
+
+
+def _next_monday():
+    today = datetime.now().date()
+    return today + timedelta(days=7 - today.weekday())
+
+
+def _post_booking(app, username, doctor_id, day, at):
+    """Post the booking form as username; returns the flashed (category, message) pairs."""
+    client = app.test_client()
+    client.post('/login', data={'username': username, 'password': devtools.BENCH_PASSWORD})
+    with client.session_transaction() as session:
+        session.pop('_flashes', None)
+    response = client.post('/patient/book_appointment',
+                           data={'doctor_id': doctor_id, 'date': day.isoformat(), 'time': at})
+    assert response.status_code == 302
+    with client.session_transaction() as session:
+        return session.get('_flashes', [])
+
+
+def test_second_insert_for_a_slot_is_reported_as_taken(make_doctor, make_patient):
+    doctor = make_doctor('doctor')
+    first, second = make_patient('first'), make_patient('second')
+    day, at = _next_monday(), parse_time('09:00')
+
+    assert hospital.book_slot(first.id, doctor.id, day, at) is not None
+    assert hospital.book_slot(second.id, doctor.id, day, at) is None
+    assert hospital.db.session.query(hospital.Appointment).filter_by(doctor_id=doctor.id).count() == 1
+    assert hospital.read_counters()['appointments:Booked'] == 1
+
+
+def test_booking_form_reports_taken_and_unscheduled_slots(app, make_doctor, make_patient):
+    doctor_id = make_doctor('doctor', schedule=[(0, '09:00', '10:00')]).id
+    make_patient('first')
+    make_patient('second')
+    monday = _next_monday()
+
+    assert _post_booking(app, 'first', doctor_id, monday, '09:00') == [
+        ('success', 'Appointment booked successfully!')]
+    assert _post_booking(app, 'second', doctor_id, monday, '09:00') == [
+        ('warning', 'This time slot is already booked!')]
+    assert _post_booking(app, 'second', doctor_id, monday, '11:00') == [
+        ('warning', "That time is outside the doctor's open slots. Please pick one from the list.")]
+    assert _post_booking(app, 'second', doctor_id, monday, '09:30') == [
+        ('success', 'Appointment booked successfully!')]
@@ -0,0 +1,18 @@
+"""Per-process caches stay within their configured size."""
+import app as hospital
+
+
+def test_dashboard_cache_keeps_the_most_recent_principals(app):
+    app.config['DASHBOARD_CACHE_SIZE'] = 2
+    computed = []
+
+    def dashboard(principal):
+        return hospital.cached_dashboard(principal, lambda: computed.append(principal) or principal)
+
+    for principal in (('doctor', 1), ('doctor', 2), ('doctor', 1), ('patient', 3)):
+        dashboard(principal)
+    assert len(hospital._dashboard_cache) == 2
+
+    dashboard(('doctor', 1))  # still cached: used more recently than ('doctor', 2)
+    dashboard(('doctor', 2))  # evicted, so computed again
+    assert computed == [('doctor', 1), ('doctor', 2), ('patient', 3), ('doctor', 2)]
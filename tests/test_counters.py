@@ -0,0 +1,35 @@
+"""Dashboard counters stay equal to a full recount, including archived appointments."""
+from datetime import datetime, timedelta
+
+import app as hospital
+import devtools
+
+
+def _stored():
+    return dict(hospital.db.session.query(hospital.StatCounter.name, hospital.StatCounter.value))
+
+
+def test_partly_seeded_counters_are_rebuilt_on_read(app):
+    devtools.generate_hospital_data(doctors=3, patients=5, appointments=40, seed=3)
+    hospital.StatCounter.query.filter(hospital.StatCounter.name != 'appointments').delete()
+    hospital.db.session.commit()
+
+    assert hospital.read_counters() == hospital.compute_counters()
+
+
+def test_lazily_seeded_counter_includes_the_archive(app, make_patient):
+    devtools.generate_hospital_data(doctors=3, patients=5, appointments=40, seed=3)
+    hospital.archive_closed_appointments(datetime.now().date(), chunk_size=10, report=lambda line: None)
+    hospital.StatCounter.query.delete()
+    hospital.db.session.commit()
+
+    doctor_id = hospital.db.session.query(hospital.Doctor.id).first()[0]
+    patient = make_patient('counted')
+    hospital.db.session.add(hospital.Appointment(patient_id=patient.id, doctor_id=doctor_id, status='Booked',
+                                                 date=datetime.now().date() + timedelta(days=400),
+                                                 time=datetime.strptime('09:00', '%H:%M').time()))
+    hospital.db.session.commit()
+
+    expected = hospital.compute_counters()
+    assert _stored()['appointments'] == expected['appointments']
+    assert _stored()['appointments:Booked'] == expected['appointments:Booked']
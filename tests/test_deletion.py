@@ -0,0 +1,59 @@
+"""Deleting a profile removes its rows from every table, index and counter."""
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import func, text
+
+import app as hospital
+import devtools
+
+
+def _orphaned_fts_rows():
+    return hospital.db.session.execute(text(
+        'SELECT count(*) FROM treatment_fts WHERE rowid NOT IN '
+        '(SELECT id FROM treatment UNION ALL SELECT id FROM treatment_archive)')).scalar()
+
+
+def _busiest(column):
+    return hospital.db.session.query(column).group_by(column).order_by(func.count().desc()).limit(1).scalar()
+
+
+@pytest.fixture
+def history(app):
+    app.config.update(DELETE_CHUNK_SIZE=7, DELETE_CHUNK_PAUSE=0)
+    devtools.generate_hospital_data(doctors=3, patients=6, appointments=200, seed=11)
+    hospital.archive_closed_appointments(datetime.now().date() - timedelta(days=30), chunk_size=25,
+                                         report=lambda line: None)
+    assert hospital.db.session.query(hospital.TreatmentArchive).count()
+
+
+@pytest.mark.parametrize('kind, column', [('patient', hospital.Appointment.patient_id),
+                                          ('doctor', hospital.Appointment.doctor_id)])
+def test_deletion_removes_fts_rows_and_adjusts_counters(history, kind, column):
+    profile_id = _busiest(column)
+    model = hospital.Patient if kind == 'patient' else hospital.Doctor
+    user_id = hospital.db.session.get(model, profile_id).user_id
+
+    hospital.delete_profile(kind, profile_id)
+
+    for appointment in (hospital.Appointment, hospital.AppointmentArchive):
+        assert not hospital.db.session.query(appointment).filter(
+            getattr(appointment, f'{kind}_id') == profile_id).count()
+    assert hospital.db.session.get(model, profile_id) is None
+    assert hospital.db.session.get(hospital.User, user_id) is None
+    assert _orphaned_fts_rows() == 0
+    stored = dict(hospital.db.session.query(hospital.StatCounter.name, hospital.StatCounter.value))
+    assert stored == hospital.compute_counters()
+
+
+def test_deletion_while_the_fts_table_is_missing_leaves_no_orphans(history):
+    hospital.db.session.execute(text('DROP TABLE treatment_fts'))
+    hospital.db.session.commit()
+    hospital.reset_process_caches()
+
+    hospital.delete_profile('patient', _busiest(hospital.Appointment.patient_id))
+
+    assert _orphaned_fts_rows() == 0
+    indexed = hospital.db.session.execute(text('SELECT count(*) FROM treatment_fts')).scalar()
+    assert indexed == (hospital.db.session.query(hospital.Treatment).count()
+                       + hospital.db.session.query(hospital.TreatmentArchive).count())
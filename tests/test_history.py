@@ -0,0 +1,28 @@
+"""Access to the patient history API."""
+from datetime import datetime, timedelta
+
+import app as hospital
+import devtools
+from conftest import parse_time
+
+
+def test_doctor_with_only_archived_visits_can_read_the_history(app, make_doctor, make_patient):
+    doctor = make_doctor('doctor')
+    make_doctor('stranger')
+    patient = make_patient('patient')
+    hospital.db.session.add(hospital.Appointment(doctor_id=doctor.id, patient_id=patient.id, status='Completed',
+                                                 date=datetime.now().date() - timedelta(days=30),
+                                                 time=parse_time('09:00')))
+    hospital.db.session.commit()
+    hospital.archive_closed_appointments(datetime.now().date(), report=lambda line: None)
+    patient_id = patient.id
+
+    client = app.test_client()
+    client.post('/login', data={'username': 'doctor', 'password': devtools.BENCH_PASSWORD})
+    response = client.get(f'/api/patients/{patient_id}/history')
+    assert response.status_code == 200
+    assert len(response.get_json()['entries']) == 1
+
+    client = app.test_client()
+    client.post('/login', data={'username': 'stranger', 'password': devtools.BENCH_PASSWORD})
+    assert client.get(f'/api/patients/{patient_id}/history').status_code == 403
@@ -0,0 +1,60 @@
+"""Rerunning an import skips what is already there."""
+import json
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+import app as hospital
+
+
+def _write(path, rows):
+    path.write_text(''.join(json.dumps(row) + '\n' for row in rows))
+    return str(path)
+
+
+def _import(app, tmp_path, **files):
+    args = ['import-data', '--checkpoint', str(tmp_path / 'checkpoint.json')]
+    for kind, path in files.items():
+        args += [f'--{kind}', path]
+    result = app.test_cli_runner().invoke(args=args)
+    assert result.exit_code == 0, result.output
+    hospital.db.session.remove()
+    return result.output
+
+
+def _snapshot():
+    tables = ('user', 'doctor', 'patient', 'appointment', 'treatment', 'treatment_fts')
+    counts = {table: hospital.db.session.execute(text(f'SELECT count(*) FROM "{table}"')).scalar()
+              for table in tables}
+    return counts, hospital.read_counters()
+
+
+def test_second_run_of_the_same_files_changes_nothing(app, tmp_path):
+    department = hospital.db.session.query(hospital.Department.name).first()[0]
+    day = (datetime.now().date() - timedelta(days=2)).isoformat()
+    visit = {'doctor': 'dr_import', 'date': day, 'time': '09:00'}
+    files = {
+        'doctors': _write(tmp_path / 'doctors.jsonl', [
+            {'username': 'dr_import', 'department': department, 'password': 'x'}]),
+        'patients': _write(tmp_path / 'patients.jsonl', [
+            {'username': 'imported_patient', 'password': 'x'}]),
+        'appointments': _write(tmp_path / 'appointments.jsonl', [
+            dict(visit, patient='imported_patient', status='Completed')]),
+        'treatments': _write(tmp_path / 'treatments.jsonl', [
+            dict(visit, diagnosis='Asthma'), dict(visit, diagnosis='Asthma again')]),
+    }
+
+    _import(app, tmp_path, **files)
+    first = _snapshot()
+    assert first[0]['treatment'] == first[0]['treatment_fts'] == 1
+    assert first[1]['doctors'] == 1 and first[1]['appointments'] == 1
+
+    output = _import(app, tmp_path, **files)
+    assert _snapshot() == first
+    assert 'treatments: 2 rows read, 0 imported, 2 skipped' in output
+    assert not (tmp_path / 'checkpoint.json').exists()
+
+
+def test_empty_file_imports_nothing(app, tmp_path):
+    output = _import(app, tmp_path, users=_write(tmp_path / 'users.jsonl', []))
+    assert 'Import finished, 0 row(s) rejected' in output
@@ -0,0 +1,77 @@
+"""Every list page runs a fixed number of SQL statements, whatever the row count."""
+import os
+import sys
+
+import pytest
+from sqlalchemy import event, func
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as hospital  # noqa: E402
+import devtools  # noqa: E402
+
+LIST_PAGES = [
+    ('admin', '/admin/appointments'),
+    ('admin', '/admin/doctors'),
+    ('admin', '/admin/treatments'),
+    ('admin', '/admin/patients'),
+    ('doctor', '/doctor/appointments?view=month'),
+    ('patient', '/patient/appointments'),
+    ('patient', '/patient/treatments'),
+]
+
+SIZES = {
+    'small': {'doctors': 4, 'patients': 20, 'appointments': 300},
+    'large': {'doctors': 40, 'patients': 200, 'appointments': 3000},
+}
+
+
+def _busiest(column):
+    return hospital.db.session.query(column).group_by(column).order_by(func.count().desc()).limit(1).scalar()
+
+
+def _query_counts(tmp_path, size):
+    """{(role, url): statements} for one warmed request to each list page."""
+    hospital.reset_process_caches()
+    app = devtools.create_app({'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / f'{size}.db'}",
+                               'METRICS_ENABLED': False, 'ADMISSION_ENABLED': False})
+    with app.app_context():
+        hospital.seed_database()
+        devtools.generate_hospital_data(**SIZES[size], seed=1)
+        doctor = hospital.db.session.get(hospital.Doctor, _busiest(hospital.Appointment.doctor_id))
+        patient = hospital.db.session.get(hospital.Patient, _busiest(hospital.Appointment.patient_id))
+        logins = {'admin': ('Admin', '@dmin123'),
+                  'doctor': (doctor.user.username, devtools.BENCH_PASSWORD),
+                  'patient': (patient.user.username, devtools.BENCH_PASSWORD)}
+        engine = hospital.db.engine
+        hospital.db.session.remove()
+
+    statements = []
+    event.listen(engine, 'before_cursor_execute', lambda *args: statements.append(1))
+    counts = {}
+    try:
+        for role, url in LIST_PAGES:
+            client = app.test_client()
+            client.post('/login', data=dict(zip(('username', 'password'), logins[role])))
+            client.get(url).get_data()  # warm the per-process caches
+            statements.clear()
+            response = client.get(url)
+            response.get_data()  # streamed pages run their queries while the body is read
+            assert response.status_code == 200, url
+            counts[(role, url)] = len(statements)
+    finally:
+        with app.app_context():
+            hospital.db.engine.dispose()
+        hospital.reset_process_caches()
+    return counts
+
+
+@pytest.fixture(scope='module')
+def query_counts(tmp_path_factory):
+    tmp_path = tmp_path_factory.mktemp('list-queries')
+    return {size: _query_counts(tmp_path, size) for size in SIZES}
+
+
+@pytest.mark.parametrize('role, url', LIST_PAGES)
+def test_list_page_query_count_is_fixed(query_counts, role, url):
+    assert query_counts['small'][(role, url)] == query_counts['large'][(role, url)]
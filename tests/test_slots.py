@@ -0,0 +1,53 @@
+"""The department earliest-slot search agrees with each doctor's open slots."""
+from datetime import datetime, timedelta
+
+import app as hospital
+from conftest import parse_time
+
+
+def _next_monday():
+    today = datetime.now().date()
+    return today + timedelta(days=7 - today.weekday())
+
+
+def _book(doctor, patient, day, at):
+    hospital.db.session.add(hospital.Appointment(doctor_id=doctor.id, patient_id=patient.id,
+                                                 date=day, time=parse_time(at)))
+    hospital.db.session.commit()
+
+
+def test_bookings_of_unscheduled_doctors_do_not_fill_the_day(make_doctor, make_patient):
+    monday = _next_monday()
+    scheduled = make_doctor('scheduled', schedule=[(0, '09:00', '10:00')])
+    unscheduled = make_doctor('unscheduled')
+    patient = make_patient('patient')
+    _book(unscheduled, patient, monday, '09:00')
+    _book(unscheduled, patient, monday, '09:30')
+
+    found = hospital.earliest_department_slots(1, monday, 1, 10)
+
+    assert [(day, at) for day, at, _, _ in found] == [(monday, parse_time('09:00')), (monday, parse_time('09:30'))]
+    assert {doctor_id for _, _, doctor_id, _ in found} == {scheduled.id}
+    assert hospital.open_slots(scheduled.id, monday, 1)[monday] == [parse_time('09:00'), parse_time('09:30')]
+
+
+def test_earliest_slots_match_open_slots_with_mixed_schedules(make_doctor, make_patient):
+    monday = _next_monday()
+    short = make_doctor('short', schedule=[(0, '09:00', '10:00'), (1, '09:00', '10:00')])
+    long = make_doctor('long', schedule=[(0, '09:30', '11:00')])
+    unscheduled = make_doctor('unscheduled')
+    patient = make_patient('patient')
+    _book(short, patient, monday, '09:00')
+    _book(short, patient, monday, '14:00')  # outside the hours, left by a schedule change
+    _book(long, patient, monday, '09:30')
+    _book(long, patient, monday, '10:00')
+    _book(unscheduled, patient, monday + timedelta(days=1), '09:00')
+
+    found = hospital.earliest_department_slots(1, monday, 7, 100)
+
+    expected = sorted((day, at, doctor.id) for doctor in (short, long, unscheduled)
+                      for day, times in hospital.open_slots(doctor.id, monday, 7).items() for at in times)
+    assert sorted((day, at, doctor_id) for day, at, doctor_id, _ in found) == expected
+    assert expected == [(monday, parse_time('09:30'), short.id), (monday, parse_time('10:30'), long.id),
+                        (monday + timedelta(days=1), parse_time('09:00'), short.id),
+                        (monday + timedelta(days=1), parse_time('09:30'), short.id)]
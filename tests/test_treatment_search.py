@@ -0,0 +1,53 @@
+"""The treatment FTS index follows treatment and username writes."""
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+import app as hospital
+from conftest import parse_time
+
+
+def _indexed():
+    return {rowid: (diagnosis, patient) for rowid, diagnosis, patient in hospital.db.session.execute(
+        text('SELECT rowid, diagnosis, patient FROM treatment_fts'))}
+
+
+def _found(search):
+    return [treatment_id for treatment_id, _ in hospital.search_treatments(search, None, 50)[0]]
+
+
+def test_index_follows_insert_update_rename_and_delete(make_doctor, make_patient):
+    doctor, patient = make_doctor('doctor'), make_patient('margaret')
+    appointment = hospital.Appointment(doctor_id=doctor.id, patient_id=patient.id, status='Completed',
+                                       date=datetime.now().date() - timedelta(days=3), time=parse_time('09:00'))
+    treatment = hospital.Treatment(appointment=appointment, diagnosis='Bronchitis', prescription='Rest')
+    hospital.db.session.add(treatment)
+    hospital.db.session.commit()
+    assert _indexed() == {treatment.id: ('Bronchitis', 'margaret')}
+    assert _found('bronchitis') == [treatment.id]
+
+    treatment.diagnosis = 'Migraine'
+    patient.user.username = 'peggy'
+    hospital.db.session.commit()
+    assert _indexed() == {treatment.id: ('Migraine', 'peggy')}
+    assert _found('bronchitis') == []
+    assert _found('peggy') == [treatment.id]
+
+    hospital.db.session.delete(treatment)
+    hospital.db.session.commit()
+    assert _indexed() == {}
+    assert _found('migraine') == []
+
+
+def test_index_covers_archived_treatments(make_doctor, make_patient):
+    doctor, patient = make_doctor('doctor'), make_patient('archived')
+    appointment = hospital.Appointment(doctor_id=doctor.id, patient_id=patient.id, status='Completed',
+                                       date=datetime.now().date() - timedelta(days=90), time=parse_time('09:00'))
+    hospital.db.session.add(hospital.Treatment(appointment=appointment, diagnosis='Sprain'))
+    hospital.db.session.commit()
+    hospital.archive_closed_appointments(datetime.now().date(), report=lambda line: None)
+
+    assert hospital.db.session.query(hospital.TreatmentArchive).count() == 1
+    assert len(_found('sprain')) == 1
+    assert hospital.rebuild_treatment_fts() == 1
+    assert len(_found('sprain')) == 1